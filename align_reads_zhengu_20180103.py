@@ -23,12 +23,21 @@
 __author__ = 'Maggie Ruimin Sun'
 __version__ = '0.1'
 
-import subprocess
 import os
 import logging
 import time
 import sys
-import yaml
+
+import fastq_utils_zhengu_20180103
+import lift_over_zhengu_20180103
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import resources_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import stage_cache_zhengu_20180103
+import shell_command_zhengu_20180103
+import trace_zhengu_20180103
+from shell_command_zhengu_20180103 import run_command, run_pipe, run_shell_command
 
 def setup_logger(name, log_file, formatter, level=logging.DEBUG):
     handler = logging.FileHandler(log_file)
@@ -51,19 +60,9 @@ def store_logs(log_dir):
                                     formatter_bwa_errors)
     return logger_bwa_process, logger_bwa_errors
 
-def align_reads_bwa(bwa_dir, ref_fa_file, ref_index_name, read1, read2, 
-                    out_file, n_threads, read_group, logger_bwa_process, 
+def check_bwa_index(bwa_dir, ref_fa_file, ref_index_name, logger_bwa_process,
                     logger_bwa_errors):
-    out_dir = os.path.dirname(out_file)
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    
-    if not os.path.isfile(read1):
-        logger_bwa_errors.error('%s does not exists!', read1)
-        return
-    
     # check the existence of each index file
-    sample_alignment_dirs = {}
     index_files_extensions = ['.pac', '.amb', '.ann', '.bwt', '.sa']
     genome_indexed = True
     for extension in index_files_extensions:
@@ -75,69 +74,389 @@ def align_reads_bwa(bwa_dir, ref_fa_file, ref_index_name, read1, read2,
                                'Running BWA to generate the required indices.')
         bwa_index_command = '{0} index -p {1} {2}'.format(
             bwa_dir, ref_index_name, ref_fa_file)
-        logger_bwa_process.info(bwa_index_command)
-        subprocess.call(bwa_index_command.split())
+        # libraries aligned in parallel wait for the first one to build it
+        with reference_zhengu_20180103.locked(ref_index_name + '.lock', 
+                                              logger_bwa_process):
+            if all(os.path.isfile(ref_index_name + extension) 
+                   for extension in index_files_extensions):
+                return 0
+            returncode_index = run_shell_command(bwa_index_command, logger_bwa_process, 
+                                                 logger_bwa_errors)
+        if not returncode_index == 0:
+            logger_bwa_errors.error('BWA indexing returns non-zero value %d.', 
+                                    returncode_index)
+            return 1
         logger_bwa_process.info('BWA genome index files are generated.')
     else:
         logger_bwa_process.info('BWA genome index files exist.')
+    return 0
+
+def check_read_stats(stats, read_stats_file, logger_bwa_process, logger_bwa_errors):
+    """Report the read statistics collected while the aligner read the files. 
+    A problem fails the alignment, before any downstream stage starts."""
+    if stats is None:
+        return 0
+    if read_stats_file is not None:
+        stats.write_report(read_stats_file)
+    problems = stats.check()
+    for problem in problems:
+        logger_bwa_errors.error('Read files: %s', problem)
+    if problems:
+        print('The read files failed the checks! Check the logging files.')
+        return 1
+    logger_bwa_process.info('%d read pairs passed the checks.', stats.n_pairs)
+    return 0
+
+def align_reads_bwa(bwa_dir, ref_fa_file, ref_index_name, read1, read2, 
+                    out_file, n_threads, read_group, logger_bwa_process, 
+                    logger_bwa_errors, batch_bases=None, read_stats_file=None, 
+                    decompress_threads=1):
+    out_dir = os.path.dirname(out_file)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    
+    for read_file in (read1, read2):
+        if not os.path.isfile(read_file):
+            logger_bwa_errors.error('%s does not exists!', read_file)
+            return 1
+    
+    if not check_bwa_index(bwa_dir, ref_fa_file, ref_index_name, logger_bwa_process,
+                           logger_bwa_errors) == 0:
+        return 1
     
     #Run BWA-MEM
     logger_bwa_process.info('Running paired end mapping.')
-    bwa_align_command = '{0} mem -t {1} -M -R {2} {3} {4} {5} > {6}'.format(
-        bwa_dir, n_threads, read_group, ref_index_name, read1, read2, out_file)
-    logger_bwa_process.info(bwa_align_command)
-    os.system(bwa_align_command)
+    with fastq_utils_zhengu_20180103.feed_read_pair(
+            read1, read2, out_dir, read_stats_file is not None, 
+            decompress_threads) as (fastq1, fastq2, stats):
+        bwa_align_command = '{0} mem -t {1} -M -R {2} {3} {4} {5}'.format(
+            bwa_dir, n_threads, read_group, ref_index_name, fastq1, fastq2)
+        if batch_bases is not None:
+            # a fixed batch size makes the results independent of the thread count
+            bwa_align_command = bwa_align_command.replace(
+                ' -M ', ' -K {0} -M '.format(batch_bases), 1)
+        logger_bwa_process.info('Writing alignments to %s.', out_file)
+        with open(out_file, 'wb') as sam_out:
+            returncode_align = run_command(bwa_align_command, logger_bwa_process, 
+                                           logger_bwa_errors, stdout=sam_out).returncode
+    if not returncode_align == 0:
+        logger_bwa_errors.error('BWA-MEM returns non-zero value %d.', returncode_align)
+        print('Alignment failed! Check the logging files.')
+        return 1
+    if not check_read_stats(stats, read_stats_file, logger_bwa_process, 
+                            logger_bwa_errors) == 0:
+        os.remove(out_file)
+        return 1
     logger_bwa_process.info('Paired end mapping finished.')
+    return 0
 
-def modify_sam_location(sam_file_org, sam_file_mod):
-    sam_in = open(sam_file_org)
-    sam_out = open(sam_file_mod, 'w')
-    for row in sam_in:
-        if row[0] == '@':
-            sam_out.write(row)
-            continue
-        items = row.strip().split()
-        if items[2] == '*':
-            sam_out.write(row)
-            continue
-        chrom, start, stop = items[2].split('_')
-        pos = int(v[3]) + int(start) - 1
-        sam_out.write(v[0] + '\t' + v[1] + '\t' + chrom + '\t' + str(pos) 
-                     + '\t' + '\t'.join(v[4:]) + '\n')
-        sam_in.close()
-        sam_out.close()
+def align_reads_bwa_streaming(bwa_dir, picard_dir, ref_fa_file, ref_index_name, 
+                              read1, read2, out_bam, n_threads, read_group, 
+                              logger_bwa_process, logger_bwa_errors, batch_bases=None, 
+                              read_stats_file=None, decompress_threads=1, profile=None):
+    """Pipe BWA-MEM straight into Picard SortSam, producing a coordinate sorted 
+    and indexed BAM without writing the intermediate SAM to disk. The OS pipe 
+    between the processes provides the back-pressure."""
+    out_dir = os.path.dirname(out_bam)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    
+    for read_file in (read1, read2):
+        if not os.path.isfile(read_file):
+            logger_bwa_errors.error('%s does not exists!', read_file)
+            return 1
+    
+    if not check_bwa_index(bwa_dir, ref_fa_file, ref_index_name, logger_bwa_process,
+                           logger_bwa_errors) == 0:
+        return 1
+    
+    logger_bwa_process.info('Running paired end mapping in streaming mode.')
+    with fastq_utils_zhengu_20180103.feed_read_pair(
+            read1, read2, out_dir, read_stats_file is not None, 
+            decompress_threads) as (fastq1, fastq2, stats):
+        # the read group is passed as a single argument, no shell quoting needed
+        bwa_align_command = [bwa_dir, 'mem', '-t', str(n_threads), '-M', 
+                             '-R', read_group.strip('\''), ref_index_name, fastq1, fastq2]
+        if batch_bases is not None:
+            bwa_align_command[4:4] = ['-K', str(batch_bases)]
+        command_sort = (resources_zhengu_20180103.java_args(picard_dir, profile) + 
+                        ['SortSam', 'INPUT=/dev/stdin', 'OUTPUT=' + out_bam, 
+                         'SORT_ORDER=coordinate', 'CREATE_INDEX=true'] + 
+                        resources_zhengu_20180103.picard_args(profile))
+        commands = [bwa_align_command, command_sort]
+        stage_names = ['BWA-MEM', 'Picard sorting']
+        returncodes = [result.returncode for result in 
+                       run_pipe(commands, logger_bwa_process, logger_bwa_errors)]
+    returncodes.append(check_read_stats(stats, read_stats_file, logger_bwa_process, 
+                                        logger_bwa_errors))
+    stage_names.append('Read check')
+    
+    for stage_name, returncode in zip(stage_names, returncodes):
+        if not returncode == 0:
+            logger_bwa_errors.error('%s returns non-zero value %d.', stage_name, 
+                                    returncode)
+    if any(returncodes):
+        # a truncated stream still yields a valid looking BAM, never keep it
+        for partial_file in (out_bam, os.path.splitext(out_bam)[0] + '.bai'):
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+        print('Streaming alignment failed! Check the logging files.')
+        return 1
+    logger_bwa_process.info('Paired end mapping and sorting finished.')
+    return 0
 
-def main():
-    with open('configure.yaml') as yamlfile:
-        config = yaml.load(yamlfile)
-    yamlfile.close()
+def split_read_pair(bwa_dir, ref_fa_file, ref_index_name, read1, read2, 
+                    out_prefix, n_chunks, batch_bases, logger_bwa_process, 
+                    logger_bwa_errors, read_stats_file=None, decompress_threads=1):
+    """Split the read pair into 'n_chunks' chunk pairs on BWA-MEM batch 
+    boundaries, so that every chunk can be aligned on its own. A short 
+    library may leave the last chunks without reads and without files."""
+    out_dir = os.path.dirname(out_prefix)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for read_file in (read1, read2):
+        if not os.path.isfile(read_file):
+            logger_bwa_errors.error('%s does not exists!', read_file)
+            return 1
+    # index once, before the chunks would race to build it
+    if not check_bwa_index(bwa_dir, ref_fa_file, ref_index_name, logger_bwa_process,
+                           logger_bwa_errors) == 0:
+        return 1
+    
+    # the read statistics are collected while splitting
+    stats = fastq_utils_zhengu_20180103.ReadStats() \
+        if read_stats_file is not None else None
+    try:
+        filled = fastq_utils_zhengu_20180103.split_fastq_pair(
+            read1, read2, out_prefix, n_chunks, batch_bases, stats, decompress_threads)
+        if not check_read_stats(stats, read_stats_file, logger_bwa_process, 
+                                logger_bwa_errors) == 0:
+            raise ValueError('the read files failed the checks')
+    except (OSError, ValueError) as error:
+        for chunk_file in fastq_utils_zhengu_20180103.chunk_file_names(out_prefix, 
+                                                                       n_chunks):
+            for x in chunk_file:
+                if os.path.isfile(x):
+                    os.remove(x)
+        logger_bwa_errors.error('Cannot split %s and %s: %s', read1, read2, error)
+        print('Splitting the read files failed! Check the logging files.')
+        return 1
+    logger_bwa_process.info('Split %s into %d chunks.', read1, len(filled))
+    return 0
+
+def merge_chunk_bams(picard_dir, chunk_bams, out_bam, logger_bwa_process, 
+                     logger_bwa_errors, profile=None):
+    """Merge the sorted chunk BAMs into 'out_bam'. Every chunk carries the same 
+    read group, so the merged header holds it once."""
+    if not chunk_bams:
+        logger_bwa_errors.error('No chunk BAM to merge into %s.', out_bam)
+        return 1
+    command_merge = ('{0} MergeSamFiles {1} OUTPUT={2} '
+                     'SORT_ORDER=coordinate ASSUME_SORTED=true '
+                     'CREATE_INDEX=true{3}').format(
+        resources_zhengu_20180103.java_command(picard_dir, profile), 
+        ' '.join('INPUT=' + chunk_bam for chunk_bam in chunk_bams), out_bam, 
+        resources_zhengu_20180103.picard_options(profile))
+    returncode_merge = run_shell_command(command_merge, logger_bwa_process, 
+                                         logger_bwa_errors)
+    if not returncode_merge == 0:
+        logger_bwa_errors.error('Picard MergeSamFiles returns non-zero value %d.', 
+                                returncode_merge)
+        print('Merging the chunk BAMs failed! Check the logging files.')
+        return 1
+    logger_bwa_process.info('Merged %d chunk BAMs into %s.', len(chunk_bams), out_bam)
+    return 0
+
+def modify_sam_location(sam_file_org, sam_file_mod, ref_fa_file='-'):
+    """Translate the amplicon coordinates of a SAM file into genomic ones."""
+    return lift_over_zhengu_20180103.lift_over_sam_file(ref_fa_file, sam_file_org, 
+                                                        sam_file_mod)
+
+def align_library(config, library, logger_bwa_process, logger_bwa_errors):
+    bwa_dir = config['alignment']['software']
+    ref_index_name = config['alignment']['ref_index']
+    ref_fa_file = config['reference']['fa_file']
+    n_threads = config['alignment']['num_threads']
+    # the Picard sorter of the streaming and chunked modes
+    profile = resources_zhengu_20180103.stage_profile(config, 'align', library)
+    
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['align']
+    files = entry['files']
+    sample_name = entry['sample_name']
+    logger_bwa_process.info('Start alignment for data in {}.'.format(sample_name))
+    read1 = files['read1']
+    read2 = files['read2']
+    read_group = entry['read_group']
+    read_stats_file = files['read_stats'] if files['read_stats'] in stage['outputs'] \
+        else None
+    decompress_threads = config['alignment'].get('decompress_threads', 1)
+    n_chunks = config['alignment'].get('chunks', 1)
+    batch_bases = config['alignment'].get('batch_bases')
+    if n_chunks > 1:
+        # the single process runs the stages of the chunked mode in turn
+        n_workers = config['alignment'].get('chunk_workers', n_chunks)
+        returncode = split_library(config, library, logger_bwa_process, logger_bwa_errors)
+        if returncode:
+            return returncode
+        returncodes = shell_command_zhengu_20180103.map_in_context(
+            lambda chunk: align_chunk_library(config, library, chunk, logger_bwa_process, 
+                                              logger_bwa_errors), 
+            range(n_chunks), n_workers)
+        if any(returncodes):
+            print('Chunked alignment failed! Check the logging files.')
+            return 1
+        return merge_library(config, library, logger_bwa_process, logger_bwa_errors)
+    if config['alignment'].get('streaming', False):
+        picard_dir = config['sorting']['software']
+        out_file = files['sorted_bam']
+        with shell_command_zhengu_20180103.command_context(config, 'align', library):
+            return stage_cache_zhengu_20180103.run_stage(
+                config, 'align', library, 
+                lambda: align_reads_bwa_streaming(bwa_dir, picard_dir, ref_fa_file, ref_index_name, 
+                                                  read1, read2, out_file, str(n_threads), read_group, 
+                                                  logger_bwa_process, logger_bwa_errors, batch_bases, 
+                                                  read_stats_file, decompress_threads, profile),
+                inputs=stage['inputs'], outputs=stage['outputs'], 
+                tools=[bwa_dir, picard_dir], 
+                command=['align_reads_bwa_streaming', ref_index_name, read_group, 
+                         batch_bases, n_threads, profile], 
+                intermediate=True, logger_process=logger_bwa_process)
+    out_file = files['aligned_sam']
+    with shell_command_zhengu_20180103.command_context(config, 'align', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'align', library, 
+            lambda: align_reads_bwa(bwa_dir, ref_fa_file, ref_index_name, read1, read2, 
+                                    out_file, str(n_threads), read_group, logger_bwa_process, 
+                                    logger_bwa_errors, batch_bases, read_stats_file, 
+                                    decompress_threads),
+            inputs=stage['inputs'], outputs=stage['outputs'], 
+            tools=[bwa_dir], command=['align_reads_bwa', ref_index_name, read_group, 
+                                      batch_bases, n_threads], 
+            intermediate=True, logger_process=logger_bwa_process)
+
+def split_library(config, library, logger_bwa_process, logger_bwa_errors):
+    """The 'split' stage of the chunked mode."""
+    bwa_dir = config['alignment']['software']
+    ref_index_name = config['alignment']['ref_index']
+    ref_fa_file = config['reference']['fa_file']
+    n_chunks = config['alignment']['chunks']
+    batch_bases = config['alignment'].get('batch_bases') or \
+        fastq_utils_zhengu_20180103.BATCH_BASES
+    decompress_threads = config['alignment'].get('decompress_threads', 1)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['split']
+    files = entry['files']
+    read_stats_file = files['read_stats'] if files['read_stats'] in stage['outputs'] \
+        else None
+    out_prefix = os.path.splitext(files['sorted_bam'])[0]
+    with shell_command_zhengu_20180103.command_context(config, 'split', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'split', library, 
+            lambda: split_read_pair(bwa_dir, ref_fa_file, ref_index_name, files['read1'], 
+                                    files['read2'], out_prefix, n_chunks, batch_bases, 
+                                    logger_bwa_process, logger_bwa_errors, read_stats_file, 
+                                    decompress_threads),
+            inputs=stage['inputs'], outputs=stage['outputs'], tools=[bwa_dir], 
+            command=['split_read_pair', n_chunks, batch_bases, read_stats_file], 
+            intermediate=True, logger_process=logger_bwa_process)
+
+def align_chunk_library(config, library, chunk, logger_bwa_process, logger_bwa_errors):
+    """The 'align_chunk_<chunk>' stage of the chunked mode: align and sort one 
+    chunk of the split reads."""
     bwa_dir = config['alignment']['software']
+    picard_dir = config['sorting']['software']
     ref_index_name = config['alignment']['ref_index']
     ref_fa_file = config['reference']['fa_file']
-    source = config['input_data']['input_dir']
-    out_dir = source + config['alignment']['output_dir']
+    batch_bases = config['alignment'].get('batch_bases') or \
+        fastq_utils_zhengu_20180103.BATCH_BASES
+    n_workers = config['alignment'].get('chunk_workers', config['alignment']['chunks'])
+    # the threads of the alignment are shared by the chunks aligned at once
+    chunk_threads = max(1, int(config['alignment']['num_threads']) // max(1, n_workers))
+    profile = resources_zhengu_20180103.stage_profile(config, 'align', library)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage_name = 'align_chunk_{0}'.format(chunk)
+    stage = entry['stages'][stage_name]
+    read1, read2 = stage['inputs'][:2]
+    chunk_bam = stage['outputs'][0]
+    cache = stage_cache_zhengu_20180103.get_cache(config)
+    if not os.path.isfile(read1) and (cache is None or not cache.is_released(read1)):
+        logger_bwa_process.info('Chunk %d of %s received no reads.', chunk, library)
+        return 0
+    with shell_command_zhengu_20180103.command_context(config, stage_name, library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, stage_name, library, 
+            lambda: align_reads_bwa_streaming(bwa_dir, picard_dir, ref_fa_file, 
+                                              ref_index_name, read1, read2, chunk_bam, 
+                                              chunk_threads, entry['read_group'], 
+                                              logger_bwa_process, logger_bwa_errors, 
+                                              batch_bases, profile=profile),
+            inputs=stage['inputs'], outputs=stage['outputs'], 
+            tools=[bwa_dir, picard_dir], 
+            command=['align_reads_bwa_streaming', ref_index_name, entry['read_group'], 
+                     batch_bases, chunk_threads, profile], 
+            intermediate=True, logger_process=logger_bwa_process)
+
+def merge_library(config, library, logger_bwa_process, logger_bwa_errors):
+    """The 'align' stage of the chunked mode: merge the chunk BAMs into the 
+    sorted BAM of the library, then delete the chunk files."""
+    picard_dir = config['sorting']['software']
+    profile = resources_zhengu_20180103.stage_profile(config, 'align', library)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['align']
+    chunk_files = [file_name for stage_name, files in entry['stages'].items() 
+                   if stage_name == 'split' or stage_name.startswith('align_chunk_') 
+                   for file_name in files['outputs'] 
+                   if file_name != entry['files']['read_stats']]
+    cache = stage_cache_zhengu_20180103.get_cache(config)
+    # an empty chunk has no BAM, the released ones are produced again
+    chunk_bams = [x for x in stage['inputs'] if os.path.isfile(x) or 
+                  (cache is not None and cache.is_released(x))]
+    with shell_command_zhengu_20180103.command_context(config, 'align', library):
+        returncode = stage_cache_zhengu_20180103.run_stage(
+            config, 'align', library, 
+            lambda: merge_chunk_bams(picard_dir, chunk_bams, entry['files']['sorted_bam'], 
+                                     logger_bwa_process, logger_bwa_errors, profile),
+            inputs=stage['inputs'], outputs=stage['outputs'], tools=[picard_dir], 
+            command=['merge_chunk_bams', profile], 
+            intermediate=True, logger_process=logger_bwa_process)
+    if returncode:
+        return returncode
+    # the cache keeps the fingerprints of released files valid, so the
+    # chunk stages stay complete
+    for chunk_file in chunk_files:
+        if not os.path.isfile(chunk_file):
+            continue
+        if cache is not None:
+            cache.release(chunk_file)
+        else:
+            os.remove(chunk_file)
+    logger_bwa_process.info('Chunked paired end mapping finished.')
+    return 0
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
     log_dir = config['logging']
     logger_bwa_process, logger_bwa_errors = store_logs(log_dir)
-    n_threads = config['alignment']['num_threads']
+    trace_zhengu_20180103.configure_trace(config)
+    reference = reference_zhengu_20180103.prepare_reference(config, logger_bwa_process, 
+                                                            logger_bwa_errors)
+    if reference is None:
+        return 1
+    reference_zhengu_20180103.apply_reference(config, reference)
+    plan_zhengu_20180103.load_plan(config, logger_bwa_process)
     
     time_start = time.time()
     library = sys.argv[1]
-    #for library in config['input_data']['libraries']:
-    sample_name = config['input_data']['libraries'][library]['sample_name']
-    sample_id = config['input_data']['libraries'][library]['library_id']
-    logger_bwa_process.info('Start alignment for data in {}.'.format(sample_name))
-    filename1 = source + config['input_data']['libraries'][library]['location'] + sample_id + '-' + sample_name
-    print(filename1)
-    read1 = filename1 + config['input_data']['libraries'][library]['read1']
-    read2 = filename1 + config['input_data']['libraries'][library]['read2']
-    out_file = out_dir + sample_name + '_aligned.sam'
-    read_group = '\'@RG\\tID:{0}\\tPL:Illumina\\tLB:YN\\tSM:{1}\''.format(sample_id, sample_name)
-    align_reads_bwa(bwa_dir, ref_fa_file, ref_index_name, read1, read2, 
-                    out_file, str(n_threads), read_group, logger_bwa_process, 
-                    logger_bwa_errors)
+    returncode = align_library(config, library, logger_bwa_process, logger_bwa_errors)
+    if returncode:
+        return 1
     time_run = (time.time() - time_start) / 60
     logger_bwa_process.info('Finish alignment for library {0} after {1} min.'.format(library, str(time_run)))
     print('Finish alignment for library {0} after {1} min.'.format(library, str(time_run)))
+    return 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,817 @@
+#!/user/bin/env python3
+
+"""End-to-end benchmark of the pipeline on synthetic amplicon data.
+
+A run generates a synthetic amplicon reference with contigs named
+chrom_start_stop, a known-sites VCF and, for every library, a pair of FASTQ
+files with 'depth' read pairs per amplicon and a few planted SNPs. It writes
+a configure.yaml for them into the work directory, based on the one next to
+this script, and runs the pipeline there:
+
+ * 'runner=scripts' runs align_reads and germline_variant_calling per
+   library and then genotype_joining, the way they are run by hand;
+ * 'runner=pipeline' runs run_pipeline, 'runner=queue' the local workers of
+   work_queue.
+
+With 'tools=real' bwa, Picard and GATK are used ('bwa', 'picard' and 'gatk'
+name the executable and the jars). With 'tools=stub' deterministic stand-ins
+in <work_dir>/bin/ produce outputs of the right format, and take a fixed
+start-up time plus a time proportional to their input, divided by their
+thread count. 'tools=auto' takes the real tools if all of them are found.
+
+Every process is measured for wall time, CPU time and peak memory, every
+stage from the trace. The results are appended to a JSONL file together with
+the commit of the code, and 'compare' checks the latest result against the
+previous one of another commit with the same parameters.
+
+ Usage::
+     $ python3 benchmark_pipeline_zhengu_20180103.py run [key=value ...]
+     $ python3 benchmark_pipeline_zhengu_20180103.py compare [key=value ...]
+
+ :param key=value: the keys of DEFAULT_PARAMS; a key with a dot sets an entry
+                   of the generated configuration, e.g. alignment.streaming=true
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import math
+import time
+import gzip
+import random
+import shutil
+import socket
+import subprocess
+import importlib.util
+import yaml
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PARAMS = {'work_dir': 'benchmark/', 'results': None, 'libraries': 2,
+                  'amplicons': 50, 'amplicon_length': 200, 'read_length': 100,
+                  'depth': 100, 'variant_rate': 0.3, 'error_rate': 0.002,
+                  'seed': 1, 'gz': False, 'tools': 'auto', 'runner': 'scripts',
+                  'workers': 2, 'repeats': 1, 'stub_overhead': 0.2, 'stub_speed': 20.0,
+                  'bwa': 'bwa', 'picard': None, 'gatk': None,
+                  'threshold': 0.1, 'min_seconds': 0.5, 'baseline': None}
+# the parameters which do not change what is measured
+RUN_ONLY_PARAMS = ['work_dir', 'results', 'repeats', 'threshold', 'min_seconds',
+                   'baseline']
+DATASET_PARAMS = ['libraries', 'amplicons', 'amplicon_length', 'read_length', 'depth',
+                  'variant_rate', 'error_rate', 'seed', 'gz']
+# relative cost of the stand-ins per MB of input, against the tool of weight 1
+STUB_WEIGHTS = {'index': 1.0, 'mem': 4.0, 'CreateSequenceDictionary': 0.1,
+                'SortSam': 1.0, 'BuildBamIndex': 0.2, 'MergeSamFiles': 0.5,
+                'BaseRecalibrator': 2.0, 'GatherBqsrReports': 0.1, 'PrintReads': 1.5,
+                'AnalyzeCovariates': 0.1, 'HaplotypeCaller': 3.0, 'CombineGVCFs': 0.5,
+                'GenotypeGVCFs': 1.0}
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+def parse_params(args):
+    """DEFAULT_PARAMS updated by the key=value arguments, and the overrides
+    of the configuration, {'section.key': value}."""
+    params = dict(DEFAULT_PARAMS)
+    overrides = {}
+    for arg in args:
+        if '=' not in arg:
+            raise ValueError('{0} is not a key=value argument'.format(arg))
+        key, value = arg.split('=', 1)
+        if '.' in key:
+            overrides[key] = yaml.safe_load(value)
+        elif key in params:
+            params[key] = yaml.safe_load(value)
+        else:
+            raise ValueError('unknown parameter {0}'.format(key))
+    params['work_dir'] = os.path.abspath(params['work_dir'])
+    if params['results'] is None:
+        params['results'] = os.path.join(params['work_dir'], 'results.jsonl')
+    return params, overrides
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def error_positions(rng, length, rate):
+    """The positions of sequencing errors in a read, drawn by geometric skips
+    instead of one draw per base."""
+    positions = []
+    if rate <= 0:
+        return positions
+    position = -1
+    while True:
+        position += 1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - rate))
+        if position >= length:
+            return positions
+        positions.append(position)
+
+def add_errors(rng, read, rate):
+    positions = error_positions(rng, len(read), rate)
+    if not positions:
+        return read
+    bases = list(read)
+    for position in positions:
+        bases[position] = rng.choice([x for x in 'ACGT' if x != bases[position]])
+    return ''.join(bases)
+
+def quality_profile(read_length):
+    """Base qualities falling towards the end of the read, as on Illumina."""
+    return ''.join('I' if i < 0.7 * read_length else 'F' if i < 0.9 * read_length
+                   else '?' for i in range(read_length))
+
+def generate_reference(params, ref_dir):
+    """Write the amplicon FASTA and the known sites, and return the amplicons
+    as [(contig, sequence, [(offset, ref, alt)])]."""
+    rng = random.Random('{0}-reference'.format(params['seed']))
+    length = params['amplicon_length']
+    amplicons = []
+    for i in range(params['amplicons']):
+        start = 1000001 + (i // 22) * 5000
+        contig = 'chr{0}_{1}_{2}'.format(i % 22 + 1, start, start + length - 1)
+        sequence = ''.join(rng.choice('ACGT') for _ in range(length))
+        variants = []
+        if rng.random() < params['variant_rate']:
+            offset = rng.randrange(10, length - 10)
+            alt = rng.choice([x for x in 'ACGT' if x != sequence[offset]])
+            variants.append((offset, sequence[offset], alt))
+        amplicons.append((contig, sequence, variants))
+    if not os.path.exists(ref_dir):
+        os.makedirs(ref_dir)
+    with open(os.path.join(ref_dir, 'amplicons.fa'), 'w') as fa:
+        for contig, sequence, _ in amplicons:
+            fa.write('>{0}\n'.format(contig))
+            for i in range(0, len(sequence), 60):
+                fa.write(sequence[i:i + 60] + '\n')
+    # every second planted SNP is known, BQSR masks those
+    with open(os.path.join(ref_dir, 'knownsites.vcf'), 'w') as vcf:
+        vcf.write('##fileformat=VCFv4.1\n')
+        for contig, sequence, _ in amplicons:
+            vcf.write('##contig=<ID={0},length={1}>\n'.format(contig, len(sequence)))
+        vcf.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        n_variants = 0
+        for contig, sequence, variants in amplicons:
+            for offset, ref, alt in variants:
+                if n_variants % 2 == 0:
+                    vcf.write('{0}\t{1}\trs{2}\t{3}\t{4}\t.\tPASS\t.\n'.format(
+                        contig, offset + 1, n_variants + 1, ref, alt))
+                n_variants += 1
+    return amplicons
+
+def library_entry(i):
+    return {'location': 'fastq/', 'library_id': 'BENCH_{0:03d}'.format(i),
+            'sample_name': 'SAMPLE-{0:03d}'.format(i), 'read1': '_L001_R1.fastq',
+            'read2': '_L001_R2.fastq'}
+
+def generate_library(params, amplicons, i, reads_dir):
+    """Write the FASTQ pair of library 'i'. Every read pair spans the whole
+    amplicon, read 1 from its start and read 2 from its end, and its name
+    holds the library ID, the amplicon and the pair number. The library's
+    genotype of every planted SNP is drawn from its own generator, so adding
+    libraries leaves the others unchanged."""
+    entry = library_entry(i)
+    rng = random.Random('{0}-library-{1}'.format(params['seed'], i))
+    read_length = params['read_length']
+    quality = quality_profile(read_length)
+    prefix = os.path.join(reads_dir, entry['location'],
+                          '{0}-{1}'.format(entry['library_id'], entry['sample_name']))
+    if not os.path.exists(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix))
+    extension = '.gz' if params['gz'] else ''
+    opener = gzip.open if params['gz'] else open
+    n_pairs = 0
+    with opener(prefix + entry['read1'] + extension, 'wt') as fastq1, \
+            opener(prefix + entry['read2'] + extension, 'wt') as fastq2:
+        for k, (contig, sequence, variants) in enumerate(amplicons):
+            genotypes = [rng.choice([0, 0, 0, 1, 1, 2]) for _ in variants]
+            rows1 = []
+            rows2 = []
+            for pair in range(params['depth']):
+                template = sequence
+                for (offset, ref, alt), genotype in zip(variants, genotypes):
+                    if rng.random() < genotype / 2.0:
+                        template = template[:offset] + alt + template[offset + 1:]
+                name = '@{0}:{1}:{2}'.format(entry['library_id'], k, pair)
+                read1 = add_errors(rng, template[:read_length], params['error_rate'])
+                read2 = add_errors(rng, reverse_complement(template[-read_length:]),
+                                   params['error_rate'])
+                rows1.append('{0} 1:N:0:1\n{1}\n+\n{2}\n'.format(name, read1, quality))
+                rows2.append('{0} 2:N:0:1\n{1}\n+\n{2}\n'.format(name, read2, quality))
+            fastq1.writelines(rows1)
+            fastq2.writelines(rows2)
+            n_pairs += len(rows1)
+    return n_pairs
+
+def generate_dataset(params):
+    """Generate the reference and the reads unless the work directory holds
+    a dataset of the same parameters."""
+    work_dir = params['work_dir']
+    dataset = {key: params[key] for key in DATASET_PARAMS}
+    dataset_file = os.path.join(work_dir, 'dataset.json')
+    if os.path.isfile(dataset_file):
+        with open(dataset_file) as f:
+            if json.load(f) == dataset:
+                return dataset
+        os.remove(dataset_file)
+    if params['read_length'] > params['amplicon_length']:
+        raise ValueError('the reads are longer than the amplicons')
+    for name in ['reference', 'reads']:
+        shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+    time_start = time.time()
+    amplicons = generate_reference(params, os.path.join(work_dir, 'reference'))
+    n_pairs = sum(generate_library(params, amplicons, i, os.path.join(work_dir, 'reads'))
+                  for i in range(1, params['libraries'] + 1))
+    print('Generated {0} amplicons and {1} read pairs in {2:.1f} s.'.format(
+        len(amplicons), n_pairs, time.time() - time_start))
+    with open(dataset_file, 'w') as f:
+        json.dump(dataset, f)
+    return dataset
+
+def find_real_tools(params):
+    """The paths of bwa and the Picard and GATK jars, or None if one is missing."""
+    bwa = shutil.which(params['bwa'])
+    jars = [params['picard'], params['gatk']]
+    if bwa is None or shutil.which('java') is None or \
+            not all(x is not None and os.path.isfile(x) for x in jars):
+        return None
+    return bwa, os.path.abspath(jars[0]), os.path.abspath(jars[1])
+
+def write_stubs(params, bin_dir):
+    """Write the stand-ins of bwa, java and the two jars into 'bin_dir'. The
+    jars only have to exist, the stand-in of java tells Picard from GATK by
+    the command line."""
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in ['bwa', 'java']:
+        stub_file = os.path.join(bin_dir, tool)
+        with open(stub_file, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" stub {2} {3} {4} "$@"\n'.format(
+                sys.executable, os.path.abspath(__file__), tool,
+                params['stub_overhead'], params['stub_speed']))
+        os.chmod(stub_file, 0o755)
+    for jar in ['picard.jar', 'GenomeAnalysisTK.jar']:
+        with open(os.path.join(bin_dir, jar), 'w') as f:
+            f.write('stub {0}\n'.format(__version__))
+    return (os.path.join(bin_dir, 'bwa'), os.path.join(bin_dir, 'picard.jar'),
+            os.path.join(bin_dir, 'GenomeAnalysisTK.jar'))
+
+def set_entry(config, key, value):
+    section = config
+    keys = key.split('.')
+    for name in keys[:-1]:
+        section = section.setdefault(name, {})
+    section[keys[-1]] = value
+
+def write_config(params, overrides, tools):
+    """Write configure.yaml of the benchmark into the work directory, from
+    the one of the package with all paths pointing into the work directory."""
+    work_dir = params['work_dir']
+    run_dir = os.path.join(work_dir, 'run')
+    with open(os.path.join(PACKAGE_DIR, 'configure.yaml')) as yamlfile:
+        config = yaml.safe_load(yamlfile)
+    bwa, picard, gatk = tools
+    extension = '.gz' if params['gz'] else ''
+    libraries = {}
+    for i in range(1, params['libraries'] + 1):
+        entry = library_entry(i)
+        entry['read1'] += extension
+        entry['read2'] += extension
+        libraries['library_{0:02d}'.format(i)] = entry
+    config['reference'] = {'fa_file': os.path.join(work_dir, 'reference', 'amplicons.fa'),
+                           'cache_dir': os.path.join(run_dir, 'reference') + '/'}
+    config['input_data'] = {'input_dir': os.path.join(work_dir, 'reads') + '/',
+                            'sample_sheet': None, 'plan_file': None,
+                            'libraries': libraries}
+    config['logging'] = os.path.join(run_dir, 'log') + '/'
+    config['alignment']['software'] = bwa
+    config['alignment']['ref_index'] = os.path.join(work_dir, 'reference', 'amplicons.fa')
+    config['sorting']['software'] = picard
+    config['snv_calling']['software'] = gatk
+    config['snv_calling']['knownsites'] = {
+        'synthetic': os.path.join(work_dir, 'reference', 'knownsites.vcf')}
+    config['genotype_joining']['output_name'] = 'benchmark_joint'
+    config.setdefault('scratch', {}).update({'enabled': False, 'scratch_dir':
+                                             os.path.join(run_dir, 'scratch') + '/'})
+    config.setdefault('cache', {}).update({'enabled': False, 'cache_dir':
+                                           os.path.join(run_dir, 'cache') + '/'})
+    config.setdefault('resources', {})['libraries'] = {}
+    config.setdefault('scheduler', {})['cores'] = os.cpu_count()
+    config.setdefault('queue', {})['database'] = os.path.join(run_dir, 'queue.sqlite')
+    config['trace'] = {'enabled': True, 'file': os.path.join(run_dir, 'log', 'trace.jsonl')}
+    # the coverage QC reads the BAMs with pysam
+    if importlib.util.find_spec('pysam') is None:
+        config.setdefault('coverage_qc', {})['enabled'] = False
+    for key, value in sorted(overrides.items()):
+        set_entry(config, key, value)
+    with open(os.path.join(work_dir, 'configure.yaml'), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config
+
+def clean_outputs(config, run_dir):
+    """Remove everything a previous run left, the reference index included."""
+    shutil.rmtree(run_dir, ignore_errors=True)
+    for key in ['alignment', 'snv_calling']:
+        shutil.rmtree(config['input_data']['input_dir'] + config[key]['output_dir'],
+                      ignore_errors=True)
+    os.makedirs(config['logging'])
+
+def run_process(name, args, work_dir, env, log_file):
+    """Run one script in the work directory and measure it. The resource
+    usage of the process includes the tools it waited for."""
+    with open(log_file, 'a') as log:
+        log.write('$ {0}\n'.format(' '.join(args)))
+        log.flush()
+        time_start = time.time()
+        process = subprocess.Popen(args, cwd=work_dir, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.time() - time_start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {'name': name, 'returncode': process.returncode, 'wall_time': wall_time,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime, 'max_rss_kb': rusage.ru_maxrss}
+
+def runner_commands(params, libraries):
+    """The processes of the runner, in order, as [(name, args)]."""
+    def script(name, *args):
+        return [sys.executable, os.path.join(PACKAGE_DIR, name)] + list(args)
+    if params['runner'] == 'pipeline':
+        return [('run_pipeline', script('run_pipeline_zhengu_20180103.py'))]
+    if params['runner'] == 'queue':
+        return [('work_queue', script('work_queue_zhengu_20180103.py', 'local',
+                                      str(params['workers'])))]
+    if params['runner'] != 'scripts':
+        raise ValueError('unknown runner {0}'.format(params['runner']))
+    commands = []
+    for library in libraries:
+        commands.append(('align_reads ' + library,
+                         script('align_reads_zhengu_20180103.py', library)))
+        commands.append(('germline_variant_calling ' + library,
+                         script('germline_variant_calling_GATK_zhengu_20180103.py',
+                                library)))
+    commands.append(('genotype_joining', script('genotype_joining_GATK_zhengu_20171211.py')))
+    return commands
+
+def stage_metrics(trace_file):
+    """Runs, wall time, CPU time and peak memory of every stage in the trace,
+    and the number of failed stage runs."""
+    # imported here, the stand-ins do not need it
+    import trace_zhengu_20180103
+    if not os.path.isfile(trace_file):
+        return {}, 0
+    records = [x for x in trace_zhengu_20180103.read_trace(trace_file)
+               if x['type'] == 'stage']
+    stages = {}
+    for stage, entry in trace_zhengu_20180103.summarize_by(records, 'stage').items():
+        stages[stage] = {'runs': int(entry['count']), 'wall_time': entry['duration'],
+                         'cpu_time': entry['cpu_time'],
+                         'max_rss_kb': int(entry['max_rss_kb'])}
+    return stages, sum(1 for x in records if x['returncode'])
+
+def run_once(params, config, tools_env):
+    run_dir = os.path.join(params['work_dir'], 'run')
+    clean_outputs(config, run_dir)
+    log_file = os.path.join(run_dir, 'benchmark.log')
+    processes = []
+    time_start = time.time()
+    for name, args in runner_commands(params, list(config['input_data']['libraries'])):
+        processes.append(run_process(name, args, params['work_dir'], tools_env, log_file))
+        print('{0:<40}{1:>8.1f} s'.format(name, processes[-1]['wall_time']))
+    wall_time = time.time() - time_start
+    stages, n_failed = stage_metrics(config['trace']['file'])
+    joint_vcf = config['input_data']['input_dir'] + config['snv_calling']['output_dir'] + \
+        config['genotype_joining']['output_name'] + '.vcf'
+    # the scripts do not all return their status, the joint VCF tells
+    ok = os.path.isfile(joint_vcf) and n_failed == 0 and \
+        not any(x['returncode'] for x in processes)
+    return {'ok': ok, 'failed_stages': n_failed, 'processes': processes, 'stages': stages,
+            'end_to_end': {'wall_time': wall_time,
+                           'cpu_time': sum(x['cpu_time'] for x in processes),
+                           'max_rss_kb': max(x['max_rss_kb'] for x in processes)}}
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def summarize_runs(runs):
+    """The median wall and CPU time and the largest peak memory over the runs,
+    end to end and per stage."""
+    def combine(entries):
+        return {'wall_time': median([x['wall_time'] for x in entries]),
+                'cpu_time': median([x['cpu_time'] for x in entries]),
+                'max_rss_kb': max(x['max_rss_kb'] for x in entries)}
+    stages = {}
+    for stage in runs[0]['stages']:
+        entries = [run['stages'][stage] for run in runs if stage in run['stages']]
+        stages[stage] = dict(combine(entries), runs=entries[0]['runs'])
+    return {'end_to_end': combine([run['end_to_end'] for run in runs]), 'stages': stages}
+
+def git_commit():
+    """The commit of the code, and whether the working tree differs from it."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PACKAGE_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=PACKAGE_DIR, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(dirty)
+
+def result_key(result):
+    """Results with the same key measured the same thing."""
+    params = {key: value for key, value in result['params'].items()
+              if key not in RUN_ONLY_PARAMS}
+    return json.dumps([params, result['overrides'], result['tools']], sort_keys=True)
+
+def print_result(summary):
+    print('{0:<28}{1:>7}{2:>12}{3:>10}{4:>12}'.format('Stage', 'Runs', 'Wall [s]',
+                                                      'CPU [s]', 'Peak [MB]'))
+    for stage, entry in summary['stages'].items():
+        print('{0:<28}{1:>7}{2:>12.1f}{3:>10.1f}{4:>12.1f}'.format(
+            stage, entry['runs'], entry['wall_time'], entry['cpu_time'],
+            entry['max_rss_kb'] / 1024))
+    entry = summary['end_to_end']
+    print('{0:<28}{1:>7}{2:>12.1f}{3:>10.1f}{4:>12.1f}'.format(
+        'end to end', '', entry['wall_time'], entry['cpu_time'], entry['max_rss_kb'] / 1024))
+
+def run_benchmark(params, overrides):
+    """Generate the data, run the pipeline 'repeats' times and append the
+    result to the results file. Returns the result."""
+    work_dir = params['work_dir']
+    generate_dataset(params)
+    tools = find_real_tools(params) if params['tools'] in ('real', 'auto') else None
+    if tools is None and params['tools'] == 'real':
+        raise ValueError('bwa, java or the Picard and GATK jars are missing')
+    tools_mode = 'real' if tools is not None else 'stub'
+    env = dict(os.environ)
+    if tools is None:
+        bin_dir = os.path.join(work_dir, 'bin')
+        tools = write_stubs(params, bin_dir)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    config = write_config(params, overrides, tools)
+    print('Running the {0} runner with the {1} tools in {2}.'.format(
+        params['runner'], tools_mode, work_dir))
+    runs = []
+    for i in range(params['repeats']):
+        runs.append(run_once(params, config, env))
+        if not runs[-1]['ok']:
+            print('The run failed! Check {0}.'.format(os.path.join(work_dir, 'run')))
+            break
+    commit, dirty = git_commit()
+    result = {'commit': commit, 'dirty': dirty,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(),
+              'cpus': os.cpu_count(), 'params': params, 'overrides': overrides,
+              'tools': tools_mode, 'ok': all(run['ok'] for run in runs), 'runs': runs,
+              'summary': summarize_runs(runs)}
+    print_result(result['summary'])
+    if not os.path.exists(os.path.dirname(params['results'])):
+        os.makedirs(os.path.dirname(params['results']))
+    with open(params['results'], 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    return result
+
+def read_results(results_file):
+    results = []
+    with open(results_file) as f:
+        for row in f:
+            if row.strip():
+                results.append(json.loads(row))
+    return results
+
+def compare_results(baseline, current, threshold=0.1, min_seconds=0.5):
+    """Print the change of every stage and of the whole run, and return the
+    names of those whose wall time grew by more than 'threshold' and by more
+    than 'min_seconds'."""
+    print('{0:<28}{1:>12}{2:>12}{3:>9}{4:>12}{5:>12}'.format(
+        'Stage', 'Before [s]', 'After [s]', 'Change', 'CPU [s]', 'Peak [MB]'))
+    before = dict(baseline['summary']['stages'], **{'end to end':
+                                                   baseline['summary']['end_to_end']})
+    after = dict(current['summary']['stages'], **{'end to end':
+                                                 current['summary']['end_to_end']})
+    regressions = []
+    for name, entry in after.items():
+        if name not in before:
+            print('{0:<28}{1:>12}{2:>12.1f}'.format(name, '-', entry['wall_time']))
+            continue
+        old = before[name]['wall_time']
+        change = (entry['wall_time'] - old) / old if old > 0 else 0.0
+        slower = change > threshold and entry['wall_time'] - old > min_seconds
+        if slower:
+            regressions.append(name)
+        print('{0:<28}{1:>12.1f}{2:>12.1f}{3:>8.1f}%{4:>12.1f}{5:>12.1f}{6}'.format(
+            name, old, entry['wall_time'], 100 * change, entry['cpu_time'],
+            entry['max_rss_kb'] / 1024, '  slower' if slower else ''))
+    return regressions
+
+def compare_latest(params):
+    """Compare the latest successful result with the latest earlier one of the
+    same parameters from another commit, or from the 'baseline' commit."""
+    if not os.path.isfile(params['results']):
+        print('No results in {0}.'.format(params['results']))
+        return 1
+    results = [x for x in read_results(params['results']) if x['ok']]
+    if not results:
+        print('No successful results in {0}.'.format(params['results']))
+        return 1
+    current = results[-1]
+    candidates = [x for x in results[:-1] if result_key(x) == result_key(current)]
+    if params['baseline'] is not None:
+        candidates = [x for x in candidates
+                      if (x['commit'] or '').startswith(str(params['baseline']))]
+    else:
+        candidates = [x for x in candidates if x['commit'] != current['commit']] or \
+            candidates
+    if not candidates:
+        print('No earlier result with the same parameters to compare with.')
+        return 1
+    baseline = candidates[-1]
+    print('Before: {0} {1}{2}'.format(baseline['time'], baseline['commit'],
+                                      ' (modified)' if baseline['dirty'] else ''))
+    print('After:  {0} {1}{2}'.format(current['time'], current['commit'],
+                                      ' (modified)' if current['dirty'] else ''))
+    regressions = compare_results(baseline, current, params['threshold'],
+                                  params['min_seconds'])
+    if regressions:
+        print('Slower by more than {0:.0f}%: {1}'.format(100 * params['threshold'],
+                                                         ', '.join(regressions)))
+        return 1
+    return 0
+
+# The stand-ins of the tools. They are run as
+# 'benchmark_pipeline_zhengu_20180103.py stub <tool> <overhead> <speed> args...'.
+
+def option_values(args, names):
+    """The values following any of the options 'names', and of NAME=value
+    arguments for names ending in '='."""
+    values = []
+    for i, arg in enumerate(args):
+        for name in names:
+            if name.endswith('=') and arg.startswith(name):
+                values.append(arg[len(name):])
+            elif arg == name and i + 1 < len(args):
+                values.append(args[i + 1])
+    return values
+
+def simulate_runtime(tool, input_bytes, n_threads, overhead, speed):
+    time.sleep(overhead + STUB_WEIGHTS.get(tool, 1.0) * input_bytes / 1e6 /
+               (speed * max(1, n_threads)))
+
+def read_fasta(fa_file):
+    contigs = []
+    with open(fa_file) as fa:
+        for row in fa:
+            if row.startswith('>'):
+                contigs.append([row[1:].split()[0], []])
+            elif contigs:
+                contigs[-1][1].append(row.strip())
+    return [(name, ''.join(rows)) for name, rows in contigs]
+
+def read_contig_lengths(fa_file):
+    """[(contig, length)] from the .fai of the FASTA, or from the FASTA."""
+    if os.path.isfile(fa_file + '.fai'):
+        with open(fa_file + '.fai') as fai:
+            return [(row.split('\t')[0], int(row.split('\t')[1])) for row in fai]
+    return [(name, len(sequence)) for name, sequence in read_fasta(fa_file)]
+
+def stub_bwa(args, overhead, speed):
+    if args[0] == 'index':
+        prefix = option_values(args, ['-p'])[0]
+        fa_file = args[-1]
+        contigs = read_fasta(fa_file)
+        simulate_runtime('index', os.path.getsize(fa_file), 1, overhead, speed)
+        with open(prefix + '.ann', 'w') as ann:
+            ann.write('{0} {1} 11\n'.format(sum(len(x) for _, x in contigs), len(contigs)))
+            offset = 0
+            for name, sequence in contigs:
+                ann.write('0 {0} (null)\n{1} {2} 0\n'.format(name, offset, len(sequence)))
+                offset += len(sequence)
+        for extension in ['.pac', '.amb', '.bwt', '.sa']:
+            with open(prefix + extension, 'w') as f:
+                f.write('stub\n')
+        return 0
+    if args[0] != 'mem':
+        print('[stub bwa] unknown command {0}'.format(args[0]), file=sys.stderr)
+        return 1
+    # the options with a value, all others are flags
+    with_value = ['-t', '-K', '-R', '-k', '-w', '-r', '-c', '-A', '-B', '-O', '-E', '-L',
+                  '-U', '-T', '-h', '-v']
+    positional = []
+    i = 1
+    while i < len(args):
+        if args[i] in with_value:
+            i += 2
+            continue
+        if not args[i].startswith('-'):
+            positional.append(args[i])
+        i += 1
+    prefix, fastq1, fastq2 = positional[:3]
+    n_threads = int((option_values(args, ['-t']) or ['1'])[0])
+    read_group = (option_values(args, ['-R']) or [''])[0].strip('\'').replace('\\t', '\t')
+    contigs = []
+    with open(prefix + '.ann') as ann:
+        rows = ann.readlines()[1:]
+    for name_row, length_row in zip(rows[0::2], rows[1::2]):
+        contigs.append((name_row.split()[1], int(length_row.split()[1])))
+    out = sys.stdout
+    out.write('@HD\tVN:1.5\tSO:unsorted\n')
+    for name, length in contigs:
+        out.write('@SQ\tSN:{0}\tLN:{1}\n'.format(name, length))
+    tag = ''
+    if read_group:
+        out.write(read_group + '\n')
+        tag = '\tRG:Z:' + read_group.split('ID:')[1].split('\t')[0]
+    out.write('@PG\tID:bwa\tPN:bwa\tVN:stub\n')
+    n_bytes = 0
+    # both files are read in step, as they may be pipes filled alternately
+    with open(fastq1) as f1, open(fastq2) as f2:
+        while True:
+            record1 = [f1.readline() for _ in range(4)]
+            record2 = [f2.readline() for _ in range(4)]
+            if not record1[0] or not record2[0]:
+                break
+            n_bytes += sum(len(x) for x in record1 + record2)
+            name = record1[0][1:].split()[0]
+            contig, length = contigs[int(name.split(':')[1])]
+            seq1, qual1 = record1[1].strip(), record1[3].strip()
+            seq2, qual2 = reverse_complement(record2[1].strip()), record2[3].strip()[::-1]
+            pos2 = length - len(seq2) + 1
+            out.write('{0}\t99\t{1}\t1\t60\t{2}M\t=\t{3}\t{4}\t{5}\t{6}{7}\n'.format(
+                name, contig, len(seq1), pos2, length, seq1, qual1, tag))
+            out.write('{0}\t147\t{1}\t{2}\t60\t{3}M\t=\t1\t{4}\t{5}\t{6}{7}\n'.format(
+                name, contig, pos2, len(seq2), -length, seq2, qual2, tag))
+    simulate_runtime('mem', n_bytes, n_threads, overhead, speed)
+    return 0
+
+def write_sorted_bam(input_file, output_bam):
+    """Sort a SAM or BAM into a BAM with pysam, or copy it without pysam."""
+    try:
+        import pysam
+    except ImportError:
+        shutil.copyfile(input_file, output_bam)
+        return
+    pysam.sort('-o', output_bam, '-O', 'BAM', input_file)
+
+def write_merged_bam(input_files, output_bam):
+    """Merge BAMs with pysam, or concatenate the SAM copies without pysam,
+    keeping the header of the first one."""
+    try:
+        import pysam
+    except ImportError:
+        with open(output_bam, 'w') as out:
+            for i, input_file in enumerate(input_files):
+                with open(input_file) as f:
+                    for line in f:
+                        if i == 0 or not line.startswith('@'):
+                            out.write(line)
+        return
+    pysam.merge('-f', output_bam, *input_files)
+
+def write_bam_index(bam_file, bai_file):
+    try:
+        import pysam
+    except ImportError:
+        # not a BAM without pysam, the index is only a marker then
+        with open(bai_file, 'w') as f:
+            f.write('stub\n')
+        return
+    pysam.index(bam_file, bai_file)
+
+def write_vcf(out_vcf, fa_file, samples, gvcf=False, contig_names=None):
+    """Write a VCF with no variants, or a GVCF with one reference block per
+    contig, and the index GATK writes next to it."""
+    contigs = read_fasta(fa_file)
+    if contig_names is not None:
+        contigs = [x for x in contigs if x[0] in contig_names]
+    with open(out_vcf, 'w') as vcf:
+        vcf.write('##fileformat=VCFv4.2\n')
+        if gvcf:
+            vcf.write('##ALT=<ID=NON_REF,Description="Any other allele">\n'
+                      '##INFO=<ID=END,Number=1,Type=Integer,Description="End">\n')
+        vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        for name, sequence in read_fasta(fa_file):
+            vcf.write('##contig=<ID={0},length={1}>\n'.format(name, len(sequence)))
+        vcf.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                             'INFO', 'FORMAT'] + samples) + '\n')
+        if gvcf:
+            for name, sequence in contigs:
+                vcf.write('{0}\t1\t.\t{1}\t<NON_REF>\t.\t.\tEND={2}\tGT{3}\n'.format(
+                    name, sequence[0], len(sequence), '\t0/0' * len(samples)))
+    with open(out_vcf + '.idx', 'w') as idx:
+        idx.write('stub\n')
+
+def vcf_samples(vcf_files):
+    samples = []
+    for vcf_file in vcf_files:
+        with open(vcf_file) as vcf:
+            for row in vcf:
+                if row.startswith('#CHROM'):
+                    samples += [x for x in row.rstrip('\n').split('\t')[9:]
+                                if x not in samples]
+                    break
+    return samples
+
+def variant_files(args):
+    """The VCF files of the --variant arguments, a .list holding one per line."""
+    vcf_files = []
+    for value in option_values(args, ['--variant', '-V']):
+        if value.endswith('.list'):
+            with open(value) as f:
+                vcf_files += [x.strip() for x in f if x.strip()]
+        else:
+            vcf_files.append(value)
+    return vcf_files
+
+def stub_java(args, overhead, speed):
+    if '-cp' in args:
+        tool = args[args.index('-cp') + 2].split('.')[-1]
+        tool_args = args[args.index('-cp') + 3:]
+    elif '-jar' in args:
+        tool_args = args[args.index('-jar') + 2:]
+        tool = tool_args[0] if tool_args and not tool_args[0].startswith('-') \
+            else (option_values(tool_args, ['-T']) or [''])[0]
+    else:
+        print('[stub java] no -jar or -cp', file=sys.stderr)
+        return 1
+    inputs = option_values(tool_args, ['INPUT=', 'I=', '-I', 'R=', '-BQSR', '-before',
+                                       '-after']) + variant_files(tool_args)
+    n_threads = int((option_values(tool_args, ['-nct', '-nt']) or ['1'])[0])
+    outputs = option_values(tool_args, ['OUTPUT=', 'O=', '-o', '-plots'])
+    fa_file = (option_values(tool_args, ['-R', 'R=']) or [None])[0]
+    stdin_file = None
+    if 'INPUT=/dev/stdin' in tool_args:
+        # the streaming sorter, its input is the pipe from BWA-MEM
+        stdin_file = outputs[0] + '.stdin.sam'
+        with open(stdin_file, 'wb') as f:
+            shutil.copyfileobj(sys.stdin.buffer, f)
+        inputs = [stdin_file]
+    simulate_runtime(tool, sum(os.path.getsize(x) for x in inputs if os.path.isfile(x)),
+                     n_threads, overhead, speed)
+    if tool == 'CreateSequenceDictionary':
+        with open(outputs[0], 'w') as f:
+            f.write('@HD\tVN:1.5\n')
+            for name, length in read_contig_lengths(fa_file):
+                f.write('@SQ\tSN:{0}\tLN:{1}\n'.format(name, length))
+    elif tool in ('SortSam', 'MergeSamFiles'):
+        if tool == 'SortSam':
+            write_sorted_bam(inputs[0], outputs[0])
+        else:
+            write_merged_bam(inputs, outputs[0])
+        if 'CREATE_INDEX=true' in tool_args:
+            write_bam_index(outputs[0], os.path.splitext(outputs[0])[0] + '.bai')
+    elif tool == 'BuildBamIndex':
+        write_bam_index(inputs[0], os.path.splitext(inputs[0])[0] + '.bai')
+    elif tool in ('BaseRecalibrator', 'GatherBqsrReports'):
+        with open(outputs[0], 'w') as f:
+            f.write('#:GATKReport.v1.1:5\n')
+            f.write('#:GATKTable:stub:{0}\n'.format(
+                ','.join(os.path.basename(x) for x in inputs)))
+    elif tool == 'AnalyzeCovariates':
+        with open(outputs[0], 'w') as f:
+            f.write('%PDF-1.4\n%%EOF\n')
+    elif tool == 'PrintReads':
+        bam = option_values(tool_args, ['-I'])[0]
+        shutil.copyfile(bam, outputs[0])
+        if os.path.isfile(os.path.splitext(bam)[0] + '.bai'):
+            shutil.copyfile(os.path.splitext(bam)[0] + '.bai',
+                            os.path.splitext(outputs[0])[0] + '.bai')
+    elif tool == 'HaplotypeCaller':
+        bam = option_values(tool_args, ['-I'])[0]
+        sample = os.path.basename(bam).split('_recal.bam')[0]
+        intervals = option_values(tool_args, ['-L'])
+        contig_names = None
+        if intervals:
+            with open(intervals[0]) as f:
+                contig_names = set(x.strip() for x in f)
+        write_vcf(outputs[0], fa_file, [sample], True, contig_names)
+    elif tool in ('CombineGVCFs', 'GenotypeGVCFs'):
+        write_vcf(outputs[0], fa_file, vcf_samples(variant_files(tool_args)),
+                  tool == 'CombineGVCFs')
+    elif tool == 'ValidateVariants':
+        # GATK 3 leaves the index of every VCF it reads
+        for vcf_file in variant_files(tool_args):
+            with open(vcf_file + '.idx', 'w') as idx:
+                idx.write('stub\n')
+    else:
+        print('[stub java] unknown tool {0}'.format(tool), file=sys.stderr)
+        return 1
+    if stdin_file is not None:
+        os.remove(stdin_file)
+    return 0
+
+def main():
+    if len(sys.argv) > 4 and sys.argv[1] == 'stub':
+        stub = {'bwa': stub_bwa, 'java': stub_java}[sys.argv[2]]
+        return stub(sys.argv[5:], float(sys.argv[3]), float(sys.argv[4]))
+    if len(sys.argv) < 2 or sys.argv[1] not in ('run', 'compare'):
+        print(__doc__)
+        return 1
+    try:
+        params, overrides = parse_params(sys.argv[2:])
+        if sys.argv[1] == 'compare':
+            return compare_latest(params)
+        result = run_benchmark(params, overrides)
+    except ValueError as error:
+        print('ERROR:: {0}'.format(error))
+        return 1
+    return 0 if result['ok'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
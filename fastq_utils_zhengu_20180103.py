@@ -0,0 +1,360 @@
+#!/user/bin/env python3
+
+"""Read, check and split pairs of FASTQ files, plain or compressed with gzip
+or BGZF.
+
+Compressed files are decompressed by a multi-threaded external tool (bgzip
+for BGZF, pigz for plain gzip, gzip as the last resort) and streamed into
+BWA-MEM through named pipes, so no decompressed copy is written to disk. In
+the same pass the read count, the pairing of the mate names and the length
+and per-cycle quality histograms of both mates are collected.
+
+For parallel alignment the pair can be split into synchronised chunks.
+BWA-MEM reads the pairs in batches of at least 'batch_bases' bases (its -K
+option) and estimates the insert size distribution per batch. The files are
+therefore cut on exactly these batch boundaries, and the batches are dealt
+out to the chunks in turn. Aligning each chunk with the same -K then gives
+the same records as aligning the whole pair at once. The files are streamed,
+only one batch is held in memory.
+
+ Usage::
+     $ python3 fastq_utils_zhengu_20180103.py stats <read1> <read2> <out.tsv> [threads]
+     $ python3 fastq_utils_zhengu_20180103.py split <read1> <read2> <out_prefix> <n_chunks> [batch_bases]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import queue
+import shutil
+import tempfile
+import threading
+import itertools
+import subprocess
+import contextlib
+import numpy as np
+
+BATCH_BASES = 10000000
+FEED_BATCH_BASES = 1 << 20
+FEED_QUEUE_BATCHES = 4
+READ_BUFFER_BYTES = 1 << 20
+MAX_QUALITY = 64
+MAX_EXAMPLES = 5
+
+def is_bgzf(fastq):
+    """BGZF blocks are gzip members with a 'BC' extra subfield."""
+    with open(fastq, 'rb') as f:
+        header = f.read(14)
+    return len(header) == 14 and header[:2] == b'\x1f\x8b' and \
+        header[3] & 4 and header[12:14] == b'BC'
+
+def decompress_command(fastq, n_threads=1):
+    if not fastq.endswith('.gz'):
+        return None
+    if is_bgzf(fastq) and shutil.which('bgzip'):
+        return ['bgzip', '-dc', '-@', str(n_threads), fastq]
+    if shutil.which('pigz'):
+        return ['pigz', '-dc', '-p', str(n_threads), fastq]
+    return ['gzip', '-dc', fastq]
+
+@contextlib.contextmanager
+def open_fastq(fastq, n_threads=1):
+    """Open a FASTQ file for binary reading, through a decompressor process
+    if it is compressed. A failing decompressor raises OSError on exit."""
+    command = decompress_command(fastq, n_threads)
+    if command is None:
+        with open(fastq, 'rb', buffering=READ_BUFFER_BYTES) as f:
+            yield f
+        return
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, bufsize=READ_BUFFER_BYTES)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode(errors='replace').strip()
+        process.stderr.close()
+        returncode = process.wait()
+    # a consumer stopping early makes the decompressor exit on SIGPIPE
+    if returncode not in (0, -13):
+        raise OSError('{0} failed on {1}: {2}'.format(command[0], fastq, stderr))
+
+def read_name(header):
+    """The read name without the '@', the comment and a /1 or /2 suffix."""
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b''
+    if name.endswith(b'/1') or name.endswith(b'/2'):
+        name = name[:-2]
+    return name
+
+def read_fastq_records(fastq):
+    while True:
+        record = list(itertools.islice(fastq, 4))
+        if not record:
+            return
+        if len(record) < 4 or not record[0].startswith(b'@') or \
+                not record[3].endswith(b'\n'):
+            raise ValueError('Truncated or malformed FASTQ record: {0}'.format(
+                record[0].rstrip().decode(errors='replace')))
+        yield record
+
+def read_fastq_batches(fastq1, fastq2, batch_bases=BATCH_BASES, check_names=True):
+    """Yield the pairs in the batches BWA-MEM -K would read them in, as lists
+    of (record1, record2). Mates out of order raise ValueError unless
+    'check_names' is off, e.g. because ReadStats counts them instead."""
+    batch = []
+    n_bases = 0
+    for record1, record2 in itertools.zip_longest(read_fastq_records(fastq1),
+                                                  read_fastq_records(fastq2)):
+        if record1 is None or record2 is None:
+            raise ValueError('The read files hold different numbers of records.')
+        if check_names and read_name(record1[0]) != read_name(record2[0]):
+            raise ValueError('The mates {0} and {1} are out of order.'.format(
+                record1[0].rstrip().decode(errors='replace'),
+                record2[0].rstrip().decode(errors='replace')))
+        batch.append((record1, record2))
+        n_bases += len(record1[1]) + len(record2[1]) - 2
+        if n_bases >= batch_bases:
+            yield batch
+            batch = []
+            n_bases = 0
+    if batch:
+        yield batch
+
+class ReadStats(object):
+    """Read count, mate pairing, and length and per-cycle quality histograms
+    of a read pair, accumulated batch by batch."""
+    def __init__(self):
+        self.n_pairs = 0
+        self.name_mismatches = 0
+        self.examples = []
+        self.problems = []
+        self.lengths = [np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)]
+        self.qualities = [np.zeros((1, MAX_QUALITY), dtype=np.int64),
+                          np.zeros((1, MAX_QUALITY), dtype=np.int64)]
+
+    def add_batch(self, batch):
+        self.n_pairs += len(batch)
+        for record1, record2 in batch:
+            if read_name(record1[0]) != read_name(record2[0]):
+                self.name_mismatches += 1
+                if len(self.examples) < MAX_EXAMPLES:
+                    self.examples.append((record1[0].rstrip().decode(errors='replace'),
+                                          record2[0].rstrip().decode(errors='replace')))
+        for mate in (0, 1):
+            qualities = [pair[mate][3].rstrip(b'\n') for pair in batch]
+            lengths = np.fromiter((len(x) for x in qualities), dtype=np.int64,
+                                  count=len(qualities))
+            self.lengths[mate] = add_padded(self.lengths[mate], np.bincount(lengths))
+            scores = np.frombuffer(b''.join(qualities), dtype=np.uint8).astype(np.int64)
+            scores = np.clip(scores - 33, 0, MAX_QUALITY - 1)
+            # the cycle of every base is its offset from the start of its read
+            cycles = np.arange(len(scores)) - np.repeat(np.cumsum(lengths) - lengths,
+                                                        lengths)
+            histogram = np.bincount(cycles * MAX_QUALITY + scores,
+                                    minlength=MAX_QUALITY)
+            histogram = np.pad(histogram, (0, -len(histogram) % MAX_QUALITY))
+            self.qualities[mate] = add_padded(self.qualities[mate],
+                                              histogram.reshape(-1, MAX_QUALITY))
+
+    def check(self):
+        """Return the problems which make the pair unfit for alignment."""
+        problems = list(self.problems)
+        if self.n_pairs == 0 and not problems:
+            problems.append('The read files hold no reads.')
+        if self.name_mismatches:
+            problems.append('{0} of {1} pairs have different mate names, e.g. '
+                            '{2}.'.format(self.name_mismatches, self.n_pairs,
+                                          ' / '.join(self.examples[0])))
+        return problems
+
+    def write_report(self, out_file):
+        with open(out_file, 'w') as out:
+            out.write('#pairs\t{0}\n'.format(self.n_pairs))
+            out.write('#name_mismatches\t{0}\n'.format(self.name_mismatches))
+            for problem in self.check():
+                out.write('#problem\t{0}\n'.format(problem))
+            for mate in (0, 1):
+                lengths = self.lengths[mate]
+                n_reads = lengths.sum()
+                out.write('#R{0}_mean_length\t{1:.2f}\n'.format(
+                    mate + 1, (lengths * np.arange(len(lengths))).sum() / n_reads
+                    if n_reads else 0))
+            out.write('cycle\tR1_mean_quality\tR2_mean_quality\tR1_q30_fraction\t'
+                      'R2_q30_fraction\n')
+            n_cycles = max(len(x) for x in self.qualities)
+            scores = np.arange(MAX_QUALITY)
+            for cycle in range(n_cycles):
+                fields = []
+                for mate in (0, 1):
+                    row = self.qualities[mate][cycle] if cycle < len(self.qualities[mate]) \
+                        else np.zeros(MAX_QUALITY, dtype=np.int64)
+                    total = row.sum()
+                    fields.append((row * scores).sum() / total if total else 0)
+                    fields.append(row[30:].sum() / total if total else 0)
+                out.write('{0}\t{1:.2f}\t{3:.2f}\t{2:.4f}\t{4:.4f}\n'.format(
+                    cycle + 1, *fields))
+            out.write('length\tR1_reads\tR2_reads\n')
+            for length in range(max(len(x) for x in self.lengths)):
+                counts = [x[length] if length < len(x) else 0 for x in self.lengths]
+                if any(counts):
+                    out.write('{0}\t{1}\t{2}\n'.format(length, *counts))
+        return out_file
+
+def add_padded(total, values):
+    """Add two arrays which may differ in their first dimension."""
+    if len(values) > len(total):
+        total, values = values.copy(), total
+    total[:len(values)] += values
+    return total
+
+def collect_read_stats(read1, read2, n_threads=1):
+    """Read statistics of a pair in one pass, without aligning it."""
+    stats = ReadStats()
+    try:
+        with open_fastq(read1, n_threads) as fastq1, open_fastq(read2, n_threads) as fastq2:
+            for batch in read_fastq_batches(fastq1, fastq2, FEED_BATCH_BASES,
+                                            check_names=False):
+                stats.add_batch(batch)
+    except (OSError, ValueError) as error:
+        stats.problems.append(str(error))
+    return stats
+
+class FastqPairFeeder(object):
+    """Decompress and check a read pair, and write the mates into two named
+    pipes which BWA-MEM reads as its input files. Each pipe has its own
+    writer thread, so a reader alternating between the pipes never
+    deadlocks the feeder."""
+    def __init__(self, read1, read2, work_dir, n_threads=1):
+        self.read1 = read1
+        self.read2 = read2
+        self.n_threads = n_threads
+        self.fifo_dir = tempfile.mkdtemp(prefix='fastq_fifo_', dir=work_dir)
+        self.fifos = [os.path.join(self.fifo_dir, 'R1.fastq'),
+                      os.path.join(self.fifo_dir, 'R2.fastq')]
+        self.stopped = threading.Event()
+        for fifo in self.fifos:
+            os.mkfifo(fifo)
+        self.stats = ReadStats()
+        self.queues = [queue.Queue(maxsize=FEED_QUEUE_BATCHES),
+                       queue.Queue(maxsize=FEED_QUEUE_BATCHES)]
+        self.threads = [threading.Thread(target=self.read)] + [
+            threading.Thread(target=self.write, args=(fifo, batches))
+            for fifo, batches in zip(self.fifos, self.queues)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def read(self):
+        try:
+            with open_fastq(self.read1, self.n_threads) as fastq1, \
+                    open_fastq(self.read2, self.n_threads) as fastq2:
+                for batch in read_fastq_batches(fastq1, fastq2, FEED_BATCH_BASES,
+                                                check_names=False):
+                    if self.stopped.is_set():
+                        break
+                    self.stats.add_batch(batch)
+                    for mate, batches in enumerate(self.queues):
+                        batches.put(b''.join(b''.join(pair[mate]) for pair in batch))
+        except (OSError, ValueError) as error:
+            self.stats.problems.append(str(error))
+        finally:
+            for batches in self.queues:
+                batches.put(None)
+
+    def write(self, fifo, batches):
+        try:
+            with open(fifo, 'wb') as out:
+                for data in iter(batches.get, None):
+                    out.write(data)
+        except BrokenPipeError:
+            # the aligner stopped reading, its own exit code tells why
+            if not self.stopped.is_set():
+                self.stats.problems.append('The aligner stopped reading {0} before '
+                                           'its end.'.format(os.path.basename(fifo)))
+            self.stopped.set()
+            for _ in iter(batches.get, None):
+                pass
+
+    def close(self):
+        """Wait for the feeder and remove the pipes. Writers still waiting
+        for a reader, e.g. because the aligner failed to start, are released
+        by opening and closing the read end."""
+        while any(thread.is_alive() for thread in self.threads):
+            for fifo, thread in zip(self.fifos, self.threads[1:]):
+                if thread.is_alive():
+                    try:
+                        os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+            self.threads[0].join(0.1)
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+        return self.stats
+
+@contextlib.contextmanager
+def feed_read_pair(read1, read2, work_dir, enabled=True, n_threads=1):
+    """Yield the files the aligner should read and the ReadStats filled while
+    it reads them; the stats are complete once the block is left. Disabled
+    for plain files, the read files themselves are yielded with no stats."""
+    if not enabled and not read1.endswith('.gz') and not read2.endswith('.gz'):
+        yield read1, read2, None
+        return
+    feeder = FastqPairFeeder(read1, read2, work_dir, n_threads)
+    try:
+        yield feeder.fifos[0], feeder.fifos[1], feeder.stats
+    finally:
+        feeder.close()
+
+def chunk_file_names(out_prefix, n_chunks):
+    return [('{0}.chunk_{1}_R1.fastq'.format(out_prefix, i),
+             '{0}.chunk_{1}_R2.fastq'.format(out_prefix, i)) for i in range(n_chunks)]
+
+def split_fastq_pair(read1, read2, out_prefix, n_chunks, batch_bases=BATCH_BASES,
+                     stats=None, n_threads=1):
+    """Deal the batches of the pair round-robin into 'n_chunks' chunk pairs.
+    Returns the chunk file names which received reads. With 'stats', the
+    ReadStats are collected in the same pass and mismatched mate names are
+    counted there instead of raising ValueError."""
+    chunk_files = chunk_file_names(out_prefix, n_chunks)
+    outs = [(open(chunk1, 'wb'), open(chunk2, 'wb')) for chunk1, chunk2 in chunk_files]
+    n_batches = 0
+    try:
+        with open_fastq(read1, n_threads) as fastq1, open_fastq(read2, n_threads) as fastq2:
+            for n_batches, batch in enumerate(read_fastq_batches(
+                    fastq1, fastq2, batch_bases, check_names=stats is None), 1):
+                if stats is not None:
+                    stats.add_batch(batch)
+                out1, out2 = outs[(n_batches - 1) % n_chunks]
+                for record1, record2 in batch:
+                    out1.writelines(record1)
+                    out2.writelines(record2)
+    finally:
+        for out1, out2 in outs:
+            out1.close()
+            out2.close()
+    # a short library may not fill all chunks
+    for chunk1, chunk2 in chunk_files[n_batches:]:
+        os.remove(chunk1)
+        os.remove(chunk2)
+    return chunk_files[:min(n_batches, n_chunks)]
+
+def main():
+    if len(sys.argv) >= 5 and sys.argv[1] == 'stats':
+        stats = collect_read_stats(sys.argv[2], sys.argv[3],
+                                   int(sys.argv[5]) if len(sys.argv) > 5 else 1)
+        stats.write_report(sys.argv[4])
+        for problem in stats.check():
+            print(problem)
+        return 1 if stats.check() else 0
+    if len(sys.argv) < 6 or sys.argv[1] != 'split':
+        print(__doc__)
+        return 1
+    batch_bases = int(sys.argv[6]) if len(sys.argv) > 6 else BATCH_BASES
+    chunk_files = split_fastq_pair(sys.argv[2], sys.argv[3], sys.argv[4],
+                                   int(sys.argv[5]), batch_bases)
+    for chunk1, chunk2 in chunk_files:
+        print('{0}\t{1}'.format(chunk1, chunk2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
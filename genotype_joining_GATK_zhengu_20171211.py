@@ -2,16 +2,41 @@
 
 """Combine all per-sample GCVFs to produce a set of joint-called SNPs and indels 
 ready for filtering. The GATK tool GenotypeGCVFs is applied here.
+
+In the incremental mode ('genotype_joining.incremental'), the per-sample GVCFs
+are first merged by CombineGVCFs into a tree of intermediate GVCFs with at
+most 'fan_in' inputs per node. The samples keep the order in which they were
+added to configure.yaml, so a new batch only touches the last branch of each
+level, and every other node is reused from a previous run. GenotypeGVCFs then
+runs on the few GVCFs at the top of the tree.
+
+With 'genotype_joining.shards' above 1, or 'auto' for as many shards as the
+cores and memory of the scheduler budget hold, GenotypeGVCFs is scattered over
+balanced sets of amplicon contigs and the shard VCFs are gathered into
+<output_name>.vcf in reference order.
 """
 __author__ = 'Maggie Ruimin Sun'
 __version__ = '0.1'
 
-import subprocess
 import os
 import logging
 import time
-import shlex
-import yaml
+import sys
+import shutil
+import hashlib
+import tempfile
+
+import germline_variant_calling_GATK_zhengu_20180103
+import intervals_zhengu_20180103
+import lift_over_zhengu_20180103
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import resources_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import stage_cache_zhengu_20180103
+import shell_command_zhengu_20180103
+import trace_zhengu_20180103
+from shell_command_zhengu_20180103 import run_shell_command
 
 def setup_logger(name, log_file, formatter, level=logging.DEBUG):
     handler = logging.FileHandler(log_file)
@@ -36,33 +61,32 @@ def store_logs(log_dir):
     
     return (logger_gatk_process, logger_gatk_errors)
 
-def run_shell_command(command_line, logger_process, logger_errors):
-    command_line_args = shlex.split(command_line)
-    logger_process.info(command_line)
-    command_line_process = subprocess.run(command_line_args, 
-                                            stdout=subprocess.PIPE, 
-                                            stderr=subprocess.STDOUT)
-    if command_line_process.stdout is not None:
-        for stdout_line in command_line_process.stdout.splitlines():
-            logger_process.info(stdout_line)
-    if command_line_process.stderr is not None:
-        for stderr_line in command_line_process.stderr.splitlines():
-            logger_errors.error(stderr_line)
-    return command_line_process.returncode
-
+def write_variant_list(gvcf_list, list_file):
+    """GATK reads the inputs of a '--variant' argument ending in .list from 
+    the file, one per line, which keeps the command line short."""
+    with open(list_file, 'w') as f:
+        f.writelines(gvcf + '\n' for gvcf in gvcf_list)
+    return list_file
 
 def gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, thres_call, 
-                 logger_gatk_process, logger_gatk_errors):
+                 logger_gatk_process, logger_gatk_errors, intervals=None, out_vcf=None, 
+                 profile=None):
     if not os.path.exists(variants_dir):
         logger_gatk_errors.error('The directory %s does not exist!', variants_dir)
         print('ERROR:: The directory %s does not exist! Please check the correctness of '
              'input. Make sure the GVCF files are contained in the directory.')
         return 1
     
-    command_joint = ('java -jar {0} -T GenotypeGVCFs -R {1} -stand_call_conf {2} --variant ' 
-                     + ' --variant '.join(gvcf_per_sample for gvcf_per_sample in gvcf_list)
-                     + ' -o {3}').format(gatk_dir, ref_seq, thres_call, 
-                                        variants_dir+out_name+'.vcf')
+    if out_vcf is None:
+        out_vcf = variants_dir + out_name + '.vcf'
+    variant_list = write_variant_list(gvcf_list, out_vcf[:-len('.vcf')] + '.gvcfs.list')
+    command_joint = ('{0} -T GenotypeGVCFs -R {1} -stand_call_conf {2} '
+                     '--variant {3} -o {4}{5}').format(
+        resources_zhengu_20180103.java_command(gatk_dir, profile), ref_seq, thres_call, 
+        variant_list, out_vcf, resources_zhengu_20180103.gatk_options('GenotypeGVCFs', 
+                                                                      profile))
+    if intervals is not None:
+        command_joint += ' -L {0}'.format(intervals)
     returncode_joint = run_shell_command(command_joint, logger_gatk_process, logger_gatk_errors)
     
     if not returncode_joint == 0:
@@ -72,24 +96,248 @@ def gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, thres_cal
     
     return 0
 
-def main():
-    with open('configure.yaml') as yamlfile:
-        config = yaml.load(yamlfile)
-    yamlfile.close()
+def joint_shards(config):
+    """Number of GenotypeGVCFs shards, 'auto' meaning as many JVMs of the join 
+    profile as fit the cores and memory of the scheduler budget."""
+    n_shards = config['genotype_joining'].get('shards', 1)
+    if n_shards == 'auto':
+        profile = resources_zhengu_20180103.stage_profile(config, 'join')
+        scheduler = config.get('scheduler', {})
+        n_shards = min(scheduler.get('cores', os.cpu_count()) // profile['threads'], 
+                       scheduler.get('memory_gb', 16) // 
+                       resources_zhengu_20180103.jvm_memory_gb(config, profile))
+    return max(1, int(n_shards))
+
+def gather_gvcfs_sharded(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, 
+                         thres_call, n_shards, logger_gatk_process, logger_gatk_errors, 
+                         profile=None, n_parallel=None):
+    """Genotype balanced sets of amplicon contigs across all GVCFs, at most 
+    'n_parallel' at once, and gather the shard VCFs into <out_name>.vcf."""
+    if not os.path.exists(variants_dir):
+        logger_gatk_errors.error('The directory %s does not exist!', variants_dir)
+        return 1
+    out_prefix = variants_dir + out_name
+    weighted_contigs = intervals_zhengu_20180103.contig_weights(ref_seq)
+    shards = intervals_zhengu_20180103.partition_intervals(weighted_contigs, n_shards)
+    interval_files = intervals_zhengu_20180103.write_interval_lists(shards, out_prefix)
+    shard_vcfs = [interval_file[:-len('.intervals')] + '.vcf' 
+                  for interval_file in interval_files]
+    logger_gatk_process.info('Genotyping %d GVCFs in %d shards.', len(gvcf_list), 
+                             len(shards))
+    
+    returncodes = shell_command_zhengu_20180103.map_in_context(
+        lambda shard: gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, 
+                                   thres_call, logger_gatk_process, logger_gatk_errors, 
+                                   intervals=shard[0], out_vcf=shard[1], 
+                                   profile=profile),
+        zip(interval_files, shard_vcfs), n_parallel or len(shards))
+    if any(returncodes):
+        logger_gatk_errors.error('GenotypeGVCFs failed in %d of %d shards.', 
+                                 sum(1 for x in returncodes if x), len(shards))
+        print('GVCFs joining returns non-zero value.')
+        return 1
+    
+    n_records = intervals_zhengu_20180103.gather_vcfs(
+        shard_vcfs, out_prefix + '.vcf', [name for name, _ in weighted_contigs])
+    logger_gatk_process.info('Gathered %d joint-called records into %s.', n_records, 
+                             out_prefix + '.vcf')
+    for shard_file in (interval_files + shard_vcfs + [x + '.idx' for x in shard_vcfs] +
+                       [x[:-len('.vcf')] + '.gvcfs.list' for x in shard_vcfs]):
+        if os.path.isfile(shard_file):
+            os.remove(shard_file)
+    return germline_variant_calling_GATK_zhengu_20180103.index_vcf(
+        gatk_dir, ref_seq, out_prefix + '.vcf', logger_gatk_process, logger_gatk_errors, 
+        profile)
+
+def validate_sharded_join(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, 
+                          thres_call, logger_gatk_process, logger_gatk_errors, 
+                          profile=None):
+    """Genotype the cohort once more in a single process and check that the 
+    sharded <out_name>.vcf holds the same records in the same order. The 
+    single-process VCF is written to a temporary directory and removed."""
+    tmp_dir = tempfile.mkdtemp(prefix=out_name + '.validate.', dir=variants_dir)
+    try:
+        single_vcf = os.path.join(tmp_dir, out_name + '.single.vcf')
+        returncode = gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, 
+                                  thres_call, logger_gatk_process, logger_gatk_errors, 
+                                  out_vcf=single_vcf, profile=profile)
+        if returncode:
+            return returncode
+        mismatches = intervals_zhengu_20180103.validate_sharded_vcf(
+            single_vcf, variants_dir + out_name + '.vcf')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    for i, row_single, row_sharded in mismatches:
+        logger_gatk_errors.error('Record %d differs, single process: %s, sharded: %s', 
+                                 i, str(row_single).rstrip(), str(row_sharded).rstrip())
+    if mismatches:
+        print('The sharded joint calls differ from the single-process ones.')
+        return 1
+    logger_gatk_process.info('The sharded joint calls match the single-process ones.')
+    return 0
+
+def combine_gvcfs(gatk_dir, ref_seq, gvcf_list, out_gvcf, logger_gatk_process, 
+                  logger_gatk_errors, profile=None):
+    variant_list = write_variant_list(gvcf_list, out_gvcf[:-len('.g.vcf')] + '.list')
+    command_combine = ('{0} -T CombineGVCFs -R {1} --variant {2} '
+                       '-o {3}').format(resources_zhengu_20180103.java_command(
+                           gatk_dir, profile), ref_seq, variant_list, out_gvcf)
+    returncode_combine = run_shell_command(command_combine, logger_gatk_process, 
+                                           logger_gatk_errors)
+    if not returncode_combine == 0:
+        logger_gatk_errors.error('CombineGVCFs returns non-zero value for %s.', out_gvcf)
+        print('CombineGVCFs returns non-zero value.')
+        return 1
+    return 0
+
+def build_combine_tree(gvcf_list, fan_in, combined_dir, out_name):
+    """Group the GVCFs into consecutive runs of 'fan_in', level by level, until 
+    at most 'fan_in' remain. Returns the levels as [(node_gvcf, children)] and 
+    the GVCFs at the top. A node is named after the hash of its children, so 
+    an unchanged branch keeps its name, and its file, from one run to the next."""
+    fan_in = max(2, fan_in)
+    levels = []
+    nodes = list(gvcf_list)
+    while len(nodes) > fan_in:
+        level = []
+        for i in range(0, len(nodes), fan_in):
+            children = nodes[i:i+fan_in]
+            if len(children) == 1:
+                # nothing to combine in a trailing single child
+                level.append((children[0], None))
+                continue
+            digest = hashlib.sha1('\n'.join(children).encode()).hexdigest()[:16]
+            level.append(('{0}{1}.L{2}.{3}.g.vcf'.format(combined_dir, out_name, 
+                                                         len(levels) + 1, digest), 
+                          children))
+        levels.append(level)
+        nodes = [node for node, _ in level]
+    return levels, nodes
+
+def is_up_to_date(out_file, inputs):
+    if not os.path.isfile(out_file):
+        return False
+    mtime = os.path.getmtime(out_file)
+    return all(os.path.isfile(x) and os.path.getmtime(x) <= mtime for x in inputs)
+
+def remove_stale_nodes(combined_dir, out_name, levels):
+    current = set(node for level in levels for node, children in level if children)
+    for file_name in os.listdir(combined_dir):
+        path = combined_dir + file_name
+        if file_name.startswith(out_name + '.L') and file_name.endswith('.g.vcf') and \
+                path not in current:
+            for stale in [path, path + '.idx', path[:-len('.g.vcf')] + '.list']:
+                if os.path.isfile(stale):
+                    os.remove(stale)
+
+def combine_incrementally(config, gvcf_list, variants_dir, out_name, 
+                          logger_gatk_process, logger_gatk_errors):
+    """Bring the CombineGVCFs tree over 'gvcf_list' up to date and return 
+    (returncode, top-level GVCFs)."""
+    gatk_dir = config['snv_calling']['software']
+    ref_seq = config['reference']['fa_file']
+    fan_in = config['genotype_joining'].get('fan_in', 8)
+    profile = resources_zhengu_20180103.stage_profile(config, 'combine')
+    combined_dir = variants_dir + 'combined/'
+    if not os.path.exists(combined_dir):
+        os.makedirs(combined_dir)
+    levels, top_nodes = build_combine_tree(gvcf_list, fan_in, combined_dir, out_name)
+    n_combined = n_reused = 0
+    for level in levels:
+        for node_gvcf, children in level:
+            if children is None:
+                continue
+            if is_up_to_date(node_gvcf, children):
+                n_reused += 1
+                continue
+            node_name = os.path.basename(node_gvcf)[:-len('.g.vcf')]
+            returncode = stage_cache_zhengu_20180103.run_stage(
+                config, 'combine', node_name, 
+                lambda: combine_gvcfs(gatk_dir, ref_seq, children, node_gvcf, 
+                                      logger_gatk_process, logger_gatk_errors, profile),
+                inputs=children + [ref_seq], outputs=[node_gvcf, node_gvcf + '.idx'], 
+                tools=[gatk_dir], command=['combine_gvcfs', profile], 
+                logger_process=logger_gatk_process)
+            if returncode:
+                return returncode, []
+            n_combined += 1
+    remove_stale_nodes(combined_dir, out_name, levels)
+    logger_gatk_process.info('Combined %d and reused %d intermediate GVCFs over %d '
+                             'samples in %d levels.', n_combined, n_reused, 
+                             len(gvcf_list), len(levels))
+    return 0, top_nodes
+
+def join_libraries(config, libraries, logger_gatk_process, logger_gatk_errors):
     gatk_dir = config['snv_calling']['software']
     ref_seq = config['reference']['fa_file']
-    variants_dir = config['input_data']['input_dir'] + config['snv_calling']['output_dir']
-    log_dir = config['logging']
     out_name = config['genotype_joining']['output_name']
     thres_call = config['snv_calling']['threshold']
-    sample_list = []
-    for library in config['input_data']['libraries']:
-        sample_list.append(config['input_data']['libraries'][library]['sample_name'])
-    gvcf_list = [variants_dir + x + '.g.vcf' for x in sample_list]
+    profile = resources_zhengu_20180103.stage_profile(config, 'join')
+    gvcf_list = [plan_zhengu_20180103.library_plan(config, library)['files']['published_gvcf'] 
+                 for library in libraries]
+    cohort = plan_zhengu_20180103.cohort_plan(config, libraries)
+    stage = cohort['stages']['join']
+    variants_dir = cohort['variants_dir']
+    
+    joint_vcf = stage['outputs'][0]
+    with shell_command_zhengu_20180103.command_context(config, 'join', out_name):
+        if config['genotype_joining'].get('incremental', False):
+            returncode, gvcf_list = combine_incrementally(
+                config, gvcf_list, variants_dir, out_name, logger_gatk_process, 
+                logger_gatk_errors)
+            if returncode:
+                return returncode
+        n_shards = joint_shards(config)
+        n_parallel, shard_profile = resources_zhengu_20180103.shard_resources(
+            config, profile, n_shards)
+        if n_shards > 1:
+            def gather():
+                returncode = gather_gvcfs_sharded(gatk_dir, ref_seq, gvcf_list, 
+                                                  variants_dir, out_name, thres_call, 
+                                                  n_shards, logger_gatk_process, 
+                                                  logger_gatk_errors, shard_profile, 
+                                                  n_parallel)
+                # only a join which ran is checked, not a cache hit
+                if returncode == 0 and \
+                        config['genotype_joining'].get('validate_shards', False):
+                    returncode = validate_sharded_join(gatk_dir, ref_seq, gvcf_list, 
+                                                       variants_dir, out_name, thres_call, 
+                                                       logger_gatk_process, 
+                                                       logger_gatk_errors, profile)
+                return returncode
+        else:
+            gather = lambda: gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, 
+                                          out_name, thres_call, logger_gatk_process, 
+                                          logger_gatk_errors, profile=shard_profile)
+        returncode = stage_cache_zhengu_20180103.run_stage(
+            config, 'join', out_name, gather, 
+            inputs=gvcf_list + [ref_seq], outputs=stage['outputs'], 
+            tools=[gatk_dir], command=['gather_gvcfs', thres_call, n_shards, profile], 
+            logger_process=logger_gatk_process)
+    if returncode == 0 and config['snv_calling'].get('lift_over', False):
+        lift_over_zhengu_20180103.lift_over_vcf_file(
+            ref_seq, joint_vcf, variants_dir + out_name + '.genomic.vcf', 
+            config['snv_calling'].get('genome_fai'), logger_gatk_errors)
+        logger_gatk_process.info('Lifted %s over to genomic coordinates.', joint_vcf)
+    return returncode
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    log_dir = config['logging']
     
     logger_gatk_process, logger_gatk_errors = store_logs(log_dir)
-    returncode = gather_gvcfs(gatk_dir, ref_seq, gvcf_list, variants_dir, out_name, thres_call,
-                              logger_gatk_process, logger_gatk_errors)
+    trace_zhengu_20180103.configure_trace(config)
+    reference = reference_zhengu_20180103.prepare_reference(config, logger_gatk_process, 
+                                                            logger_gatk_errors)
+    if reference is None:
+        return 1
+    reference_zhengu_20180103.apply_reference(config, reference)
+    plan_zhengu_20180103.load_plan(config, logger_gatk_process)
+    returncode = join_libraries(config, config['input_data']['libraries'], 
+                                logger_gatk_process, logger_gatk_errors)
+    return 1 if returncode else 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
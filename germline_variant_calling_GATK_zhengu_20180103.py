@@ -8,6 +8,11 @@ Three Stages are included in this script:
  1 Sorting the alignment SAM file using Picard. 
  2 Recalibrate base quality scores using GATK BaseRecalibrator. 
  3 Discovery variants using GATK HaplotypeCaller.
+
+The per-amplicon coverage QC of the sorted BAM (coverage_qc_zhengu_20180103)
+runs when 'coverage_qc.enabled' is set; with the deferred QC of the 'lean'
+BQSR mode it runs next to stages 2 and 3 if the reserved cores and memory
+hold both, and after them otherwise.
  
  Usage::
      $ python3 germline_variant_calling_GATK_zhengu_20171211.py [params]
@@ -25,13 +30,22 @@ Three Stages are included in this script:
 __author__ = 'Maggie Ruimin Sun'
 __version__ = '0.1'
 
-import subprocess
 import os
 import logging
 import time
 import sys
-import shlex
-import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+import intervals_zhengu_20180103
+import lift_over_zhengu_20180103
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import resources_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import stage_cache_zhengu_20180103
+import shell_command_zhengu_20180103
+import trace_zhengu_20180103
+from shell_command_zhengu_20180103 import run_shell_command
 
 def setup_logger(name, log_file, formatter, level=logging.DEBUG):
     handler = logging.FileHandler(log_file)
@@ -66,22 +80,8 @@ def store_logs(log_dir):
     return (logger_picard_process, logger_picard_errors, 
             logger_gatk_process, logger_gatk_errors)
 
-def run_shell_command(command_line, logger_process, logger_errors):
-    command_line_args = shlex.split(command_line)
-    logger_process.info(command_line)
-    command_line_process = subprocess.run(command_line_args,
-                                            stdout=subprocess.PIPE, 
-                                            stderr=subprocess.STDOUT)
-    if command_line_process.stdout is not None:
-        for stdout_line in command_line_process.stdout.splitlines():
-            logger_process.info(stdout_line)
-    if command_line_process.stderr is not None:
-        for stderr_line in command_line_process.stderr.splitlines():
-            logger_errors.error(stderr_line)
-    return command_line_process.returncode
-
 def sort_sam_picard(picard_dir, input_sam, output_bam, 
-                    logger_picard_process, logger_picard_errors):
+                    logger_picard_process, logger_picard_errors, profile=None):
     out_dir = os.path.dirname(output_bam)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
@@ -91,10 +91,10 @@ def sort_sam_picard(picard_dir, input_sam, output_bam,
         print('%s does not exists!', input_sam)
         return 1
     
-    command_sort = 'java -jar {0} SortSam INPUT={1} OUTPUT={2} SORT_ORDER=coordinate'.format(
-        picard_dir, input_sam, output_bam)
-    command_index = 'java -jar {0} BuildBamIndex INPUT={1}'.format(
-        picard_dir, output_bam)
+    java = resources_zhengu_20180103.java_command(picard_dir, profile)
+    command_sort = '{0} SortSam INPUT={1} OUTPUT={2} SORT_ORDER=coordinate{3}'.format(
+        java, input_sam, output_bam, resources_zhengu_20180103.picard_options(profile))
+    command_index = '{0} BuildBamIndex INPUT={1}'.format(java, output_bam)
     
     #logger_picard_process.info(command_sort)
     returncode_sort = run_shell_command(command_sort, logger_picard_process, 
@@ -118,15 +118,73 @@ def sort_sam_picard(picard_dir, input_sam, output_bam,
     
     return 0
 
+def analyze_covariation(gatk_dir, ref_fa_file, sorted_bam, knownsites, output_table, 
+                        logger_gatk_process, logger_gatk_errors, bqsr_table=None, 
+                        intervals=None, profile=None):
+    command_covariation_analysis = '{0} -T BaseRecalibrator \
+    -R {1} -I {2}'.format(resources_zhengu_20180103.java_command(gatk_dir, profile), 
+                          ref_fa_file, sorted_bam)
+    for knownsite in knownsites:
+        command_covariation_analysis += (' -knownSites ' + knownsite)
+    if bqsr_table is not None:
+        command_covariation_analysis += (' -BQSR ' + bqsr_table)
+    if intervals is not None:
+        command_covariation_analysis += (' -L ' + intervals)
+    command_covariation_analysis += resources_zhengu_20180103.gatk_options(
+        'BaseRecalibrator', profile)
+    command_covariation_analysis += (' -o ' + output_table)
+    return run_shell_command(command_covariation_analysis, logger_gatk_process, 
+                             logger_gatk_errors)
+
+def analyze_covariation_sharded(gatk_dir, ref_fa_file, sorted_bam, knownsites, 
+                                output_table, n_shards, logger_gatk_process, 
+                                logger_gatk_errors, bqsr_table=None, profile=None, 
+                                n_parallel=None):
+    """Run BaseRecalibrator per interval shard, at most 'n_parallel' at once, 
+    and merge the shard tables with GatherBqsrReports."""
+    if n_shards <= 1:
+        return analyze_covariation(gatk_dir, ref_fa_file, sorted_bam, knownsites, 
+                                   output_table, logger_gatk_process, logger_gatk_errors, 
+                                   bqsr_table, profile=profile)
+    weighted_contigs = intervals_zhengu_20180103.contig_weights(
+        ref_fa_file, 'depth', sorted_bam[:-4] + '.bai')
+    shards = intervals_zhengu_20180103.partition_intervals(weighted_contigs, n_shards)
+    interval_files = intervals_zhengu_20180103.write_interval_lists(
+        shards, output_table[:-len('.table')])
+    shard_tables = [interval_file[:-len('.intervals')] + '.table' 
+                    for interval_file in interval_files]
+    returncodes = shell_command_zhengu_20180103.map_in_context(
+        lambda shard: analyze_covariation(gatk_dir, ref_fa_file, sorted_bam, knownsites, 
+                                          shard[1], logger_gatk_process, 
+                                          logger_gatk_errors, bqsr_table, shard[0], 
+                                          profile),
+        zip(interval_files, shard_tables), n_parallel or len(shards))
+    returncode = 1 if any(returncodes) else 0
+    if returncode == 0:
+        command_gather = '{0} {1} O={2}'.format(
+            resources_zhengu_20180103.java_command(
+                gatk_dir, profile, 'org.broadinstitute.gatk.tools.GatherBqsrReports'), 
+            ' '.join('I=' + x for x in shard_tables), output_table)
+        returncode = run_shell_command(command_gather, logger_gatk_process, 
+                                       logger_gatk_errors)
+    for shard_file in interval_files + shard_tables:
+        if os.path.isfile(shard_file):
+            os.remove(shard_file)
+    return returncode
+
 def recalibrate_base_quality_scores(gatk_dir, ref_fa_file, sorted_bam, 
                                     knownsites, align_dir, logger_gatk_process,
-                                    logger_gatk_errors):
+                                    logger_gatk_errors, mode='full', n_shards=1, 
+                                    profile=None, n_parallel=None):
     
-    """kownsites is a list-type argument, containing a set of known variant vcf files"""
+    """kownsites is a list-type argument, containing a set of known variant vcf files.
+    In 'lean' mode only the recalibration table and the recalibrated BAM are 
+    produced; the QC passes are left to recalibration_qc."""
     
     if not os.path.exists(align_dir):
         os.makedirs(align_dir)
     prefix_name = sorted_bam.split('_aligned')[0]
+    sorted_bam_name = sorted_bam
     sorted_bam = align_dir + sorted_bam
     if not os.path.isfile(sorted_bam):
         logger_gatk_errors.error('%s does not exists!', sorted_bam)
@@ -134,59 +192,70 @@ def recalibrate_base_quality_scores(gatk_dir, ref_fa_file, sorted_bam,
         return 1
         
     # Step 1: analyze patterns of covariation in the sequence dataset
-    command_covariation_analysis = 'java -jar {0} -T BaseRecalibrator \
-    -R {1} -I {2}'.format(gatk_dir, ref_fa_file, sorted_bam)
-    for knownsite in knownsites:
-        command_covariation_analysis += (' -knownSites ' + knownsite)
     output_recal_table = align_dir + prefix_name + '_recal.table'
-    command_covariation_analysis += (' -o ' + output_recal_table)
-    returncode_covariation_analysis = run_shell_command(command_covariation_analysis, 
-                                                        logger_gatk_process, 
-                                                        logger_gatk_errors)
+    returncode_covariation_analysis = analyze_covariation_sharded(
+        gatk_dir, ref_fa_file, sorted_bam, knownsites, output_recal_table, n_shards, 
+        logger_gatk_process, logger_gatk_errors, profile=profile, n_parallel=n_parallel)
     if not returncode_covariation_analysis == 0:
         logger_gatk_errors.error('BQSR failed at covariation analysis stage.')
         print('BQSR failed at covariation analysis stage.')
         return 1
     
+    if mode == 'full':
+        # Step 2 & 3: second pass and before/after plots
+        returncode_qc = recalibration_qc(gatk_dir, ref_fa_file, sorted_bam_name, knownsites, 
+                                         align_dir, logger_gatk_process, logger_gatk_errors, 
+                                         n_shards, profile, n_parallel)
+        if not returncode_qc == 0:
+            return 1
+    
+    # Step 4: Apply the recalibration to the sorted alignment data
+    command_recalibrate = '{0} -T PrintReads -R {1} -I {2} -BQSR {3} -o {4}{5}'.format(
+    resources_zhengu_20180103.java_command(gatk_dir, profile), ref_fa_file, sorted_bam, 
+    output_recal_table, align_dir + prefix_name + '_recal.bam', 
+    resources_zhengu_20180103.gatk_options('PrintReads', profile))
+    returncode_recalibrate = run_shell_command(command_recalibrate, logger_gatk_process, 
+                                               logger_gatk_errors)
+    if not returncode_recalibrate == 0:
+        logger_gatk_errors.error('BQSR failed at the final application stage.')
+        print('BQSR failed at the final application stage.')
+        return 1
+    return 0
+
+def recalibration_qc(gatk_dir, ref_fa_file, sorted_bam, knownsites, align_dir, 
+                     logger_gatk_process, logger_gatk_errors, n_shards=1, profile=None, 
+                     n_parallel=None):
+    """Analyze the covariation remaining after recalibration and plot it. Only 
+    needs the table of the first BaseRecalibrator pass."""
+    prefix_name = sorted_bam.split('_aligned')[0]
+    sorted_bam = align_dir + sorted_bam
+    output_recal_table = align_dir + prefix_name + '_recal.table'
+    
     # Step 2: do a second pass to analyze covariation remaining after recalibration
-    command_covariation_analysis2 = 'java -jar {0} -T BaseRecalibrator -R {1} \
-    -I {2}'.format(gatk_dir, ref_fa_file, sorted_bam)
-    for knownsite in knownsites:
-        command_covariation_analysis2 += (' -knownSites ' + knownsite)
     output_post_recal_table = align_dir + prefix_name + '_recal_post.table'
-    command_covariation_analysis2 += ' -BQSR {0} -o {1}'.format(output_recal_table, 
-                                                                output_post_recal_table)
-    returncode_covariation_analysis2 = run_shell_command(command_covariation_analysis2, 
-                                                         logger_gatk_process,
-                                                         logger_gatk_errors)
+    returncode_covariation_analysis2 = analyze_covariation_sharded(
+        gatk_dir, ref_fa_file, sorted_bam, knownsites, output_post_recal_table, n_shards, 
+        logger_gatk_process, logger_gatk_errors, bqsr_table=output_recal_table, 
+        profile=profile, n_parallel=n_parallel)
     if not returncode_covariation_analysis2 == 0:
         logger_gatk_errors.error('BQSR failed at the second pass for covariation analysis.')
         print('BQSR failed at the second pass for covariation analysis.')
         return 1
     
     # Step 3: Generate before/after plots
-    command_plot = 'java -jar {0} -T AnalyzeCovariates -R {1} -before {2} -after {3} \
-    -plots {4}'.format(gatk_dir, ref_fa_file, output_recal_table, output_post_recal_table, 
+    command_plot = '{0} -T AnalyzeCovariates -R {1} -before {2} -after {3} \
+    -plots {4}'.format(resources_zhengu_20180103.java_command(gatk_dir, profile), ref_fa_file, output_recal_table, output_post_recal_table, 
                       align_dir + prefix_name + '_recal_plots.pdf')
     returncode_plot = run_shell_command(command_plot, logger_gatk_process, logger_gatk_errors)
     if not returncode_plot == 0:
         logger_gatk_errors.error('BQSR failed at the ploting stage.')
         print('BQSR failed at the ploting stage.')
         return 1
-    
-    # Step 4: Apply the recalibration to the sorted alignment data
-    command_recalibrate = 'java -jar {0} -T PrintReads -R {1} -I {2} -BQSR {3} -o {4}'.format(
-    gatk_dir, ref_fa_file, sorted_bam, output_recal_table, align_dir + prefix_name + '_recal.bam')
-    returncode_recalibrate = run_shell_command(command_recalibrate, logger_gatk_process, 
-                                               logger_gatk_errors)
-    if not returncode_recalibrate == 0:
-        logger_gatk_errors.error('BQSR failed at the final application stage.')
-        print('BQSR failed at the final application stage.')
-        return 1
     return 0
 
 def call_variants(gatk_dir, ref_fa_file, recal_bam, threshold_call, out_dir, 
-                  logger_gatk_process, logger_gatk_errors):
+                  logger_gatk_process, logger_gatk_errors, intervals=None, 
+                  out_gvcf=None, profile=None):
     
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
@@ -195,11 +264,16 @@ def call_variants(gatk_dir, ref_fa_file, recal_bam, threshold_call, out_dir,
         print('%s does not exists!', recal_bam)
         return 1
     samp_name = recal_bam.split('/')[-1].split('_recal.bam')[0]
+    if out_gvcf is None:
+        out_gvcf = out_dir + samp_name + '_raw_variants.g.vcf'
     
-    command_call_var = 'java -jar {0} -T HaplotypeCaller -R {1} -I {2} --genotyping_mode DISCOVERY \
-    -stand_call_conf {3} --emitRefConfidence GVCF -o {4}'.format(
-        gatk_dir, ref_fa_file, recal_bam, threshold_call, 
-        out_dir + samp_name + '_raw_variants.g.vcf')
+    command_call_var = '{0} -T HaplotypeCaller -R {1} -I {2} --genotyping_mode DISCOVERY \
+    -stand_call_conf {3} --emitRefConfidence GVCF -o {4}{5}'.format(
+        resources_zhengu_20180103.java_command(gatk_dir, profile), ref_fa_file, recal_bam, 
+        threshold_call, out_gvcf, 
+        resources_zhengu_20180103.gatk_options('HaplotypeCaller', profile))
+    if intervals is not None:
+        command_call_var += ' -L ' + intervals
     returncode_call_variants = run_shell_command(command_call_var, logger_gatk_process, 
                                                  logger_gatk_errors)
     if not returncode_call_variants == 0:
@@ -209,44 +283,305 @@ def call_variants(gatk_dir, ref_fa_file, recal_bam, threshold_call, out_dir,
 
     return 0
 
-def main():
-    with open('configure.yaml') as yamlfile:
-        config = yaml.load(yamlfile)
-    yamlfile.close()
+def index_vcf(gatk_dir, ref_fa_file, vcf_file, logger_gatk_process, logger_gatk_errors, 
+              profile=None):
+    """Write the Tribble index <vcf_file>.idx of a VCF gathered outside GATK. 
+    GATK 3 has no IndexFeatureFile, but indexes every VCF it reads and keeps the 
+    index next to it, so the file is read once by ValidateVariants with all 
+    strict checks off."""
+    if os.path.isfile(vcf_file + '.idx'):
+        # an index of an earlier run would not match the gathered file
+        os.remove(vcf_file + '.idx')
+    command_index = ('{0} -T ValidateVariants -R {1} -V {2} '
+                     '--validationTypeToExclude ALL').format(
+        resources_zhengu_20180103.java_command(gatk_dir, profile), ref_fa_file, vcf_file)
+    returncode_index = run_shell_command(command_index, logger_gatk_process, 
+                                         logger_gatk_errors)
+    if not returncode_index == 0 or not os.path.isfile(vcf_file + '.idx'):
+        logger_gatk_errors.error('Indexing %s failed.', vcf_file)
+        return 1
+    return 0
+
+def call_variants_sharded(gatk_dir, ref_fa_file, recal_bam, threshold_call, out_dir, 
+                          n_shards, shard_weight, logger_gatk_process, logger_gatk_errors, 
+                          profile=None, n_parallel=None):
+    """Scatter HaplotypeCaller over balanced sets of amplicon contigs and gather 
+    the shard GVCFs into <sample>_raw_variants.g.vcf in reference order. At most 
+    'n_parallel' shards run at once, all of them by default."""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    samp_name = recal_bam.split('/')[-1].split('_recal.bam')[0]
+    out_prefix = out_dir + samp_name + '_raw_variants'
+    weighted_contigs = intervals_zhengu_20180103.contig_weights(
+        ref_fa_file, shard_weight, recal_bam[:-4] + '.bai')
+    shards = intervals_zhengu_20180103.partition_intervals(weighted_contigs, n_shards)
+    interval_files = intervals_zhengu_20180103.write_interval_lists(shards, out_prefix)
+    shard_gvcfs = [interval_file[:-len('.intervals')] + '.g.vcf' 
+                   for interval_file in interval_files]
+    logger_gatk_process.info('Calling variants of %s in %d shards.', samp_name, 
+                             len(shards))
+    
+    # each worker only waits on its own HaplotypeCaller process
+    returncodes = shell_command_zhengu_20180103.map_in_context(
+        lambda shard: call_variants(gatk_dir, ref_fa_file, recal_bam, threshold_call, 
+                                    out_dir, logger_gatk_process, logger_gatk_errors, 
+                                    intervals=shard[0], out_gvcf=shard[1], 
+                                    profile=profile),
+        zip(interval_files, shard_gvcfs), n_parallel or len(shards))
+    if any(returncodes):
+        logger_gatk_errors.error('HaplotypeCaller failed in %d of %d shards.', 
+                                 sum(1 for x in returncodes if x), len(shards))
+        print('HaplotypeCaller failed.')
+        return 1
+    
+    n_records = intervals_zhengu_20180103.gather_vcfs(
+        shard_gvcfs, out_prefix + '.g.vcf', 
+        [name for name, _ in weighted_contigs])
+    logger_gatk_process.info('Gathered %d GVCF records of %s.', n_records, samp_name)
+    for shard_file in interval_files + shard_gvcfs + [x + '.idx' for x in shard_gvcfs]:
+        if os.path.isfile(shard_file):
+            os.remove(shard_file)
+    return index_vcf(gatk_dir, ref_fa_file, out_prefix + '.g.vcf', logger_gatk_process, 
+                     logger_gatk_errors, profile)
+
+def sort_library(config, library, logger_picard_process, logger_picard_errors):
     picard_dir = config['sorting']['software']
+    profile = resources_zhengu_20180103.stage_profile(config, 'sort', library)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['sort']
+    input_sam = entry['files']['aligned_sam']
+    sorted_bam = entry['files']['sorted_bam']
+    if config['alignment'].get('streaming', False) or \
+            config['alignment'].get('chunks', 1) > 1:
+        # the streaming and chunked aligners already wrote the sorted and 
+        # indexed BAM
+        if not os.path.isfile(sorted_bam):
+            logger_picard_errors.error('%s does not exists!', sorted_bam)
+            print('%s does not exists!', sorted_bam)
+            return 1
+        return 0
+    with shell_command_zhengu_20180103.command_context(config, 'sort', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'sort', library, 
+            lambda: sort_sam_picard(picard_dir, input_sam, sorted_bam, 
+                                    logger_picard_process, logger_picard_errors, profile),
+            inputs=stage['inputs'], outputs=stage['outputs'], tools=[picard_dir], 
+            command=['sort_sam_picard', profile], intermediate=True, 
+            logger_process=logger_picard_process)
+
+def coverage_qc_library(config, library, logger_picard_process, logger_picard_errors):
+    """Per-amplicon coverage QC of the sorted BAM, written to 
+    <sample>_coverage_qc.tsv next to it."""
+    qc_config = config.get('coverage_qc', {})
+    if not qc_config.get('enabled', False):
+        return 0
+    # pysam is only needed when the coverage QC is enabled
+    import coverage_qc_zhengu_20180103
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['coverage_qc']
+    sample_name = entry['sample_name']
+    sorted_bam = entry['files']['sorted_bam']
+    report = entry['files']['coverage_qc']
+    params = [qc_config.get('min_mapq', 20), qc_config.get('min_depth', 100), 
+              qc_config.get('min_uniformity', 0.8)]
+    def run_qc():
+        try:
+            summary, stats = coverage_qc_zhengu_20180103.coverage_qc(
+                sorted_bam, *params, n_processes=qc_config.get('processes', 1))
+        except (OSError, ValueError) as error:
+            logger_picard_errors.error('Coverage QC of %s failed: %s', sorted_bam, error)
+            print('Coverage QC failed.')
+            return 1
+        coverage_qc_zhengu_20180103.write_coverage_report(summary, stats, report)
+        logger_picard_process.info('Coverage QC of %s: on-target rate %.3f, mean depth '
+                                   '%.1f, %d of %d amplicons failed.', sample_name, 
+                                   summary['on_target_rate'], summary['mean_depth'], 
+                                   summary['failed_amplicons'], summary['amplicons'])
+        return 0
+    with shell_command_zhengu_20180103.command_context(config, 'coverage_qc', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'coverage_qc', library, run_qc, 
+            inputs=stage['inputs'], outputs=stage['outputs'], 
+            command=['coverage_qc'] + params, logger_process=logger_picard_process)
+
+def recalibrate_library(config, library, logger_gatk_process, logger_gatk_errors):
+    gatk_dir = config['snv_calling']['software']
+    ref_seq = config['reference']['fa_file']
+    knownsites = []
+    for db in config['snv_calling']['knownsites']:
+        knownsites.append(config['snv_calling']['knownsites'][db])
+    mode = config['snv_calling'].get('bqsr_mode', 'full')
+    n_shards = config['snv_calling'].get('bqsr_shards', 1)
+    profile = resources_zhengu_20180103.stage_profile(config, 'bqsr', library)
+    n_parallel, shard_profile = resources_zhengu_20180103.shard_resources(config, profile, 
+                                                                        n_shards)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['bqsr']
+    align_dir = entry['work_dir']
+    sorted_bam = os.path.basename(entry['files']['sorted_bam'])
+    with shell_command_zhengu_20180103.command_context(config, 'bqsr', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'bqsr', library, 
+            lambda: recalibrate_base_quality_scores(gatk_dir, ref_seq, sorted_bam, 
+                                                    knownsites, align_dir, 
+                                                    logger_gatk_process, logger_gatk_errors,
+                                                    mode, n_shards, shard_profile, 
+                                                    n_parallel),
+            inputs=stage['inputs'], outputs=stage['outputs'], 
+            tools=[gatk_dir], 
+            command=['recalibrate_base_quality_scores', mode, n_shards, profile], 
+            logger_process=logger_gatk_process)
+
+def recalibration_qc_library(config, library, logger_gatk_process, logger_gatk_errors):
+    """The deferred QC passes of the 'lean' BQSR mode; a no-op in 'full' mode."""
+    if config['snv_calling'].get('bqsr_mode', 'full') == 'full':
+        return 0
     gatk_dir = config['snv_calling']['software']
     ref_seq = config['reference']['fa_file']
-    align_dir = config['input_data']['input_dir'] + config['alignment']['output_dir']
-    thres_call = config['snv_calling']['threshold']
-    out_dir = config['snv_calling']['output_dir']
     knownsites = []
     for db in config['snv_calling']['knownsites']:
         knownsites.append(config['snv_calling']['knownsites'][db])
+    n_shards = config['snv_calling'].get('bqsr_shards', 1)
+    profile = resources_zhengu_20180103.stage_profile(config, 'bqsr_qc', library)
+    n_parallel, shard_profile = resources_zhengu_20180103.shard_resources(config, profile, 
+                                                                        n_shards)
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['bqsr_qc']
+    align_dir = entry['work_dir']
+    sorted_bam = os.path.basename(entry['files']['sorted_bam'])
+    with shell_command_zhengu_20180103.command_context(config, 'bqsr_qc', library):
+        return stage_cache_zhengu_20180103.run_stage(
+            config, 'bqsr_qc', library, 
+            lambda: recalibration_qc(gatk_dir, ref_seq, sorted_bam, knownsites, align_dir, 
+                                     logger_gatk_process, logger_gatk_errors, n_shards, 
+                                     shard_profile, n_parallel),
+            inputs=stage['inputs'], outputs=stage['outputs'], 
+            tools=[gatk_dir], command=['recalibration_qc', n_shards, profile], 
+            logger_process=logger_gatk_process)
+
+def call_library(config, library, logger_gatk_process, logger_gatk_errors):
+    gatk_dir = config['snv_calling']['software']
+    ref_seq = config['reference']['fa_file']
+    entry = plan_zhengu_20180103.library_plan(config, library)
+    stage = entry['stages']['call']
+    out_dir = entry['variants_dir']
+    thres_call = config['snv_calling']['threshold']
+    n_shards = config['snv_calling'].get('shards', 1)
+    shard_weight = config['snv_calling'].get('shard_weight', 'length')
+    profile = resources_zhengu_20180103.stage_profile(config, 'call', library)
+    n_parallel, shard_profile = resources_zhengu_20180103.shard_resources(config, profile, 
+                                                                        n_shards)
+    recal_bam = entry['files']['recal_bam']
+    if n_shards > 1:
+        call = lambda: call_variants_sharded(gatk_dir, ref_seq, recal_bam, thres_call, 
+                                             out_dir, n_shards, shard_weight, 
+                                             logger_gatk_process, logger_gatk_errors, 
+                                             shard_profile, n_parallel)
+    else:
+        call = lambda: call_variants(gatk_dir, ref_seq, recal_bam, thres_call, out_dir, 
+                                     logger_gatk_process, logger_gatk_errors, 
+                                     profile=shard_profile)
+    with shell_command_zhengu_20180103.command_context(config, 'call', library):
+        returncode_var = stage_cache_zhengu_20180103.run_stage(
+            config, 'call', library, call,
+            inputs=stage['inputs'], outputs=stage['outputs'], tools=[gatk_dir], 
+            command=['call_variants', thres_call, n_shards, shard_weight, profile], 
+            logger_process=logger_gatk_process)
+    if not returncode_var == 0:
+        return 1
+    if config['snv_calling'].get('lift_over', False):
+        # from the copy in the shared directory, the scratch one may be gone
+        gvcf = entry['files']['published_gvcf']
+        lift_over_zhengu_20180103.lift_over_vcf_file(
+            ref_seq, gvcf, gvcf.replace('.g.vcf', '.genomic.g.vcf'), 
+            config['snv_calling'].get('genome_fai'), logger_gatk_errors)
+        logger_gatk_process.info('Lifted %s over to genomic coordinates.', gvcf)
+    return 0
+
+def qc_resources(config, library):
+    """The cores and memory of the QC passes off the main chain: the coverage 
+    QC processes and, in 'lean' BQSR mode, one recalibration QC JVM."""
+    cores, memory_gb = 0, 0
+    if config.get('coverage_qc', {}).get('enabled', False):
+        cores += config['coverage_qc'].get('processes', 1)
+        memory_gb += 1
+    if config['snv_calling'].get('bqsr_mode', 'full') == 'lean':
+        profile = resources_zhengu_20180103.stage_profile(config, 'bqsr_qc', library)
+        cores += profile['threads']
+        memory_gb += resources_zhengu_20180103.jvm_memory_gb(config, profile)
+    return cores, memory_gb
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
     log_dir = config['logging']
     
     (logger_picard_process, logger_picard_errors, logger_gatk_process, 
      logger_gatk_errors) = store_logs(log_dir)
+    trace_zhengu_20180103.configure_trace(config)
+    reference = reference_zhengu_20180103.prepare_reference(
+        config, logger_picard_process, logger_picard_errors)
+    if reference is None:
+        return 1
+    reference_zhengu_20180103.apply_reference(config, reference)
+    plan_zhengu_20180103.load_plan(config, logger_picard_process)
     
     library = sys.argv[1]
-    sample_name = config['input_data']['libraries'][library]['sample_name']
-    input_sam = align_dir + sample_name + '_aligned.sam'
-    sorted_bam = align_dir + sample_name + '_aligned_sorted.bam'
-    returncode_picard = sort_sam_picard(picard_dir, input_sam, sorted_bam, 
-                                        logger_picard_process, logger_picard_errors)
-    
+    returncode_picard = sort_library(config, library, logger_picard_process, 
+                                     logger_picard_errors)
     if not returncode_picard == 0:
         return 1
-    sorted_bam = sample_name + '_aligned_sorted.bam'
-    returncode_bqsr = recalibrate_base_quality_scores(gatk_dir, ref_seq, sorted_bam, 
-                                                      knownsites, align_dir, 
-                                                      logger_gatk_process, logger_gatk_errors)
-    if not returncode_bqsr == 0:
-        return 2
-    recal_bam = align_dir + sample_name + '_recal.bam'
-    returncode_var = call_variants(gatk_dir, ref_seq, recal_bam, thres_call, out_dir, 
-                                  logger_gatk_process, logger_gatk_errors)
+    # the coverage QC and, in 'lean' BQSR mode, the recalibration QC passes run 
+    # next to the main chain when the reservation holds both, each sized from 
+    # its own share, and after it otherwise
+    cores, memory_gb = resources_zhengu_20180103.reserved_resources(config)
+    qc_cores, qc_memory_gb = qc_resources(config, library)
+    profiles = [resources_zhengu_20180103.stage_profile(config, stage, library) 
+                for stage in ['bqsr', 'call']]
+    main_cores = max(profile['threads'] for profile in profiles)
+    main_memory_gb = max(resources_zhengu_20180103.jvm_memory_gb(config, profile) 
+                         for profile in profiles)
+    if qc_cores and cores >= main_cores + qc_cores and \
+            memory_gb >= main_memory_gb + qc_memory_gb:
+        main_share = (cores - qc_cores, memory_gb - qc_memory_gb)
+        qc_share = (qc_cores, qc_memory_gb)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            coverage_job = executor.submit(
+                resources_zhengu_20180103.run_reserved, qc_share, coverage_qc_library, 
+                config, library, logger_picard_process, logger_picard_errors)
+            returncode_bqsr = resources_zhengu_20180103.run_reserved(
+                main_share, recalibrate_library, config, library, logger_gatk_process, 
+                logger_gatk_errors)
+            if not returncode_bqsr == 0:
+                return 2
+            qc_job = executor.submit(
+                resources_zhengu_20180103.run_reserved, qc_share, 
+                recalibration_qc_library, config, library, logger_gatk_process, 
+                logger_gatk_errors)
+            returncode_var = resources_zhengu_20180103.run_reserved(
+                main_share, call_library, config, library, logger_gatk_process, 
+                logger_gatk_errors)
+            returncode_qc = qc_job.result()
+            returncode_coverage = coverage_job.result()
+    else:
+        returncode_bqsr = recalibrate_library(config, library, logger_gatk_process, 
+                                              logger_gatk_errors)
+        if not returncode_bqsr == 0:
+            return 2
+        returncode_var = call_library(config, library, logger_gatk_process, 
+                                      logger_gatk_errors)
+        returncode_qc = recalibration_qc_library(config, library, logger_gatk_process, 
+                                                 logger_gatk_errors)
+        returncode_coverage = coverage_qc_library(config, library, logger_picard_process, 
+                                                  logger_picard_errors)
     if not returncode_var == 0:
         return 3
+    if not returncode_qc == 0:
+        return 4
+    if not returncode_coverage == 0:
+        return 5
+    return 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
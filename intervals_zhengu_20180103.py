@@ -0,0 +1,170 @@
+#!/user/bin/env python3
+
+"""Split the amplicon reference into interval shards and gather the per-shard
+VCF outputs again.
+
+Every contig of the amplicon reference is an independent region, so a shard
+is simply a set of whole contigs. Shards are balanced on the contig length or
+on the number of reads mapped to each contig, which is read from the BAM
+index without touching the BAM itself.
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import heapq
+import struct
+import itertools
+
+BAI_PSEUDO_BIN = 37450
+
+def read_reference_contigs(ref_fa_file):
+    """Return [(contig, length)] in reference order, from the .fai when it
+    exists and from the FASTA itself otherwise."""
+    contigs = []
+    if os.path.isfile(ref_fa_file + '.fai'):
+        with open(ref_fa_file + '.fai') as fai:
+            for row in fai:
+                items = row.split('\t')
+                if len(items) > 1:
+                    contigs.append((items[0], int(items[1])))
+        return contigs
+    with open(ref_fa_file) as fa:
+        for row in fa:
+            if row[0] == '>':
+                contigs.append([row[1:].split()[0], 0])
+            elif contigs:
+                contigs[-1][1] += len(row.strip())
+    return [tuple(contig) for contig in contigs]
+
+def read_bai_counts(bai_file):
+    """Return the number of mapped reads per reference from the pseudo-bins
+    of a BAI index, in reference order."""
+    with open(bai_file, 'rb') as bai:
+        data = bai.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError('{0} is not a BAI index.'.format(bai_file))
+    n_ref, = struct.unpack_from('<i', data, 4)
+    offset = 8
+    counts = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        n_mapped = 0
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_id == BAI_PSEUDO_BIN:
+                n_mapped, = struct.unpack_from('<Q', data, offset + 16)
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        counts.append(n_mapped)
+    return counts
+
+def contig_weights(ref_fa_file, weight='length', bai_file=None):
+    contigs = read_reference_contigs(ref_fa_file)
+    if weight == 'depth' and bai_file is not None and os.path.isfile(bai_file):
+        try:
+            counts = read_bai_counts(bai_file)
+        except (ValueError, struct.error):
+            # fall back on the contig lengths rather than failing the stage
+            counts = []
+        if len(counts) == len(contigs):
+            # contigs without reads still cost a little to traverse
+            return [(name, count + 1) for (name, _), count in zip(contigs, counts)]
+    return contigs
+
+def partition_intervals(weighted_contigs, n_shards):
+    """Greedily assign the heaviest contigs to the lightest shard. Each shard
+    keeps its contigs in reference order."""
+    n_shards = max(1, min(n_shards, len(weighted_contigs)))
+    order = {name: i for i, (name, _) in enumerate(weighted_contigs)}
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for name, weight in sorted(weighted_contigs, key=lambda x: -x[1]):
+        load, i = heapq.heappop(heap)
+        shards[i].append(name)
+        heapq.heappush(heap, (load + weight, i))
+    return [sorted(shard, key=order.get) for shard in shards]
+
+def write_interval_lists(shards, out_prefix):
+    interval_files = []
+    for i, shard in enumerate(shards):
+        interval_file = '{0}.shard_{1}.intervals'.format(out_prefix, i)
+        with open(interval_file, 'w') as f:
+            f.writelines(name + '\n' for name in shard)
+        interval_files.append(interval_file)
+    return interval_files
+
+def read_vcf_records(vcf_file, contig_index):
+    with open(vcf_file) as vcf:
+        for row in vcf:
+            if row[0] != '#':
+                items = row.split('\t', 2)
+                yield (contig_index.get(items[0], len(contig_index)), int(items[1])), row
+
+def read_vcf_header(vcf_file):
+    header = []
+    with open(vcf_file) as vcf:
+        for row in vcf:
+            if row[0] != '#':
+                break
+            header.append(row)
+    return header
+
+def header_key(row):
+    """Meta lines such as '##INFO=<ID=DP,...>' are identified by their key
+    and ID, so that e.g. the ##GATKCommandLine of every shard, which differ in
+    their -L and -o arguments, only appear once."""
+    key, _, value = row.partition('=')
+    if value.startswith('<ID='):
+        return key, value[4:].split(',')[0].rstrip('>\n')
+    return row
+
+def merge_vcf_headers(vcf_files):
+    meta_lines = []
+    seen = set()
+    column_line = None
+    for vcf_file in vcf_files:
+        for row in read_vcf_header(vcf_file):
+            if row.startswith('#CHROM'):
+                if column_line is not None and row != column_line:
+                    raise ValueError('The samples of {0} differ from the other '
+                                     'shards.'.format(vcf_file))
+                column_line = row
+            elif header_key(row) not in seen:
+                seen.add(header_key(row))
+                meta_lines.append(row)
+    return meta_lines + ([column_line] if column_line is not None else [])
+
+def gather_vcfs(vcf_files, out_vcf, contig_names):
+    """Merge the shard VCFs into one file sorted in reference order, under
+    the union of the shard headers."""
+    contig_index = {name: i for i, name in enumerate(contig_names)}
+    header = merge_vcf_headers(vcf_files)
+    with open(out_vcf, 'w') as out:
+        out.writelines(header)
+        records = heapq.merge(*[read_vcf_records(vcf_file, contig_index)
+                                for vcf_file in vcf_files], key=lambda x: x[0])
+        n_records = 0
+        for _, row in records:
+            out.write(row)
+            n_records += 1
+    return n_records
+
+def validate_sharded_vcf(single_vcf, sharded_vcf, max_reported=10):
+    """Compare the records of a single-process VCF and of its sharded
+    counterpart one by one. Returns the mismatches as (record number,
+    single-process record, sharded record)."""
+    mismatches = []
+    with open(single_vcf) as single, open(sharded_vcf) as sharded:
+        records_single = (row for row in single if row[0] != '#')
+        records_sharded = (row for row in sharded if row[0] != '#')
+        for i, (row_single, row_sharded) in enumerate(
+                itertools.zip_longest(records_single, records_sharded), 1):
+            if row_single != row_sharded:
+                mismatches.append((i, row_single, row_sharded))
+                if len(mismatches) >= max_reported:
+                    break
+    return mismatches
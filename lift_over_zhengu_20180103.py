@@ -0,0 +1,349 @@
+#!/user/bin/env python3
+
+"""Translate amplicon-space coordinates back to genomic coordinates.
+
+The contigs of the amplicon reference are named 'chrom_start_stop', e.g.
+'chr7_55241614_55241736', so that position 1 of the contig corresponds to
+position 'start' of 'chrom'. The contig names are parsed once into an offset
+table, and SAM or VCF records are then rewritten in large batches.
+
+ Usage::
+     $ python3 lift_over_zhengu_20180103.py sam <ref_fa> <in.sam|-> <out.sam|-> [genome_fai]
+     $ python3 lift_over_zhengu_20180103.py vcf <ref_fa> <in.vcf> <out.vcf> [genome_fai]
+     $ python3 lift_over_zhengu_20180103.py benchmark [n_reads]
+
+ :param ref_fa: FASTA file of the amplicon reference (its .fai is used when
+                present), or '-' to take the contig names from the @SQ lines
+ :param genome_fai: .fai of the genome, for the chromosome order and lengths
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import io
+import os
+import sys
+import time
+import heapq
+from collections import OrderedDict
+
+CHUNK_BYTES = 1 << 22
+
+def read_contig_names(ref_fa_file):
+    if os.path.isfile(ref_fa_file + '.fai'):
+        with open(ref_fa_file + '.fai') as fai:
+            return [row.split('\t')[0] for row in fai if row.strip()]
+    contig_names = []
+    with open(ref_fa_file) as fa:
+        for row in fa:
+            if row[0] == '>':
+                contig_names.append(row[1:].split()[0])
+    return contig_names
+
+def parse_contig_name(contig_name):
+    # chromosome names may contain '_' themselves, start & stop never do
+    items = contig_name.rsplit('_', 2)
+    if len(items) == 3 and items[1].isdigit() and items[2].isdigit():
+        return items[0], int(items[1]) - 1, int(items[2])
+    return contig_name, 0, None
+
+def lookup_offset(offsets, contig_name):
+    # contigs missing from the reference are parsed once and remembered
+    if contig_name not in offsets:
+        offsets[contig_name] = parse_contig_name(contig_name)[:2]
+    return offsets[contig_name]
+
+def build_offset_table(contig_names, genome_fai=None):
+    """Return {contig: (chrom, offset)} together with the ordered lengths of
+    the genomic chromosomes. With a genome .fai the chromosomes follow its
+    order and lengths; without it they follow the amplicons, and the length
+    of a chromosome is taken as the largest amplicon stop on it."""
+    offsets = {}
+    chrom_lengths = OrderedDict()
+    for contig_name in contig_names:
+        chrom, offset, stop = parse_contig_name(contig_name)
+        offsets[contig_name] = (chrom, offset)
+        chrom_lengths[chrom] = max(chrom_lengths.get(chrom, 0), stop or 0)
+    if genome_fai is not None:
+        genome_lengths = OrderedDict()
+        with open(genome_fai) as fai:
+            for row in fai:
+                items = row.split('\t')
+                if items[0] in chrom_lengths:
+                    genome_lengths[items[0]] = int(items[1])
+        # chromosomes missing from the genome keep their amplicon stops
+        for chrom, length in chrom_lengths.items():
+            genome_lengths.setdefault(chrom, length)
+        chrom_lengths = genome_lengths
+    return offsets, chrom_lengths
+
+def open_input(file_name):
+    if file_name == '-':
+        return open(sys.stdin.fileno(), buffering=CHUNK_BYTES, closefd=False)
+    return open(file_name, buffering=CHUNK_BYTES)
+
+def open_output(file_name):
+    if file_name == '-':
+        return open(sys.stdout.fileno(), 'w', buffering=CHUNK_BYTES, closefd=False)
+    return open(file_name, 'w', buffering=CHUNK_BYTES)
+
+def lift_over_sam_header(header_lines, offsets, chrom_lengths, genome_fai=None):
+    if offsets is None:
+        contig_names = [row.split('SN:', 1)[1].split('\t', 1)[0].rstrip('\n')
+                        for row in header_lines if row.startswith('@SQ')]
+        offsets, chrom_lengths = build_offset_table(contig_names, genome_fai)
+    out_lines = []
+    sq_written = False
+    for row in header_lines:
+        if row.startswith('@SQ'):
+            if not sq_written:
+                out_lines.extend('@SQ\tSN:{0}\tLN:{1}\n'.format(chrom, length)
+                                 for chrom, length in chrom_lengths.items())
+                sq_written = True
+        elif row.startswith('@HD'):
+            # amplicons are not necessarily in genomic order
+            out_lines.append(row.replace('SO:coordinate', 'SO:unsorted'))
+        else:
+            out_lines.append(row)
+    return out_lines, offsets, chrom_lengths
+
+def lift_over_sam_records(lines, offsets):
+    out_lines = []
+    append = out_lines.append
+    for row in lines:
+        fields = row.split('\t', 9)
+        rname = fields[2]
+        if rname == '*':
+            append(row)
+            continue
+        chrom, offset = lookup_offset(offsets, rname)
+        fields[2] = chrom
+        if fields[3] != '0':
+            fields[3] = str(int(fields[3]) + offset)
+        rnext = fields[6]
+        if rnext == '=':
+            if fields[7] != '0':
+                fields[7] = str(int(fields[7]) + offset)
+        elif rnext != '*':
+            mate_chrom, mate_offset = lookup_offset(offsets, rnext)
+            fields[6] = '=' if mate_chrom == chrom else mate_chrom
+            if fields[7] != '0':
+                fields[7] = str(int(fields[7]) + mate_offset)
+        append('\t'.join(fields))
+    return out_lines
+
+def lift_over_sam(sam_in, sam_out, offsets=None, chrom_lengths=None,
+                  genome_fai=None):
+    """Stream a SAM file from 'sam_in' to 'sam_out' in chunks of CHUNK_BYTES.
+    With 'offsets' left as None, the table is built from the @SQ lines."""
+    header_lines = []
+    in_header = True
+    n_records = 0
+    while True:
+        lines = sam_in.readlines(CHUNK_BYTES)
+        if not lines:
+            break
+        if in_header:
+            n_header = 0
+            while n_header < len(lines) and lines[n_header][0] == '@':
+                n_header += 1
+            header_lines.extend(lines[:n_header])
+            if n_header == len(lines):
+                continue
+            in_header = False
+            out_header, offsets, chrom_lengths = lift_over_sam_header(
+                header_lines, offsets, chrom_lengths, genome_fai)
+            sam_out.writelines(out_header)
+            lines = lines[n_header:]
+        sam_out.writelines(lift_over_sam_records(lines, offsets))
+        n_records += len(lines)
+    if in_header:
+        out_header, offsets, chrom_lengths = lift_over_sam_header(
+            header_lines, offsets, chrom_lengths, genome_fai)
+        sam_out.writelines(out_header)
+    return n_records
+
+def lift_over_vcf_records(lines, offsets):
+    out_lines = []
+    for row in lines:
+        fields = row.split('\t', 8)
+        chrom, offset = lookup_offset(offsets, fields[0])
+        fields[0] = chrom
+        fields[1] = str(int(fields[1]) + offset)
+        # GVCF reference blocks carry their stop position in INFO
+        if len(fields) > 7 and 'END=' in fields[7]:
+            # INFO is the last column of a sites-only VCF
+            value = fields[7].rstrip('\n')
+            info = value.split(';')
+            for i, item in enumerate(info):
+                if item.startswith('END='):
+                    info[i] = 'END=' + str(int(item[4:]) + offset)
+            fields[7] = ';'.join(info) + fields[7][len(value):]
+        out_lines.append('\t'.join(fields))
+    return out_lines
+
+def vcf_position(row):
+    return int(row.split('\t', 2)[1])
+
+def lift_over_vcf(vcf_in, vcf_out, offsets, chrom_lengths):
+    """Rewrite a VCF or GVCF, including its ##contig lines, in genomic order.
+    The records of an amplicon are in order, so a chromosome is the merge of
+    the runs of its amplicons. It is written as soon as the input, which
+    follows the amplicon reference, has passed the last amplicon on it, and
+    only the runs of the chromosomes not yet written are held."""
+    contig_index = {name: i for i, name in enumerate(offsets)}
+    last_index = {}
+    for name, (chrom, _) in offsets.items():
+        last_index[chrom] = contig_index[name]
+    chrom_order = list(chrom_lengths)
+    runs = OrderedDict()
+    written = set()
+    header_lines = []
+    contig_written = False
+    in_header = True
+    current_contig = None
+    passed = -1
+    n_records = 0
+
+    def write_chrom(chrom):
+        chrom_runs = runs.pop(chrom, [])
+        vcf_out.writelines(chrom_runs[0] if len(chrom_runs) == 1 else
+                           heapq.merge(*chrom_runs, key=vcf_position))
+        written.add(chrom)
+
+    while True:
+        lines = vcf_in.readlines(CHUNK_BYTES)
+        if not lines:
+            break
+        n_header = 0
+        while in_header and n_header < len(lines) and lines[n_header][0] == '#':
+            row = lines[n_header]
+            if not row.startswith('##contig='):
+                header_lines.append(row)
+            elif not contig_written:
+                header_lines.extend('##contig=<ID={0},length={1}>\n'.format(
+                    chrom, length) for chrom, length in chrom_lengths.items())
+                contig_written = True
+            n_header += 1
+        if in_header and n_header < len(lines):
+            in_header = False
+            vcf_out.writelines(header_lines)
+        start = n_header
+        while start < len(lines):
+            # the run of one amplicon contig within the batch
+            contig = lines[start].split('\t', 1)[0]
+            end = start + 1
+            while end < len(lines) and lines[end].startswith(contig + '\t'):
+                end += 1
+            if contig_index.get(contig, passed) < passed:
+                raise ValueError('The records of {0} do not follow the order of the '
+                                 'amplicon reference.'.format(contig))
+            lifted = lift_over_vcf_records(lines[start:end], offsets)
+            chrom = lifted[0].split('\t', 1)[0]
+            if chrom in written:
+                raise ValueError('The records of {0} come after those of the other '
+                                 'amplicons on {1}.'.format(contig, chrom))
+            chrom_runs = runs.setdefault(chrom, [])
+            if contig == current_contig:
+                chrom_runs[-1].extend(lifted)
+            else:
+                chrom_runs.append(lifted)
+            current_contig = contig
+            # contigs missing from the reference hold their chromosome to the end
+            passed = max(passed, contig_index.get(contig, -1))
+            n_records += end - start
+            start = end
+        while chrom_order and last_index.get(chrom_order[0], len(contig_index)) < passed:
+            write_chrom(chrom_order.pop(0))
+    if in_header:
+        vcf_out.writelines(header_lines)
+    for chrom in chrom_order + [x for x in runs if x not in chrom_lengths]:
+        write_chrom(chrom)
+    return n_records
+
+def lift_over_vcf_file(ref_fa_file, vcf_file_org, vcf_file_mod, genome_fai=None,
+                       logger_errors=None):
+    """Without a genome .fai, the ##contig lengths are the largest amplicon
+    stops, which GATK and bcftools take for the chromosome lengths."""
+    if genome_fai is None and logger_errors is not None:
+        logger_errors.warning('No genome .fai given to lift %s over, the ##contig '
+                              'lengths are the largest amplicon stops.', vcf_file_org)
+    offsets, chrom_lengths = build_offset_table(read_contig_names(ref_fa_file),
+                                                genome_fai)
+    with open_input(vcf_file_org) as vcf_in, open_output(vcf_file_mod) as vcf_out:
+        return lift_over_vcf(vcf_in, vcf_out, offsets, chrom_lengths)
+
+def lift_over_sam_file(ref_fa_file, sam_file_org, sam_file_mod, genome_fai=None):
+    offsets = chrom_lengths = None
+    if ref_fa_file != '-':
+        offsets, chrom_lengths = build_offset_table(read_contig_names(ref_fa_file),
+                                                    genome_fai)
+    with open_input(sam_file_org) as sam_in, open_output(sam_file_mod) as sam_out:
+        return lift_over_sam(sam_in, sam_out, offsets, chrom_lengths, genome_fai)
+
+def lift_over_sam_per_line(sam_in, sam_out):
+    # the former row-by-row approach, kept as the baseline of the benchmark
+    for row in sam_in:
+        if row[0] == '@':
+            sam_out.write(row)
+            continue
+        items = row.strip().split()
+        if items[2] == '*':
+            sam_out.write(row)
+            continue
+        chrom, start, stop = items[2].split('_')
+        pos = int(items[3]) + int(start) - 1
+        sam_out.write(items[0] + '\t' + items[1] + '\t' + chrom + '\t' + str(pos)
+                      + '\t' + '\t'.join(items[4:]) + '\n')
+
+def simulate_sam(n_reads, n_amplicons=300, read_length=150):
+    rows = ['@HD\tVN:1.5\tSO:unsorted\n']
+    contig_names = []
+    for i in range(n_amplicons):
+        start = 1000000 + i * 1000
+        contig_names.append('chr{0}_{1}_{2}'.format(i % 22 + 1, start, start + 200))
+        rows.append('@SQ\tSN:{0}\tLN:201\n'.format(contig_names[-1]))
+    seq = 'A' * read_length
+    qual = 'I' * read_length
+    for i in range(n_reads):
+        contig_name = contig_names[i % n_amplicons]
+        rows.append('read{0}\t99\t{1}\t{2}\t60\t{3}M\t=\t{4}\t{5}\t{6}\t{7}\t'
+                    'NM:i:0\tRG:Z:YN\n'.format(i, contig_name, i % 50 + 1,
+                                              read_length, i % 50 + 51,
+                                              read_length + 50, seq, qual))
+    return ''.join(rows)
+
+def benchmark_lift_over(n_reads=200000):
+    sam_text = simulate_sam(n_reads)
+    timings = OrderedDict()
+    for name, lift_over in (('per-line', lift_over_sam_per_line),
+                            ('batched', lift_over_sam)):
+        sam_in = io.StringIO(sam_text)
+        sam_out = io.StringIO()
+        time_start = time.perf_counter()
+        lift_over(sam_in, sam_out)
+        timings[name] = time.perf_counter() - time_start
+    for name, seconds in timings.items():
+        print('{0:<10}{1:>12.0f} reads/s'.format(name, n_reads / seconds))
+    print('speed-up: {0:.2f}x'.format(timings['per-line'] / timings['batched']))
+    return timings
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        n_reads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+        benchmark_lift_over(n_reads)
+    elif len(sys.argv) in (5, 6) and sys.argv[1] in ('sam', 'vcf'):
+        genome_fai = sys.argv[5] if len(sys.argv) == 6 else None
+        if genome_fai is None:
+            print('Without a genome .fai the chromosome lengths are the largest '
+                  'amplicon stops.')
+        if sys.argv[1] == 'sam':
+            lift_over_sam_file(sys.argv[2], sys.argv[3], sys.argv[4], genome_fai)
+        else:
+            lift_over_vcf_file(sys.argv[2], sys.argv[3], sys.argv[4], genome_fai)
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+#!/user/bin/env python3
+
+"""The execution plan: every input and output file of every stage.
+
+The plan is compiled once from the configuration into
+{'libraries': {library: entry}, 'cohort': entry}. A library entry holds its
+sample name, read group, working directories, its files by role and, per
+stage in pipeline order, the stage's 'inputs' and 'outputs'. All stages take
+their paths from the plan instead of assembling them on their own. The plan
+is cached as JSON under the SHA-1 of the configuration, so an unchanged
+flowcell is not compiled again.
+
+The dry-run lists, for the whole flowcell, the missing inputs and the first
+stage every library still has to run. Every directory is listed once
+instead of checking the files one by one.
+
+ Usage::
+     $ python3 plan_zhengu_20180103.py dry-run [library ...]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import hashlib
+
+import fastq_utils_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import scratch_zhengu_20180103
+
+BWA_INDEX_EXTENSIONS = ['.pac', '.amb', '.ann', '.bwt', '.sa']
+
+def config_digest(config):
+    content = {key: value for key, value in config.items() if key != 'plan'}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def plan_library(config, library):
+    """The plan entry of one library."""
+    entry = config['input_data']['libraries'][library]
+    sample_name = entry['sample_name']
+    sample_id = entry['library_id']
+    read_prefix = (config['input_data']['input_dir'] + entry['location'] +
+                   '{0}-{1}'.format(sample_id, sample_name))
+    work_dir = scratch_zhengu_20180103.work_dir(config, library, create=False)
+    variants_dir = scratch_zhengu_20180103.variants_dir(config, library, create=False)
+    ref_seq = config['reference']['fa_file']
+    ref_index = config['alignment']['ref_index']
+    knownsites = [config['snv_calling']['knownsites'][db]
+                  for db in config['snv_calling']['knownsites']]
+    prefix = work_dir + sample_name
+    files = {'read1': read_prefix + entry['read1'],
+             'read2': read_prefix + entry['read2'],
+             'aligned_sam': prefix + '_aligned.sam',
+             'sorted_bam': prefix + '_aligned_sorted.bam',
+             'sorted_bai': prefix + '_aligned_sorted.bai',
+             'read_stats': prefix + '_read_stats.tsv',
+             'coverage_qc': prefix + '_coverage_qc.tsv',
+             'recal_table': prefix + '_recal.table',
+             'recal_post_table': prefix + '_recal_post.table',
+             'recal_plots': prefix + '_recal_plots.pdf',
+             'recal_bam': prefix + '_recal.bam',
+             'recal_bai': prefix + '_recal.bai',
+             'gvcf': variants_dir + sample_name + '_raw_variants.g.vcf',
+             'published_gvcf': scratch_zhengu_20180103.shared_variants_dir(config) +
+                               sample_name + '_raw_variants.g.vcf'}
+
+    alignment = config['alignment']
+    # compressed reads are always fed through the checking decompressor
+    read_stats = alignment.get('read_stats', False) or files['read1'].endswith('.gz')
+    stats_outputs = [files['read_stats']] if read_stats else []
+    sorted_outputs = [files['sorted_bam'], files['sorted_bai']]
+    align_inputs = ([files['read1'], files['read2'], ref_seq] +
+                    [ref_index + extension for extension in BWA_INDEX_EXTENSIONS])
+    stages = {}
+    if alignment.get('chunks', 1) > 1:
+        # split, align every chunk and merge the sorted chunk BAMs, each a
+        # stage of its own
+        chunk_prefix = os.path.splitext(files['sorted_bam'])[0]
+        chunk_reads = fastq_utils_zhengu_20180103.chunk_file_names(chunk_prefix,
+                                                                 alignment['chunks'])
+        chunk_bams = ['{0}.chunk_{1}.bam'.format(chunk_prefix, i)
+                      for i in range(alignment['chunks'])]
+        stages['split'] = {'inputs': align_inputs,
+                           'outputs': [x for pair in chunk_reads for x in pair] +
+                                      stats_outputs}
+        for i, (pair, chunk_bam) in enumerate(zip(chunk_reads, chunk_bams)):
+            stages['align_chunk_{0}'.format(i)] = {
+                'inputs': list(pair) + align_inputs[2:],
+                'outputs': [chunk_bam, chunk_bam[:-len('.bam')] + '.bai']}
+        stages['align'] = {'inputs': chunk_bams, 'outputs': sorted_outputs}
+        stages['sort'] = {'inputs': [], 'outputs': sorted_outputs}
+    elif alignment.get('streaming', False):
+        # the aligner sorts and indexes, nothing is left to the sort stage
+        stages['align'] = {'inputs': align_inputs, 'outputs': sorted_outputs + stats_outputs}
+        stages['sort'] = {'inputs': [], 'outputs': sorted_outputs}
+    else:
+        stages['align'] = {'inputs': align_inputs,
+                           'outputs': [files['aligned_sam']] + stats_outputs}
+        stages['sort'] = {'inputs': [files['aligned_sam']], 'outputs': sorted_outputs}
+    if config.get('coverage_qc', {}).get('enabled', False):
+        stages['coverage_qc'] = {'inputs': sorted_outputs, 'outputs': [files['coverage_qc']]}
+    recal_outputs = [files['recal_table'], files['recal_bam'], files['recal_bai']]
+    qc_outputs = [files['recal_post_table'], files['recal_plots']]
+    if config['snv_calling'].get('bqsr_mode', 'full') == 'full':
+        stages['bqsr'] = {'inputs': [files['sorted_bam'], ref_seq] + knownsites,
+                          'outputs': recal_outputs + qc_outputs}
+    else:
+        stages['bqsr'] = {'inputs': [files['sorted_bam'], ref_seq] + knownsites,
+                          'outputs': recal_outputs}
+        stages['bqsr_qc'] = {'inputs': [files['sorted_bam'], files['recal_table'],
+                                        ref_seq] + knownsites,
+                             'outputs': qc_outputs}
+    stages['call'] = {'inputs': [files['recal_bam'], ref_seq],
+                      'outputs': [files['gvcf'], files['gvcf'] + '.idx']}
+    return {'sample_name': sample_name, 'library_id': sample_id,
+            'read_group': '\'@RG\\tID:{0}\\tPL:Illumina\\tLB:YN\\tSM:{1}\''.format(
+                sample_id, sample_name),
+            'work_dir': work_dir, 'variants_dir': variants_dir, 'files': files,
+            'stages': stages}
+
+def plan_cohort(config, libraries):
+    variants_dir = scratch_zhengu_20180103.shared_variants_dir(config)
+    joint_vcf = variants_dir + config['genotype_joining']['output_name'] + '.vcf'
+    return {'variants_dir': variants_dir,
+            'stages': {'join': {'inputs': [libraries[x]['files']['published_gvcf']
+                                           for x in libraries] +
+                                          [config['reference']['fa_file']],
+                                'outputs': [joint_vcf, joint_vcf + '.idx']}}}
+
+def build_plan(config):
+    libraries = {library: plan_library(config, library)
+                 for library in config['input_data']['libraries']}
+    return {'digest': config_digest(config), 'libraries': libraries,
+            'cohort': plan_cohort(config, libraries)}
+
+def plan_file(config):
+    return config['input_data'].get('plan_file') or os.path.join(config['logging'],
+                                                                 'plan.json')
+
+def load_plan(config, logger_process=None, write=True):
+    """Attach the plan of the configuration to it as config['plan'], from the
+    cache if it was compiled from the same configuration."""
+    digest = config_digest(config)
+    cache_file = plan_file(config)
+    plan = None
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            try:
+                plan = json.load(f)
+            except ValueError:
+                plan = None
+        if plan is not None and plan.get('digest') != digest:
+            plan = None
+    if plan is None:
+        plan = build_plan(config)
+        if logger_process is not None:
+            logger_process.info('Compiled the plan of %d libraries into %s.',
+                                len(plan['libraries']), cache_file)
+        if write:
+            if not os.path.exists(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(plan, f)
+            os.replace(tmp_file, cache_file)
+    config['plan'] = plan
+    return plan
+
+def library_plan(config, library):
+    """The plan entry of a library, compiled on the spot without a plan."""
+    plan = config.get('plan')
+    if plan is not None and library in plan['libraries']:
+        return plan['libraries'][library]
+    return plan_library(config, library)
+
+def cohort_plan(config, libraries):
+    plan = config.get('plan')
+    entries = {library: library_plan(config, library) for library in libraries}
+    if plan is not None and len(entries) == len(plan['libraries']):
+        return plan['cohort']
+    return plan_cohort(config, entries)
+
+class DirectoryListing(object):
+    """Answers whether files exist from one listing per directory."""
+    def __init__(self):
+        self.listings = {}
+
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        if directory not in self.listings:
+            try:
+                self.listings[directory] = set(os.listdir(directory or '.'))
+            except OSError:
+                self.listings[directory] = set()
+        return name in self.listings[directory]
+
+def dry_run(config, libraries):
+    """Print the missing inputs and the next stage of every library. Returns
+    the number of libraries which cannot run."""
+    plan = config['plan']
+    listing = DirectoryListing()
+    shared = set([config['reference']['fa_file']] +
+                 [config['snv_calling']['knownsites'][db]
+                  for db in config['snv_calling']['knownsites']])
+    for tool in [config['alignment']['software'], config['sorting']['software'],
+                 config['snv_calling']['software']]:
+        if os.sep in tool:
+            shared.add(tool)
+    missing_shared = sorted(x for x in shared if not listing.exists(x))
+    for path in missing_shared:
+        print('missing\t-\t{0}'.format(path))
+    n_blocked = 0
+    next_stages = {}
+    for library in libraries:
+        entry = plan['libraries'][library]
+        missing = [entry['files'][x] for x in ['read1', 'read2']
+                   if not listing.exists(entry['files'][x])]
+        for path in missing:
+            print('missing\t{0}\t{1}'.format(library, path))
+        if missing:
+            n_blocked += 1
+            continue
+        stages = [(stage, all(listing.exists(x) for x in files['outputs']))
+                  for stage, files in entry['stages'].items()]
+        # the deleted intermediates of earlier stages, e.g. the read chunks,
+        # do not count once a later stage has its outputs
+        last_done = max([i for i, (_, done) in enumerate(stages) if done] or [-1])
+        next_stage = next((stage for stage, done in stages[last_done + 1:] if not done),
+                          'done')
+        next_stages[next_stage] = next_stages.get(next_stage, 0) + 1
+    print('{0} libraries, {1} with missing reads, {2} shared files missing.'.format(
+        len(libraries), n_blocked, len(missing_shared)))
+    for stage, n_libraries in sorted(next_stages.items(), key=lambda x: -x[1]):
+        print('{0:<12}{1}'.format(stage, n_libraries))
+    return n_blocked + (len(libraries) if missing_shared else 0)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != 'dry-run':
+        print(__doc__)
+        return 1
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    libraries = sys.argv[2:] or list(config['input_data']['libraries'])
+    unknown = [x for x in libraries if x not in config['input_data']['libraries']]
+    if unknown:
+        print('Unknown libraries: {0}'.format(', '.join(unknown)))
+        return 1
+    # the reference is not prepared in a dry-run, so the plan is not cached
+    load_plan(config, write=False)
+    return 1 if dry_run(config, libraries) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#!/user/bin/env python3
+
+"""Prepare the reference once for all scripts and libraries.
+
+The BWA index, the FASTA index (.fai) and the sequence dictionary (.dict)
+needed by BWA, GATK and Picard are built into a directory of the reference
+cache named after the SHA-1 of the FASTA content. Building happens under a
+file lock, so workers started at the same time wait for the first one
+instead of building the same index in parallel, and the directory is only
+used once it is complete. A changed FASTA gets a new directory; touching or
+copying an unchanged one does not trigger a rebuild.
+
+Without 'reference.cache_dir' the configured FASTA and BWA index are used
+where they are, and whichever of the three indices is missing or older than
+the FASTA is built next to it, under a lock on the FASTA.
+
+ Usage::
+     $ python3 reference_zhengu_20180103.py [show]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import contextlib
+from collections import namedtuple
+import yaml
+
+import resources_zhengu_20180103
+from shell_command_zhengu_20180103 import run_shell_command
+
+HASH_BLOCK_BYTES = 1 << 20
+BWA_INDEX_EXTENSIONS = ['.pac', '.amb', '.ann', '.bwt', '.sa']
+
+ReferencePaths = namedtuple('ReferencePaths', ['fa_file', 'bwa_index', 'fai_file',
+                                               'dict_file', 'digest'])
+
+@contextlib.contextmanager
+def locked(lock_file, logger_process=None):
+    """Hold an exclusive flock on 'lock_file', waiting for other holders."""
+    with open(lock_file, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if logger_process is not None:
+                logger_process.info('Waiting for the lock %s.', lock_file)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def fasta_digest(ref_fa_file, cache_dir):
+    """SHA-1 of the FASTA content. The digest is remembered per path, size
+    and mtime, so an unchanged FASTA is hashed only once."""
+    digests_file = os.path.join(cache_dir, 'digests.json')
+    stat = os.stat(ref_fa_file)
+    key = os.path.abspath(ref_fa_file)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    digests = {}
+    if os.path.isfile(digests_file):
+        with open(digests_file) as f:
+            digests = json.load(f)
+    if key in digests and digests[key]['stamp'] == stamp:
+        return digests[key]['sha1']
+    sha1 = hashlib.sha1()
+    with open(ref_fa_file, 'rb') as fa:
+        for block in iter(lambda: fa.read(HASH_BLOCK_BYTES), b''):
+            sha1.update(block)
+    digests[key] = {'stamp': stamp, 'sha1': sha1.hexdigest()}
+    with open(digests_file + '.{0}.tmp'.format(os.getpid()), 'w') as f:
+        json.dump(digests, f, indent=1, sort_keys=True)
+    os.replace(digests_file + '.{0}.tmp'.format(os.getpid()), digests_file)
+    return digests[key]['sha1']
+
+def write_fasta_index(ref_fa_file, fai_file):
+    """Write the samtools faidx index: name, length, offset of the first
+    base, bases and bytes per line. Every line of a sequence but the last
+    must have the same length."""
+    entries = []
+    offset = 0
+    with open(ref_fa_file, 'rb') as fa:
+        entry = None
+        short_line = False
+        for line in fa:
+            if line.startswith(b'>'):
+                entry = [line[1:].split()[0].decode(), 0, offset + len(line), 0, 0]
+                entries.append(entry)
+                short_line = False
+            elif entry is not None and line.strip():
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[3] == 0:
+                    entry[3], entry[4] = bases, len(line)
+                elif short_line or bases > entry[3]:
+                    raise ValueError('Different line lengths in sequence {0} of '
+                                     '{1}.'.format(entry[0], ref_fa_file))
+                short_line = bases < entry[3]
+                entry[1] += bases
+            offset += len(line)
+    with open(fai_file, 'w') as fai:
+        for entry in entries:
+            fai.write('\t'.join(str(x) for x in entry) + '\n')
+    return len(entries)
+
+def build_reference(ref_fa_file, ref_dir, bwa_dir, picard_dir, logger_process,
+                    logger_errors, profile=None):
+    """Copy the FASTA into 'ref_dir' and build its three indices there."""
+    fa_file = os.path.join(ref_dir, 'reference.fa')
+    shutil.copyfile(ref_fa_file, fa_file)
+    n_contigs = write_fasta_index(fa_file, fa_file + '.fai')
+    logger_process.info('Indexed %d sequences of %s.', n_contigs, ref_fa_file)
+    command_dict = '{0} CreateSequenceDictionary R={1} O={2}'.format(
+        resources_zhengu_20180103.java_command(picard_dir, profile), fa_file,
+        os.path.join(ref_dir, 'reference.dict'))
+    if not run_shell_command(command_dict, logger_process, logger_errors) == 0:
+        logger_errors.error('Picard CreateSequenceDictionary failed on %s.', fa_file)
+        return 1
+    command_index = '{0} index -p {1} {1}'.format(bwa_dir, fa_file)
+    if not run_shell_command(command_index, logger_process, logger_errors) == 0:
+        logger_errors.error('BWA indexing failed on %s.', fa_file)
+        return 1
+    return 0
+
+def is_stale(index_file, ref_fa_file):
+    return not os.path.isfile(index_file) or \
+        os.path.getmtime(index_file) < os.path.getmtime(ref_fa_file)
+
+def index_in_place(paths, bwa_dir, picard_dir, logger_process, logger_errors,
+                   profile=None):
+    """Build the indices of 'paths' which are missing or older than the
+    FASTA next to it."""
+    fa_file = paths.fa_file
+    if is_stale(paths.fai_file, fa_file):
+        n_contigs = write_fasta_index(fa_file, paths.fai_file)
+        logger_process.info('Indexed %d sequences of %s.', n_contigs, fa_file)
+    if is_stale(paths.dict_file, fa_file):
+        # Picard refuses to overwrite an existing dictionary
+        if os.path.isfile(paths.dict_file):
+            os.remove(paths.dict_file)
+        command_dict = '{0} CreateSequenceDictionary R={1} O={2}'.format(
+            resources_zhengu_20180103.java_command(picard_dir, profile), fa_file,
+            paths.dict_file)
+        if not run_shell_command(command_dict, logger_process, logger_errors) == 0:
+            logger_errors.error('Picard CreateSequenceDictionary failed on %s.', fa_file)
+            return 1
+    if any(is_stale(paths.bwa_index + x, fa_file) for x in BWA_INDEX_EXTENSIONS):
+        command_index = '{0} index -p {1} {2}'.format(bwa_dir, paths.bwa_index, fa_file)
+        if not run_shell_command(command_index, logger_process, logger_errors) == 0:
+            logger_errors.error('BWA indexing failed on %s.', fa_file)
+            return 1
+    return 0
+
+def reference_paths(ref_dir, digest):
+    fa_file = os.path.join(ref_dir, 'reference.fa')
+    return ReferencePaths(fa_file, fa_file, fa_file + '.fai',
+                          os.path.join(ref_dir, 'reference.dict'), digest)
+
+def prepare_reference(config, logger_process, logger_errors):
+    """Return the ReferencePaths of the configured FASTA, building them if
+    needed, or None if building failed. Without 'reference.cache_dir' the
+    configured FASTA and BWA index are used and completed where they are."""
+    ref_fa_file = config['reference']['fa_file']
+    cache_dir = config['reference'].get('cache_dir')
+    if not os.path.isfile(ref_fa_file):
+        logger_errors.error('%s does not exists!', ref_fa_file)
+        return None
+    profile = resources_zhengu_20180103.stage_profile(config, 'reference')
+    if cache_dir is None:
+        paths = ReferencePaths(ref_fa_file, config['alignment']['ref_index'],
+                               ref_fa_file + '.fai',
+                               os.path.splitext(ref_fa_file)[0] + '.dict', None)
+        if not any(is_stale(x, ref_fa_file) for x in
+                   [paths.fai_file, paths.dict_file] +
+                   [paths.bwa_index + x for x in BWA_INDEX_EXTENSIONS]):
+            return paths
+        with locked(ref_fa_file + '.lock', logger_process):
+            # another worker may have built them while this one was waiting
+            try:
+                returncode = index_in_place(paths, config['alignment']['software'],
+                                            config['sorting']['software'],
+                                            logger_process, logger_errors, profile)
+            except (OSError, ValueError) as error:
+                logger_errors.error('Cannot index the reference %s: %s', ref_fa_file,
+                                    error)
+                returncode = 1
+        if not returncode == 0:
+            print('Preparing the reference failed! Check the logging files.')
+            return None
+        return paths
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    digest = fasta_digest(ref_fa_file, cache_dir)
+    ref_dir = os.path.join(cache_dir, digest[:16])
+    paths = reference_paths(ref_dir, digest)
+    ready_file = os.path.join(ref_dir, 'ready.json')
+    if os.path.isfile(ready_file):
+        return paths
+    with locked(ref_dir + '.lock', logger_process):
+        # another worker may have finished while this one was waiting
+        if os.path.isfile(ready_file):
+            return paths
+        logger_process.info('Preparing the reference %s in %s.', ref_fa_file, ref_dir)
+        shutil.rmtree(ref_dir, ignore_errors=True)
+        os.makedirs(ref_dir)
+        try:
+            returncode = build_reference(ref_fa_file, ref_dir,
+                                         config['alignment']['software'],
+                                         config['sorting']['software'],
+                                         logger_process, logger_errors, profile)
+        except (OSError, ValueError) as error:
+            logger_errors.error('Cannot prepare the reference %s: %s', ref_fa_file,
+                                error)
+            returncode = 1
+        if not returncode == 0:
+            shutil.rmtree(ref_dir, ignore_errors=True)
+            print('Preparing the reference failed! Check the logging files.')
+            return None
+        with open(ready_file, 'w') as f:
+            json.dump({'source': os.path.abspath(ref_fa_file), 'sha1': digest,
+                       'built': time.time()}, f, indent=1)
+    return paths
+
+def apply_reference(config, paths):
+    """Point the configuration of all stages at the prepared reference."""
+    config['reference']['fa_file'] = paths.fa_file
+    config['alignment']['ref_index'] = paths.bwa_index
+    return config
+
+def main():
+    with open('configure.yaml') as yamlfile:
+        config = yaml.safe_load(yamlfile)
+    cache_dir = config['reference'].get('cache_dir')
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        print('No reference cache is configured or built yet.')
+        return 1
+    for name in sorted(os.listdir(cache_dir)):
+        ready_file = os.path.join(cache_dir, name, 'ready.json')
+        if os.path.isfile(ready_file):
+            with open(ready_file) as f:
+                ready = json.load(f)
+            print('{0}  {1}  {2}'.format(name, time.ctime(ready['built']),
+                                         ready['source']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
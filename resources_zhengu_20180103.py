@@ -0,0 +1,222 @@
+#!/user/bin/env python3
+
+"""Resource profiles of the Java tools, per stage and per library.
+
+Every Picard and GATK command is built from the profile of its stage: the
+JVM heap, the number of parallel GC threads and the temp directory, the GATK
+threading (-nct for BaseRecalibrator, PrintReads and HaplotypeCaller, -nt
+for GenotypeGVCFs) and Picard's MAX_RECORDS_IN_RAM and COMPRESSION_LEVEL.
+The profile of a stage is 'resources.default', updated by
+'resources.stages.<stage>' and then by 'resources.libraries.<library>.<stage>'.
+The scheduler sizes its tasks from the same profiles. A stage scattered
+over interval shards runs no more shard JVMs at once, and gives each no more
+threads and heap, than the cores and memory its task was granted.
+
+The profiling mode runs the sort, BQSR and calling stages of one library
+once per setting of the 'resources.profiling' grid and reports the fastest
+profile of every stage. It overwrites the outputs of that library, so run it
+on a library whose alignment is in the shared alignment directory.
+
+ Usage::
+     $ python3 resources_zhengu_20180103.py show [library]
+     $ python3 resources_zhengu_20180103.py profile <library> [stage ...]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import copy
+import time
+import itertools
+import contextvars
+import yaml
+
+import sample_sheet_zhengu_20180103
+
+STAGES = ['reference', 'align', 'sort', 'bqsr', 'bqsr_qc', 'call', 'combine', 'join']
+PROFILED_STAGES = ['sort', 'bqsr', 'call']
+DEFAULT_PROFILE = {'heap_gb': 4, 'gc_threads': 1, 'tmp_dir': None, 'threads': 1,
+                   'max_records_in_ram': None, 'compression_level': None}
+DEFAULT_GRID = {'heap_gb': [2, 4, 8], 'threads': [1, 2, 4]}
+# the GATK 3 walkers which can use more than one thread, and how
+GATK_THREADING = {'BaseRecalibrator': '-nct', 'PrintReads': '-nct',
+                  'HaplotypeCaller': '-nct', 'GenotypeGVCFs': '-nt'}
+# (cores, memory_gb) granted to the running task by the scheduler or a worker
+reservation = contextvars.ContextVar('reservation', default=None)
+
+def stage_profile(config, stage, library=None):
+    """The resource profile of 'stage', for 'library' if given."""
+    resources = config.get('resources') or {}
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(resources.get('default') or {})
+    profile.update((resources.get('stages') or {}).get(stage) or {})
+    if library is not None:
+        profile.update(((resources.get('libraries') or {}).get(library) or {}).get(stage)
+                       or {})
+    if profile['tmp_dir'] is not None and not os.path.exists(profile['tmp_dir']):
+        os.makedirs(profile['tmp_dir'], exist_ok=True)
+    return profile
+
+def jvm_memory_gb(config, profile):
+    """Memory of one JVM of the profile: the heap and the off-heap overhead."""
+    return profile['heap_gb'] + config.get('scheduler', {}).get('jvm_overhead_gb', 1)
+
+def reserved_resources(config):
+    """The cores and memory of the running task, or of the node when a script
+    runs on its own."""
+    if reservation.get() is not None:
+        return reservation.get()
+    scheduler = config.get('scheduler', {})
+    return scheduler.get('cores', os.cpu_count()), scheduler.get('memory_gb', 16)
+
+def run_reserved(resources, function, *args):
+    """Call 'function' with (cores, memory_gb) as the reservation, so that
+    the stages it runs size their JVMs from that share only."""
+    token = reservation.set(resources)
+    try:
+        return function(*args)
+    finally:
+        reservation.reset(token)
+
+def shard_resources(config, profile, n_shards):
+    """The number of shards to run at once and the profile of every shard
+    JVM, so that together they fit the reserved cores and memory."""
+    cores, memory_gb = reserved_resources(config)
+    overhead_gb = jvm_memory_gb(config, profile) - profile['heap_gb']
+    n_parallel = max(1, min(n_shards, int(cores),
+                            int(memory_gb // jvm_memory_gb(config, profile))))
+    shard_profile = dict(profile)
+    shard_profile['threads'] = max(1, min(profile['threads'], int(cores) // n_parallel))
+    shard_profile['heap_gb'] = max(1, min(profile['heap_gb'],
+                                          memory_gb / n_parallel - overhead_gb))
+    return n_parallel, shard_profile
+
+def java_args(jar, profile=None, main_class=None):
+    """The 'java' command line of 'jar' as a list, running 'main_class' from
+    the class path instead of the jar's main class if given."""
+    args = ['java']
+    if profile is not None:
+        args.append('-Xmx{0}m'.format(int(profile['heap_gb'] * 1024)))
+        if profile['gc_threads']:
+            args.append('-XX:ParallelGCThreads={0}'.format(profile['gc_threads']))
+        if profile['tmp_dir'] is not None:
+            args.append('-Djava.io.tmpdir=' + profile['tmp_dir'])
+    if main_class is not None:
+        return args + ['-cp', jar, main_class]
+    return args + ['-jar', jar]
+
+def java_command(jar, profile=None, main_class=None):
+    return ' '.join(java_args(jar, profile, main_class))
+
+def picard_args(profile=None):
+    """The options every Picard tool accepts."""
+    if profile is None:
+        return []
+    args = []
+    if profile['tmp_dir'] is not None:
+        args.append('TMP_DIR=' + profile['tmp_dir'])
+    if profile['max_records_in_ram'] is not None:
+        args.append('MAX_RECORDS_IN_RAM={0}'.format(profile['max_records_in_ram']))
+    if profile['compression_level'] is not None:
+        args.append('COMPRESSION_LEVEL={0}'.format(profile['compression_level']))
+    return args
+
+def picard_options(profile=None):
+    return ''.join(' ' + x for x in picard_args(profile))
+
+def gatk_options(tool, profile=None):
+    """The threading and BAM compression options of a GATK 3 walker."""
+    if profile is None:
+        return ''
+    options = ''
+    if profile['threads'] > 1 and tool in GATK_THREADING:
+        options += ' {0} {1}'.format(GATK_THREADING[tool], profile['threads'])
+    if profile['compression_level'] is not None and tool == 'PrintReads':
+        options += ' --bam_compression {0}'.format(profile['compression_level'])
+    return options
+
+def profile_grid(config):
+    """All combinations of the settings of 'resources.profiling.grid'."""
+    grid = (config.get('resources') or {}).get('profiling', {}).get('grid', DEFAULT_GRID)
+    keys = sorted(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+def profile_stages(config, library, stages=None):
+    """Time every stage of 'stages' for 'library' with every profile of the
+    grid, and return {stage: [(seconds, profile), ...]} sorted by time. A
+    failed run is reported with time None."""
+    # the stage functions import this module, so they are imported here
+    import germline_variant_calling_GATK_zhengu_20180103 as germline
+    log_dir = config['logging']
+    loggers = germline.store_logs(log_dir)
+    stage_functions = {'sort': (germline.sort_library, loggers[:2]),
+                       'bqsr': (germline.recalibrate_library, loggers[2:]),
+                       'call': (germline.call_library, loggers[2:])}
+    repeats = (config.get('resources') or {}).get('profiling', {}).get('repeats', 1)
+    results = {}
+    for stage in stages or PROFILED_STAGES:
+        function, stage_loggers = stage_functions[stage]
+        results[stage] = []
+        for candidate in profile_grid(config):
+            trial_config = copy.deepcopy(config)
+            # every run has to execute and leave its outputs for the next stage
+            trial_config.setdefault('cache', {})['enabled'] = False
+            trial_config.setdefault('scratch', {})['enabled'] = False
+            # the plan was compiled for the scratch directories
+            trial_config.pop('plan', None)
+            resources = trial_config.setdefault('resources', {})
+            resources.setdefault('stages', {})[stage] = dict(
+                (resources.get('stages') or {}).get(stage) or {}, **candidate)
+            resources.pop('libraries', None)
+            seconds = 0.0
+            for _ in range(repeats):
+                time_start = time.time()
+                returncode = function(trial_config, library, *stage_loggers)
+                seconds += time.time() - time_start
+                if returncode:
+                    seconds = None
+                    break
+            if seconds is not None:
+                seconds /= repeats
+            results[stage].append((seconds, candidate))
+            print('{0:<8}{1:<48}{2}'.format(stage, str(candidate), 'failed'
+                                            if seconds is None
+                                            else '{0:.1f} s'.format(seconds)))
+        results[stage].sort(key=lambda x: float('inf') if x[0] is None else x[0])
+    return results
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    if len(sys.argv) > 2 and sys.argv[1] == 'profile':
+        import reference_zhengu_20180103
+        import germline_variant_calling_GATK_zhengu_20180103 as germline
+        logger_process, logger_errors = germline.store_logs(config['logging'])[:2]
+        reference = reference_zhengu_20180103.prepare_reference(config, logger_process,
+                                                                logger_errors)
+        if reference is None:
+            return 1
+        reference_zhengu_20180103.apply_reference(config, reference)
+        results = profile_stages(config, sys.argv[2], sys.argv[3:])
+        fastest = {stage: runs[0][1] for stage, runs in results.items()
+                   if runs and runs[0][0] is not None}
+        print('Fastest profiles of {0}:'.format(sys.argv[2]))
+        print(yaml.safe_dump({'resources': {'stages': fastest}},
+                             default_flow_style=False), end='')
+        return 0 if len(fastest) == len(results) else 1
+    if len(sys.argv) > 1 and sys.argv[1] != 'show':
+        print(__doc__)
+        return 1
+    library = sys.argv[2] if len(sys.argv) > 2 else None
+    for stage in STAGES:
+        profile = stage_profile(config, stage, library)
+        print('{0:<12}{1}'.format(stage, java_command('<jar>', profile) +
+                                  picard_options(profile) +
+                                  ' threads={0}'.format(profile['threads'])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
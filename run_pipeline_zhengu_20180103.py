@@ -0,0 +1,250 @@
+#!/user/bin/env python3
+
+"""Run the whole pipeline for a cohort of libraries on one node.
+
+Each library goes through its own chain of stages (alignment, sorting &
+indexing, BQSR, HaplotypeCaller), and the GVCFs of all libraries are joined
+by GenotypeGVCFs at the end. The stages are executed by a pool of workers
+which never exceeds the core and memory budget of the node, so library N+1
+can be aligned while library N is still in HaplotypeCaller. A failing library
+only cancels its own downstream stages; the joint genotyping runs over the
+libraries that succeeded. With scratch staging, a library holds its share of
+the scratch budget from its alignment until its last stage, which limits the
+number of libraries staged at once.
+
+ Usage::
+     $ python3 run_pipeline_zhengu_20180103.py [library ...]
+
+ :param library: keys of 'input_data.libraries' in configure.yaml, all of
+                 them by default
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import align_reads_zhengu_20180103
+import germline_variant_calling_GATK_zhengu_20180103
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import resources_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import scratch_zhengu_20180103
+import shell_command_zhengu_20180103
+import trace_zhengu_20180103
+import work_queue_zhengu_20180103
+
+class Task(object):
+    def __init__(self, name, library, function, cores, memory_gb, deps=(),
+                 require_all=True):
+        self.name = name
+        self.library = library
+        self.function = function
+        self.cores = cores
+        self.memory_gb = memory_gb
+        self.deps = list(deps)
+        # a fan-in task with require_all=False runs on whatever succeeded
+        self.require_all = require_all
+        # scratch space held by the library from this task on
+        self.scratch_gb = 0
+        self.state = 'pending'
+        self.returncode = None
+        self.time_start = None
+        self.time_end = None
+
+class ResourceBudget(object):
+    def __init__(self, cores, memory_gb, scratch_gb=None):
+        self.cores = cores
+        self.memory_gb = memory_gb
+        self.scratch_gb = scratch_gb
+        self.free_cores = cores
+        self.free_memory_gb = memory_gb
+        self.free_scratch_gb = scratch_gb
+        self.lock = threading.Lock()
+
+    def clamp(self, task):
+        # a task larger than the node would never be scheduled
+        task.cores = min(task.cores, self.cores)
+        task.memory_gb = min(task.memory_gb, self.memory_gb)
+        if self.scratch_gb is not None:
+            task.scratch_gb = min(task.scratch_gb, self.scratch_gb)
+
+    def try_acquire(self, task):
+        with self.lock:
+            if task.cores <= self.free_cores and task.memory_gb <= self.free_memory_gb \
+                    and (self.scratch_gb is None or task.scratch_gb <= self.free_scratch_gb):
+                self.free_cores -= task.cores
+                self.free_memory_gb -= task.memory_gb
+                if self.scratch_gb is not None:
+                    self.free_scratch_gb -= task.scratch_gb
+                return True
+            return False
+
+    def release(self, task):
+        with self.lock:
+            self.free_cores += task.cores
+            self.free_memory_gb += task.memory_gb
+
+    def release_scratch(self, scratch_gb):
+        with self.lock:
+            if self.scratch_gb is not None:
+                self.free_scratch_gb += scratch_gb
+
+def build_task_graph(config, libraries, loggers):
+    """The tasks of work_queue_zhengu_20180103.task_definitions, run in this
+    process."""
+    tasks = {}
+    call_tasks = []
+    for definition in work_queue_zhengu_20180103.task_definitions(config, libraries):
+        if definition['stage'] == 'join':
+            function = lambda: work_queue_zhengu_20180103.run_stage_task(
+                config, 'join', 'cohort', loggers,
+                [task.library for task in call_tasks if task.state == 'done'])
+        else:
+            function = lambda d=definition: work_queue_zhengu_20180103.run_stage_task(
+                config, d['stage'], d['library'], loggers)
+        task = Task(definition['stage'], definition['library'], function,
+                    definition['cores'], definition['memory_gb'],
+                    deps=[tasks[x] for x in definition['deps']],
+                    require_all=definition['require_all'])
+        task.scratch_gb = definition['scratch_gb']
+        tasks[definition['task_id']] = task
+        if definition['stage'] == 'call':
+            call_tasks.append(task)
+    return list(tasks.values())
+
+def run_task(task):
+    task.time_start = time.time()
+    # the sharded stages size their JVMs from what the task was granted
+    token = resources_zhengu_20180103.reservation.set((task.cores, task.memory_gb))
+    try:
+        returncode = task.function()
+    except Exception:
+        logging.getLogger('Errors of Pipeline Scheduler').exception(
+            'Stage %s of %s raised an exception.', task.name, task.library)
+        returncode = 1
+    finally:
+        resources_zhengu_20180103.reservation.reset(token)
+    task.time_end = time.time()
+    # the stage functions return None or 0 on success
+    return returncode or 0
+
+def run_task_graph(tasks, budget, logger_process, logger_errors):
+    """Dispatch the tasks whose dependencies are met and whose resources fit
+    the budget. Downstream stages are preferred so that started libraries
+    finish first and release their intermediates."""
+    for task in tasks:
+        budget.clamp(task)
+    running = {}
+    scratch_held = {}
+    with ThreadPoolExecutor(max_workers=max(budget.cores, 1)) as executor:
+        while True:
+            for task in tasks:
+                if task.state != 'pending':
+                    continue
+                dep_states = [dep.state for dep in task.deps]
+                if any(state in ('pending', 'running') for state in dep_states):
+                    continue
+                if task.deps and (
+                        (task.require_all and any(s != 'done' for s in dep_states)) or
+                        (not task.require_all and 'done' not in dep_states)):
+                    task.state = 'skipped'
+                    logger_errors.error('Skip stage %s of %s after upstream failure.',
+                                        task.name, task.library)
+            ready = [task for task in tasks if task.state == 'pending' and
+                     all(dep.state in ('done', 'failed', 'skipped') for dep in task.deps)]
+            ready.sort(key=lambda task: -work_queue_zhengu_20180103.stage_rank(task.name))
+            for task in ready:
+                if budget.try_acquire(task):
+                    task.state = 'running'
+                    if task.scratch_gb:
+                        scratch_held[task.library] = task.scratch_gb
+                    logger_process.info('Start stage %s of %s with %d cores and %s GB.',
+                                        task.name, task.library, task.cores,
+                                        task.memory_gb)
+                    running[executor.submit(run_task, task)] = task
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                budget.release(task)
+                task.returncode = future.result()
+                if task.returncode == 0:
+                    task.state = 'done'
+                    logger_process.info('Finished stage %s of %s after %.1f min.',
+                                        task.name, task.library,
+                                        (task.time_end - task.time_start) / 60)
+                else:
+                    task.state = 'failed'
+                    logger_errors.error('Stage %s of %s returns non-zero value %d.',
+                                        task.name, task.library, task.returncode)
+            for library in list(scratch_held):
+                if all(task.state in ('done', 'failed', 'skipped') for task in tasks
+                       if task.library == library):
+                    budget.release_scratch(scratch_held.pop(library))
+    return tasks
+
+def store_logs(log_dir):
+    formatter_process = logging.Formatter("%(asctime)s;%(message)s")
+    formatter_errors = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
+    logger_process = align_reads_zhengu_20180103.setup_logger(
+        'Pipeline Scheduler', log_dir + '/pipeline_process.log', formatter_process)
+    logger_errors = align_reads_zhengu_20180103.setup_logger(
+        'Errors of Pipeline Scheduler', log_dir + '/pipeline_errors.log',
+        formatter_errors)
+    return logger_process, logger_errors
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    log_dir = config['logging']
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    logger_process, logger_errors = store_logs(log_dir)
+    trace_zhengu_20180103.configure_trace(config)
+    loggers = (align_reads_zhengu_20180103.store_logs(log_dir) +
+               germline_variant_calling_GATK_zhengu_20180103.store_logs(log_dir))
+
+    # prepared once here, before the libraries would wait on its lock
+    reference = reference_zhengu_20180103.prepare_reference(config, logger_process, 
+                                                            logger_errors)
+    if reference is None:
+        return 1
+    reference_zhengu_20180103.apply_reference(config, reference)
+    plan_zhengu_20180103.load_plan(config, logger_process)
+
+    libraries = sys.argv[1:] or list(config['input_data']['libraries'])
+    unknown = [x for x in libraries if x not in config['input_data']['libraries']]
+    if unknown:
+        logger_errors.error('Unknown libraries: %s', ', '.join(unknown))
+        print('Unknown libraries: {0}'.format(', '.join(unknown)))
+        return 1
+    scheduler = config.get('scheduler', {})
+    budget = ResourceBudget(scheduler.get('cores', os.cpu_count()),
+                            scheduler.get('memory_gb', 16),
+                            config['scratch'].get('budget_gb')
+                            if scratch_zhengu_20180103.is_enabled(config) else None)
+    time_start = time.time()
+    try:
+        tasks = run_task_graph(build_task_graph(config, libraries, loggers), budget,
+                               logger_process, logger_errors)
+    except KeyboardInterrupt:
+        # stop the running tools instead of leaving them orphaned
+        shell_command_zhengu_20180103.cancel_all()
+        raise
+    time_run = (time.time() - time_start) / 60
+    for task in tasks:
+        print('{0:<12}{1:<24}{2}'.format(task.name, str(task.library), task.state))
+    print('Finish pipeline for {0} libraries after {1} min.'.format(len(libraries),
+                                                                   str(time_run)))
+    return 0 if all(task.state == 'done' for task in tasks) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
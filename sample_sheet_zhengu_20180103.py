@@ -0,0 +1,125 @@
+#!/user/bin/env python3
+
+"""Load configure.yaml and the libraries of a flowcell from a sample sheet.
+
+The libraries are listed either as nested YAML under 'input_data.libraries'
+or, for a whole flowcell, in a tab- or comma-separated sample sheet named by
+'input_data.sample_sheet', with one row per library and the columns
+
+    library  location  library_id  sample_name  read1  read2
+
+which mean the same as the keys of the YAML entries. Either way the entries
+are validated once, when the configuration is loaded: every column must be
+filled in, and neither a library nor a sample name may appear twice, as the
+output files are named after the sample.
+
+Lifting over to genomic coordinates is limited to the variant calls
+('snv_calling.lift_over'). The BAM stays on the amplicon reference, which
+BQSR, the calling and the joining use, so 'alignment.lift_over' is rejected.
+The chromosome order and lengths of the lifted calls are taken from the
+genome .fai of 'snv_calling.genome_fai'; without it the lengths are the
+largest amplicon stops.
+
+ Usage::
+     $ python3 sample_sheet_zhengu_20180103.py [configure.yaml]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import csv
+import yaml
+
+COLUMNS = ['library', 'location', 'library_id', 'sample_name', 'read1', 'read2']
+MAX_REPORTED = 20
+
+def read_sample_sheet(sheet_file):
+    """Return {library: entry} of a sample sheet and the list of its errors.
+    The delimiter is a comma for .csv files and a tab otherwise."""
+    delimiter = ',' if sheet_file.endswith('.csv') else '\t'
+    libraries = {}
+    errors = []
+    with open(sheet_file, newline='') as sheet:
+        reader = csv.DictReader((line for line in sheet if not line.startswith('#')),
+                                delimiter=delimiter)
+        missing = [x for x in COLUMNS if x not in (reader.fieldnames or [])]
+        if missing:
+            return {}, ['{0}: missing columns {1}'.format(sheet_file, ','.join(missing))]
+        for i, row in enumerate(reader, 2):
+            library = (row['library'] or '').strip()
+            if library in libraries:
+                errors.append('{0}:{1}: library {2} is listed twice'.format(
+                    sheet_file, i, library))
+                continue
+            entry = {key: (row[key] or '').strip() for key in COLUMNS[1:]}
+            entry['row'] = i
+            libraries[library] = entry
+    return libraries, errors
+
+def validate_libraries(libraries, source):
+    """The errors of the library entries, as a list of messages."""
+    errors = []
+    samples = {}
+    for library, entry in libraries.items():
+        where = '{0}:{1}'.format(source, entry['row']) if 'row' in entry else source
+        if not library:
+            errors.append('{0}: a library has no name'.format(where))
+        empty = [key for key in COLUMNS[1:] if not entry.get(key)]
+        if empty:
+            errors.append('{0}: library {1} has no {2}'.format(where, library,
+                                                               ','.join(empty)))
+            continue
+        if entry['read1'] == entry['read2']:
+            errors.append('{0}: library {1} has the same read1 and read2'.format(
+                where, library))
+        if entry['sample_name'] in samples:
+            errors.append('{0}: libraries {1} and {2} share the sample name {3}'.format(
+                where, samples[entry['sample_name']], library, entry['sample_name']))
+        samples[entry['sample_name']] = library
+    return errors
+
+def load_config(config_file='configure.yaml'):
+    """Read the configuration and fill 'input_data.libraries' from the sample
+    sheet if one is set. Returns None if the libraries are not valid."""
+    with open(config_file) as yamlfile:
+        config = yaml.safe_load(yamlfile)
+    sheet_file = config['input_data'].get('sample_sheet')
+    if sheet_file is not None:
+        if not os.path.isfile(sheet_file):
+            print('The sample sheet {0} does not exist!'.format(sheet_file))
+            return None
+        libraries, errors = read_sample_sheet(sheet_file)
+        config['input_data']['libraries'] = libraries
+        source = sheet_file
+    else:
+        errors = []
+        source = config_file
+    libraries = config['input_data'].get('libraries') or {}
+    config['input_data']['libraries'] = libraries
+    errors += validate_libraries(libraries, source)
+    if config.get('alignment', {}).get('lift_over', False):
+        errors.append('{0}: alignment.lift_over would move the BAM off the amplicon '
+                      'reference the downstream stages use, set snv_calling.lift_over '
+                      'to lift the variant calls over instead'.format(config_file))
+    genome_fai = config.get('snv_calling', {}).get('genome_fai')
+    if genome_fai is not None and not os.path.isfile(genome_fai):
+        errors.append('{0}: the genome .fai {1} of snv_calling.genome_fai does not '
+                      'exist'.format(config_file, genome_fai))
+    if errors:
+        for error in errors[:MAX_REPORTED]:
+            print(error)
+        if len(errors) > MAX_REPORTED:
+            print('... and {0} more errors.'.format(len(errors) - MAX_REPORTED))
+        return None
+    return config
+
+def main():
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else 'configure.yaml')
+    if config is None:
+        return 1
+    print('{0} libraries are valid.'.format(len(config['input_data']['libraries'])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/user/bin/env python3
+
+"""Stage the per-library intermediates on a local scratch directory.
+
+With 'scratch.enabled', every library works in <scratch_dir>/<library>/
+instead of the shared alignment directory: the SAM, the sorted BAM, the
+recalibration tables and BAM and the GVCF are written there. After each
+stage succeeds, its outputs listed as final ('scratch.final_outputs') are
+copied back to the shared directories, and every scratch file whose
+consumer stages have all succeeded is deleted. Which stages have succeeded
+is kept in a small state file per library, so that the separate scripts
+and the scheduler share it.
+
+ Usage::
+     $ python3 scratch_zhengu_20180103.py [show]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+
+import sample_sheet_zhengu_20180103
+
+FINAL_OUTPUTS = ['_recal.bam', '_recal.bai', '_raw_variants.g.vcf',
+                 '_raw_variants.g.vcf.idx', '_read_stats.tsv', '_coverage_qc.tsv',
+                 '_recal_plots.pdf']
+STATE_FILE = 'stages_done.json'
+
+def is_enabled(config):
+    return config.get('scratch', {}).get('enabled', False)
+
+def shared_align_dir(config):
+    return config['input_data']['input_dir'] + config['alignment']['output_dir']
+
+def shared_variants_dir(config):
+    return config['input_data']['input_dir'] + config['snv_calling']['output_dir']
+
+def work_dir(config, library, create=True):
+    """Directory of the intermediates of a library, on scratch if enabled."""
+    if not is_enabled(config):
+        return shared_align_dir(config)
+    path = os.path.join(config['scratch']['scratch_dir'], library) + '/'
+    if create and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+def variants_dir(config, library, create=True):
+    """Directory HaplotypeCaller writes the GVCF of a library to."""
+    return work_dir(config, library, create) if is_enabled(config) \
+        else shared_variants_dir(config)
+
+def consumers(config):
+    """The stages reading each intermediate, by file suffix. Files without a
+    consumer are deleted as soon as their producer succeeds."""
+    sorted_bam_readers = ['bqsr']
+    if config['snv_calling'].get('bqsr_mode', 'full') == 'lean':
+        sorted_bam_readers.append('bqsr_qc')
+    if config.get('coverage_qc', {}).get('enabled', False):
+        sorted_bam_readers.append('coverage_qc')
+    table = {'_aligned.sam': ['sort'],
+             '_aligned_sorted.bam': sorted_bam_readers,
+             '_aligned_sorted.bai': sorted_bam_readers,
+             '_recal.table': ['bqsr_qc']
+             if config['snv_calling'].get('bqsr_mode', 'full') == 'lean' else [],
+             '_recal_post.table': [],
+             '_recal_plots.pdf': [],
+             '_recal.bam': ['call'],
+             '_recal.bai': ['call'],
+             '_raw_variants.g.vcf': [],
+             '_raw_variants.g.vcf.idx': [],
+             '_read_stats.tsv': [],
+             '_coverage_qc.tsv': []}
+    return table
+
+def publish_path(config, file_name):
+    name = os.path.basename(file_name)
+    if name.endswith('.g.vcf') or name.endswith('.g.vcf.idx'):
+        return shared_variants_dir(config) + name
+    return shared_align_dir(config) + name
+
+def update_state(state_dir, update):
+    """Apply 'update' to the set of succeeded stages of a library under a
+    file lock, and return the new set."""
+    state_file = os.path.join(state_dir, STATE_FILE)
+    with open(state_file + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        done = set()
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                done = set(json.load(f))
+        update(done)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(sorted(done), f)
+        os.replace(state_file + '.tmp', state_file)
+    return done
+
+def after_stage(config, stage, library, outputs, release=None, logger_process=None):
+    """Publish the final outputs of a succeeded stage and delete the scratch
+    files no stage needs any more. 'release' deletes a file on behalf of the
+    stage cache, which keeps its fingerprint valid."""
+    if not is_enabled(config) or library not in config['input_data']['libraries']:
+        return 0
+    sample_name = config['input_data']['libraries'][library]['sample_name']
+    library_dir = work_dir(config, library)
+    final_outputs = config['scratch'].get('final_outputs', FINAL_OUTPUTS)
+    table = consumers(config)
+    for file_name in outputs:
+        suffix = os.path.basename(file_name)[len(sample_name):]
+        if suffix in final_outputs and os.path.isfile(file_name) and \
+                file_name.startswith(library_dir):
+            target = publish_path(config, file_name)
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(file_name, target)
+            if logger_process is not None:
+                logger_process.info('Copied %s back to %s.', file_name, target)
+
+    def mark(done):
+        # a re-run producer invalidates its consumers
+        for file_name in outputs:
+            suffix = os.path.basename(file_name)[len(sample_name):]
+            done.difference_update(table.get(suffix, []))
+        done.add(stage)
+    done = update_state(library_dir, mark)
+
+    for suffix, readers in table.items():
+        file_name = library_dir + sample_name + suffix
+        if os.path.isfile(file_name) and all(reader in done for reader in readers):
+            if release is not None:
+                release(file_name)
+            else:
+                os.remove(file_name)
+            if logger_process is not None:
+                logger_process.info('Removed the intermediate %s.', file_name)
+    return 0
+
+def library_scratch_gb(config):
+    return config.get('scratch', {}).get('library_gb', 20)
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    if not is_enabled(config):
+        print('Scratch staging is disabled.')
+        return 1
+    scratch_dir = config['scratch']['scratch_dir']
+    for library in sorted(config['input_data']['libraries']):
+        library_dir = os.path.join(scratch_dir, library)
+        if not os.path.isdir(library_dir):
+            continue
+        n_bytes = sum(os.path.getsize(os.path.join(library_dir, x))
+                      for x in os.listdir(library_dir)
+                      if os.path.isfile(os.path.join(library_dir, x)))
+        done = []
+        if os.path.isfile(os.path.join(library_dir, STATE_FILE)):
+            with open(os.path.join(library_dir, STATE_FILE)) as f:
+                done = json.load(f)
+        print('{0:<24}{1:>10.2f} GB  {2}'.format(library, n_bytes / (1 << 30),
+                                                ','.join(done)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#!/user/bin/env python3
+
+"""Run the external tools of the pipeline (bwa, Picard, GATK).
+
+stdout and stderr of every process are streamed line by line into the process
+logger while the tool is running, through bounded line buffers. The last
+lines of stderr are kept and copied to the error logger if the tool fails.
+Each command may be given a timeout and can be cancelled. When a process
+exits, its wall time, CPU time, peak resident memory and I/O volume are
+collected from wait4() and /proc, and returned with the exit code.
+
+The stage and library a command belongs to, its timeout and its cancel event
+are taken from the surrounding command_context(), so that the stage functions
+keep their plain run_shell_command() calls.
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import time
+import shlex
+import signal
+import threading
+import subprocess
+import contextlib
+import contextvars
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import trace_zhengu_20180103
+
+MAX_LINE_BYTES = 1 << 16
+TAIL_LINES = 20
+POLL_SECONDS = 0.05
+KILL_GRACE_SECONDS = 10
+
+CommandResult = namedtuple('CommandResult', [
+    'command', 'returncode', 'time_start', 'wall_time', 'cpu_time', 'max_rss_kb',
+    'read_bytes', 'write_bytes', 'timed_out', 'cancelled', 'stderr_tail'])
+
+current_context = contextvars.ContextVar('command_context', default={})
+cancel_all_event = threading.Event()
+
+@contextlib.contextmanager
+def command_context(config=None, stage=None, library=None, timeout=None,
+                    cancel_event=None):
+    """Label the commands run inside the block with their stage and library.
+    Without an explicit timeout, the one of 'timeouts.<stage>' in the
+    configuration applies."""
+    if timeout is None and config is not None:
+        timeout = config.get('timeouts', {}).get(stage)
+    context = dict(current_context.get())
+    context.update({key: value for key, value in [
+        ('stage', stage), ('library', library), ('timeout', timeout),
+        ('cancel_event', cancel_event)] if value is not None})
+    token = current_context.set(context)
+    try:
+        yield context
+    finally:
+        current_context.reset(token)
+
+def map_in_context(function, items, max_workers):
+    """Like ThreadPoolExecutor.map, but the workers see the command context
+    of the caller."""
+    items = list(items)
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        return list(pool.map(lambda context, item: context.run(function, item),
+                             contexts, items))
+
+def cancel_all():
+    cancel_all_event.set()
+
+def log_stream(stream, log, tail=None):
+    for line in iter(lambda: stream.readline(MAX_LINE_BYTES), b''):
+        line = line.decode(errors='replace').rstrip()
+        log(line)
+        if tail is not None:
+            tail.append(line)
+    stream.close()
+
+def read_proc_io(pid):
+    io_counters = {}
+    try:
+        with open('/proc/{0}/io'.format(pid)) as f:
+            for row in f:
+                key, value = row.split(':')
+                io_counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io_counters.get('rchar', 0), io_counters.get('wchar', 0)
+
+def reap(process):
+    """Reap an exited process with wait4() to collect its resource usage. The
+    I/O counters are read first, while the process is still a zombie."""
+    read_bytes, write_bytes = read_proc_io(process.pid)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return (time.time(), rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss,
+            read_bytes, write_bytes)
+
+def has_exited(process):
+    try:
+        info = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+    except ChildProcessError:
+        return True
+    return info is not None
+
+def run_pipe(commands, logger_process, logger_errors, stdout=None, timeout=None,
+             cancel_event=None):
+    """Chain the commands through OS pipes, the stdout of the last one goes to
+    the file object 'stdout' or to the process logger. Returns one
+    CommandResult per command, in the order of 'commands'."""
+    context = current_context.get()
+    timeout = timeout if timeout is not None else context.get('timeout')
+    cancel_event = cancel_event or context.get('cancel_event')
+    commands = [shlex.split(command) if isinstance(command, str) else command
+                for command in commands]
+    logger_process.info(' | '.join(' '.join(command) for command in commands))
+
+    time_start = time.time()
+    processes = []
+    log_threads = []
+    tails = []
+    stdin = None
+    for i, command in enumerate(commands):
+        last = i == len(commands) - 1
+        try:
+            process = subprocess.Popen(command, stdin=stdin,
+                                       stdout=stdout if last and stdout is not None
+                                       else subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as error:
+            logger_errors.error('Cannot start %s: %s', command[0], error)
+            for started in processes:
+                started.kill()
+                reap(started)
+            return [CommandResult(' '.join(command), 127, time_start, 0, 0, 0, 0, 0, 
+                                  False, False, [str(error)]) for command in commands]
+        if stdin is not None:
+            # let the consumer own the read end so the producer receives
+            # SIGPIPE if the consumer dies
+            stdin.close()
+        stdin = process.stdout if not last else None
+        tail = deque(maxlen=TAIL_LINES)
+        tails.append(tail)
+        log_threads.append(threading.Thread(target=log_stream, args=(
+            process.stderr, logger_process.info, tail)))
+        if last and stdout is None:
+            log_threads.append(threading.Thread(target=log_stream, args=(
+                process.stdout, logger_process.info)))
+        processes.append(process)
+    for log_thread in log_threads:
+        log_thread.daemon = True
+        log_thread.start()
+
+    usage = [None] * len(processes)
+    timed_out = cancelled = False
+    while any(x is None for x in usage):
+        for i, process in enumerate(processes):
+            if usage[i] is None and has_exited(process):
+                usage[i] = reap(process)
+        if any(x is None for x in usage):
+            if not (timed_out or cancelled):
+                if timeout is not None and time.time() - time_start > timeout:
+                    timed_out = True
+                elif cancel_all_event.is_set() or (cancel_event is not None and
+                                                   cancel_event.is_set()):
+                    cancelled = True
+                if timed_out or cancelled:
+                    terminate(processes, usage)
+            time.sleep(POLL_SECONDS)
+    for log_thread in log_threads:
+        log_thread.join()
+
+    results = []
+    for command, process, tail, (time_end, cpu_time, max_rss_kb, read_bytes,
+                                 write_bytes) in zip(commands, processes, tails, usage):
+        wall_time = time_end - time_start
+        results.append(CommandResult(' '.join(command), process.returncode, time_start,
+                                     wall_time, cpu_time, max_rss_kb, read_bytes,
+                                     write_bytes, timed_out, cancelled, list(tail)))
+        logger_process.info('%s exited with %d after %.1f s, CPU %.1f s, peak RSS '
+                            '%.1f MB, read %d B, written %d B.', command[0],
+                            process.returncode, wall_time, cpu_time,
+                            max_rss_kb / 1024, read_bytes, write_bytes)
+        if process.returncode != 0 and tail:
+            logger_errors.error('%s exited with %d, the end of its stderr:\n%s',
+                                command[0], process.returncode, '\n'.join(tail))
+    if timed_out:
+        logger_errors.error('Killed %s after the timeout of %s s.', commands[0][0],
+                            timeout)
+    if cancelled:
+        logger_errors.error('Cancelled %s.', commands[0][0])
+    trace_zhengu_20180103.record_commands(results, context.get('stage'),
+                                          context.get('library'))
+    return results
+
+def terminate(processes, usage):
+    for i, process in enumerate(processes):
+        if usage[i] is None:
+            process.send_signal(signal.SIGTERM)
+    # escalate to SIGKILL for tools ignoring SIGTERM
+    def kill():
+        for i, process in enumerate(processes):
+            if usage[i] is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+    timer = threading.Timer(KILL_GRACE_SECONDS, kill)
+    timer.daemon = True
+    timer.start()
+
+def run_command(command_line, logger_process, logger_errors, stdout=None,
+                timeout=None, cancel_event=None):
+    return run_pipe([command_line], logger_process, logger_errors, stdout, timeout,
+                    cancel_event)[0]
+
+def run_shell_command(command_line, logger_process, logger_errors):
+    return run_command(command_line, logger_process, logger_errors).returncode
+
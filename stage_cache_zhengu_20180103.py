@@ -0,0 +1,472 @@
+#!/user/bin/env python3
+
+"""Checkpoint the pipeline stages so that re-runs skip unchanged work.
+
+Every stage is keyed on the fingerprints of its input files, of the tool
+binaries or jars, of the reference and known-sites files, and on the exact
+arguments which make up its command line. The key and the fingerprints of the
+produced outputs are recorded in an entry file of the stage in the cache
+directory. A stage whose key and outputs match its entry is skipped;
+otherwise the outputs of the stale entry are removed before the stage runs
+again. Every record is a file of its own, so a stage transition costs the
+same whether the cache holds ten libraries or thousands, and workers only
+contend on the files they share.
+
+Intermediate outputs (SAM, sorted BAM) may be evicted to keep the cache under
+a size budget. Their fingerprints are kept as 'released', so consumers that
+were already completed stay valid, and a consumer which does need to run
+again first regenerates the evicted file through its producer. A running
+stage holds a lease on its inputs in the cache, and an output is only
+evicted once no stage holds a lease on it and all stages reading it have
+completed since it was produced, whichever process runs them.
+
+ Usage::
+     $ python3 stage_cache_zhengu_20180103.py [show|evict <max_gb>]
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+import contextlib
+
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import scratch_zhengu_20180103
+import trace_zhengu_20180103
+
+HASH_BLOCK_BYTES = 1 << 20
+# a lease of another host is trusted for this long
+LEASE_HOURS = 24
+
+def fingerprint_file(file_name, content_hash=False):
+    if not os.path.isfile(file_name):
+        return None
+    stat = os.stat(file_name)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+                sha1.update(block)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+def lease_is_live(lease):
+    """A lease of a process on this host lasts while the process runs, one
+    of another host until it is LEASE_HOURS old."""
+    if lease['host'] == socket.gethostname():
+        try:
+            os.kill(lease['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return time.time() - lease['since'] < LEASE_HOURS * 3600
+
+def has_pending_consumer(entries, entry, consumer_names):
+    """Whether a stage reading the outputs of 'entry' has not completed
+    since 'entry' did. 'entries' maps entry names to entries."""
+    for consumer_name in consumer_names:
+        consumer = entries.get(consumer_name)
+        if consumer is None or consumer['completed'] < entry['completed']:
+            return True
+    return False
+
+def path_digest(name):
+    return hashlib.sha1(name.encode()).hexdigest()
+
+def write_json(path, data):
+    """Replace 'path' atomically, readers never see a partial file."""
+    tmp_file = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+class StageCache(object):
+    """The records of the cache are small files, so that no update reads or
+    rewrites more than the entry or file it concerns:
+
+     * entries/<library>/<stage>.json, the key and outputs of a stage;
+     * files/<xx>/<sha1 of path>.json, the producer of an output and, once
+       it is released, its fingerprint;
+     * leases/<sha1 of path>/<sha1 of token>.json, a lease on an input.
+
+    The file records and leases of a path are changed under one of
+    LOCK_STRIPES lock files chosen by the path, so leasing and evicting the
+    same file exclude each other while unrelated files never contend."""
+    LOCK_STRIPES = 256
+
+    def __init__(self, cache_dir, content_hash=False, max_intermediate_bytes=None):
+        self.cache_dir = cache_dir
+        self.content_hash = content_hash
+        self.max_intermediate_bytes = max_intermediate_bytes
+        self.lock = threading.Lock()
+        # the leased files of the leases held by this process
+        self.leases = {}
+        # producers seen in this run, used to regenerate evicted inputs
+        self.producers = {}
+        # runs a producer stage of another process, set by run_stage
+        self.run_producer = None
+        for name in ['entries', 'files', 'leases', 'locks']:
+            os.makedirs(os.path.join(cache_dir, name), exist_ok=True)
+
+    def entry_file(self, entry_name):
+        stage, library = entry_name.split(':', 1)
+        return os.path.join(self.cache_dir, 'entries', library.replace(os.sep, '_'),
+                            stage.replace(os.sep, '_') + '.json')
+
+    def file_record(self, file_name):
+        digest = path_digest(file_name)
+        return os.path.join(self.cache_dir, 'files', digest[:2], digest + '.json')
+
+    def lease_dir(self, file_name):
+        return os.path.join(self.cache_dir, 'leases', path_digest(file_name))
+
+    def locked(self, names):
+        """Hold the stripe locks of 'names', taken in a fixed order."""
+        stripes = sorted(set(int(path_digest(x)[:8], 16) % self.LOCK_STRIPES
+                             for x in names))
+        stack = contextlib.ExitStack()
+        for stripe in stripes:
+            stack.enter_context(reference_zhengu_20180103.locked(os.path.join(
+                self.cache_dir, 'locks', '{0:03d}.lock'.format(stripe))))
+        return stack
+
+    def load_entry(self, entry_name):
+        return read_json(self.entry_file(entry_name))
+
+    def load_entries(self):
+        """{entry name: entry} of all stages, read without any lock."""
+        entries = {}
+        entries_dir = os.path.join(self.cache_dir, 'entries')
+        for library in os.listdir(entries_dir):
+            for file_name in os.listdir(os.path.join(entries_dir, library)):
+                if not file_name.endswith('.json'):
+                    continue
+                entry = read_json(os.path.join(entries_dir, library, file_name))
+                if entry is not None:
+                    entries[entry['name']] = entry
+        return entries
+
+    def write_entry(self, entry_name, entry):
+        entry_file = self.entry_file(entry_name)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        write_json(entry_file, entry)
+
+    def released(self, file_name):
+        """The fingerprint a released file had, or None."""
+        record = read_json(self.file_record(file_name))
+        return None if record is None else record['released']
+
+    def is_released(self, file_name):
+        return not os.path.isfile(file_name) and self.released(file_name) is not None
+
+    def fingerprint(self, file_name):
+        fingerprint = fingerprint_file(file_name, self.content_hash)
+        if fingerprint is None:
+            return self.released(file_name)
+        return fingerprint
+
+    def stage_key(self, inputs, tools, command):
+        fingerprints = []
+        for file_name in list(inputs) + list(tools):
+            fingerprint = self.fingerprint(file_name)
+            if fingerprint is not None and 'sha1' in fingerprint:
+                # with content hashes a touched but unchanged file still matches
+                fingerprint = {'size': fingerprint['size'], 'sha1': fingerprint['sha1']}
+            fingerprints.append((file_name, fingerprint))
+        # the command holds every argument which changes the outputs, the
+        # resource profile included
+        key_source = json.dumps([fingerprints, list(command)], sort_keys=True,
+                                default=str)
+        return hashlib.sha1(key_source.encode()).hexdigest()
+
+    def is_complete(self, entry, key):
+        if entry is None or entry['key'] != key:
+            return False
+        for file_name, recorded in entry['outputs'].items():
+            current = fingerprint_file(file_name) or self.released(file_name)
+            if current is None or current['size'] != recorded['size'] or \
+                    current['mtime'] != recorded['mtime']:
+                return False
+        return True
+
+    def invalidate(self, entry_name):
+        entry = self.load_entry(entry_name)
+        if entry is None:
+            return
+        with self.locked(entry['outputs']):
+            for file_name in entry['outputs']:
+                for path in [file_name, self.file_record(file_name)]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+        if os.path.isfile(self.entry_file(entry_name)):
+            os.remove(self.entry_file(entry_name))
+
+    def acquire(self, entry_name, inputs):
+        """Lease the inputs of a stage while it runs. Returns the lease token."""
+        token = '{0}@{1}:{2}:{3}'.format(entry_name, socket.gethostname(), os.getpid(),
+                                         threading.get_ident())
+        lease = {'token': token, 'host': socket.gethostname(), 'pid': os.getpid(),
+                 'since': time.time()}
+        for file_name in inputs:
+            # one file at a time, an eviction only needs the lock of its files
+            with self.locked([file_name]):
+                os.makedirs(self.lease_dir(file_name), exist_ok=True)
+                write_json(os.path.join(self.lease_dir(file_name),
+                                        path_digest(token) + '.json'), lease)
+        with self.lock:
+            self.leases[token] = list(inputs)
+        return token
+
+    def release_lease(self, token):
+        with self.lock:
+            inputs = self.leases.pop(token, [])
+        for file_name in inputs:
+            with self.locked([file_name]):
+                lease_file = os.path.join(self.lease_dir(file_name),
+                                          path_digest(token) + '.json')
+                if os.path.isfile(lease_file):
+                    os.remove(lease_file)
+                try:
+                    os.rmdir(self.lease_dir(file_name))
+                except OSError:
+                    pass
+
+    def is_leased(self, file_name):
+        """Whether a live lease holds 'file_name', dropping the dead ones. The
+        caller holds the lock of the file."""
+        lease_dir = self.lease_dir(file_name)
+        if not os.path.isdir(lease_dir):
+            return False
+        leased = False
+        for name in os.listdir(lease_dir):
+            lease = read_json(os.path.join(lease_dir, name)) if name.endswith('.json') \
+                else None
+            if lease is None:
+                continue
+            if lease_is_live(lease):
+                leased = True
+            else:
+                os.remove(os.path.join(lease_dir, name))
+        return leased
+
+    def run(self, stage, library, function, inputs, outputs, tools=(), command=(),
+            intermediate=False, logger_process=None, consumers=None):
+        """Run 'function' unless the stage is already complete with the same
+        key. Returns the return code of the stage, 0 for a cache hit.
+        'consumers' returns {file: [entry names of the stages reading it]}
+        and is only called for an eviction."""
+        entry_name = '{0}:{1}'.format(stage, library)
+        producer = lambda: self.execute(entry_name, function, inputs, outputs, tools,
+                                        command, intermediate, logger_process, consumers)
+        for file_name in outputs:
+            self.producers[file_name] = producer
+        token = self.acquire(entry_name, inputs)
+        try:
+            key = self.stage_key(inputs, tools, command)
+            entry = self.load_entry(entry_name)
+            if self.is_complete(entry, key):
+                if logger_process is not None:
+                    logger_process.info('Skip stage %s of %s, outputs are up to date.',
+                                        stage, library)
+                entry['last_used'] = time.time()
+                self.write_entry(entry_name, entry)
+                return 0
+            return producer()
+        finally:
+            self.release_lease(token)
+
+    def regenerate(self, file_name, logger_process=None):
+        """Produce an evicted input again, through its producer if it ran in
+        this process and through 'run_producer' otherwise. Concurrent
+        consumers wait for the first one to regenerate it."""
+        lock_file = os.path.join(self.cache_dir, 'regenerate_{0}.lock'.format(
+            path_digest(file_name)[:16]))
+        with reference_zhengu_20180103.locked(lock_file, logger_process):
+            record = read_json(self.file_record(file_name))
+            if os.path.isfile(file_name) or record is None or record['released'] is None:
+                return 0
+            if logger_process is not None:
+                logger_process.info('Regenerate the evicted input %s.', file_name)
+            if file_name in self.producers:
+                return self.producers[file_name]()
+            if record['producer'] is None or self.run_producer is None:
+                return 1
+            # its released fingerprints would make the producer a cache hit
+            self.invalidate(record['producer'])
+            stage, library = record['producer'].split(':', 1)
+            return self.run_producer(stage, library)
+
+    def execute(self, entry_name, function, inputs, outputs, tools, command,
+                intermediate, logger_process, consumers=None):
+        for file_name in inputs:
+            if self.is_released(file_name):
+                if self.regenerate(file_name, logger_process):
+                    return 1
+        self.invalidate(entry_name)
+        returncode = function()
+        if returncode:
+            return returncode
+        # the key is taken after the run, inputs may have been regenerated
+        key = self.stage_key(inputs, tools, command)
+        recorded_outputs = {}
+        for file_name in outputs:
+            fingerprint = fingerprint_file(file_name)
+            if fingerprint is not None:
+                recorded_outputs[file_name] = fingerprint
+        with self.locked(recorded_outputs):
+            for file_name in recorded_outputs:
+                record_file = self.file_record(file_name)
+                os.makedirs(os.path.dirname(record_file), exist_ok=True)
+                write_json(record_file, {'file': file_name, 'producer': entry_name,
+                                         'released': None})
+        self.write_entry(entry_name, {
+            'name': entry_name, 'key': key, 'outputs': recorded_outputs,
+            'intermediate': intermediate, 'completed': time.time(),
+            'last_used': time.time()})
+        if intermediate and self.max_intermediate_bytes is not None and \
+                consumers is not None:
+            self.evict(self.max_intermediate_bytes, consumers(), keep=entry_name)
+        return 0
+
+    def release_locked(self, file_name):
+        """Delete a file but keep its fingerprint valid. The caller holds the
+        lock of the file. Returns the bytes freed."""
+        fingerprint = fingerprint_file(file_name, self.content_hash)
+        if fingerprint is None:
+            return 0
+        record_file = self.file_record(file_name)
+        record = read_json(record_file) or {'file': file_name, 'producer': None}
+        record['released'] = fingerprint
+        os.makedirs(os.path.dirname(record_file), exist_ok=True)
+        write_json(record_file, record)
+        os.remove(file_name)
+        return fingerprint['size']
+
+    def release(self, file_name):
+        """Delete an intermediate output but keep its fingerprint valid."""
+        with self.locked([file_name]):
+            return self.release_locked(file_name)
+
+    def evict(self, max_bytes, consumers, keep=None):
+        """Release intermediate outputs, least recently used first, until
+        they take no more than 'max_bytes'. The outputs of an entry are kept
+        while a live lease holds one of them or a stage of 'consumers'
+        ({file: [entry names]}) still has to read them. The candidates are
+        chosen without any lock; the leases of an entry's outputs are checked
+        again under their locks right before deleting them, and a stage
+        leases its inputs under the same locks."""
+        entries = self.load_entries()
+        candidates = sorted(((entry['last_used'], entry_name, entry)
+                             for entry_name, entry in entries.items()
+                             if entry['intermediate']), key=lambda x: x[0])
+        total_bytes = sum(os.path.getsize(file_name) for _, _, entry in candidates
+                          for file_name in entry['outputs'] if os.path.isfile(file_name))
+        for _, entry_name, entry in candidates:
+            if total_bytes <= max_bytes:
+                break
+            if entry_name == keep or any(
+                    has_pending_consumer(entries, entry, consumers.get(file_name, []))
+                    for file_name in entry['outputs']):
+                continue
+            with self.locked(entry['outputs']):
+                if any(self.is_leased(file_name) for file_name in entry['outputs']):
+                    continue
+                for file_name in entry['outputs']:
+                    total_bytes -= self.release_locked(file_name)
+        return total_bytes
+
+caches = {}
+
+def get_cache(config):
+    """Return the shared StageCache described by the 'cache' section of the
+    configuration, or None if caching is disabled."""
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    cache_dir = cache_config.get('cache_dir', config['input_data']['input_dir'] + 'cache/')
+    if cache_dir not in caches:
+        max_gb = cache_config.get('max_intermediate_gb')
+        caches[cache_dir] = StageCache(
+            cache_dir, cache_config.get('content_hash', False),
+            None if max_gb is None else int(max_gb * (1 << 30)))
+    return caches[cache_dir]
+
+def consumer_entries(config):
+    """{file: [entry names of the stages reading it]} from the plan of all
+    libraries."""
+    consumers = {}
+    for library in config['input_data']['libraries']:
+        entry = plan_zhengu_20180103.library_plan(config, library)
+        for stage, files in entry['stages'].items():
+            for file_name in files['inputs']:
+                consumers.setdefault(file_name, []).append('{0}:{1}'.format(stage, library))
+    return consumers
+
+def run_producer_stage(config, stage, library):
+    """Run a stage of a library which another process produced, to
+    regenerate its evicted outputs."""
+    # the stage modules import this one
+    import work_queue_zhengu_20180103
+    loggers = tuple(logging.getLogger(name)
+                    for name in work_queue_zhengu_20180103.STAGE_LOGGERS)
+    return work_queue_zhengu_20180103.run_stage_task(config, stage, library, loggers)
+
+def run_stage(config, stage, library, function, inputs, outputs, tools=(),
+              command=(), intermediate=False, logger_process=None):
+    cache = get_cache(config)
+    with trace_zhengu_20180103.stage_span(stage, library, inputs, outputs) as span:
+        if cache is None:
+            returncode = function()
+        else:
+            def traced_function():
+                span['cached'] = False
+                return function()
+            span['cached'] = True
+            cache.run_producer = lambda producer_stage, producer_library: \
+                run_producer_stage(config, producer_stage, producer_library)
+            returncode = cache.run(stage, library, traced_function, inputs, outputs,
+                                   tools, command, intermediate, logger_process,
+                                   lambda: consumer_entries(config))
+        span['returncode'] = returncode
+    if returncode == 0:
+        scratch_zhengu_20180103.after_stage(config, stage, library, outputs,
+                                            cache.release if cache is not None else None,
+                                            logger_process)
+    return returncode
+
+def main():
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    config.setdefault('cache', {})['enabled'] = True
+    cache = get_cache(config)
+    if len(sys.argv) > 2 and sys.argv[1] == 'evict':
+        plan_zhengu_20180103.load_plan(config, write=False)
+        total_bytes = cache.evict(float(sys.argv[2]) * (1 << 30), consumer_entries(config))
+        print('Intermediate files in cache: {0:.2f} GB'.format(total_bytes / (1 << 30)))
+        return 0
+    for entry_name, entry in sorted(cache.load_entries().items()):
+        print('{0:<40}{1}  {2}'.format(entry_name, entry['key'][:12],
+                                       time.ctime(entry['completed'])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+import coverage_qc_zhengu_20180103 as coverage_qc
+
+
+@pytest.fixture(scope='module')
+def bam_file(tmp_path_factory):
+    bam_file = str(tmp_path_factory.mktemp('bam') / 'x.bam')
+    return coverage_qc.simulate_bam(bam_file, n_amplicons=20, n_reads=4000)
+
+
+def test_amplicon_depth_matches_per_base_loop(bam_file):
+    with pysam.AlignmentFile(bam_file) as bam:
+        for contig, length in zip(bam.references, bam.lengths):
+            depth, n_reads, n_placed = coverage_qc.amplicon_depth(bam, contig, length)
+            expected, expected_reads = coverage_qc.amplicon_depth_per_base(
+                bam, contig, length)
+            assert np.array_equal(depth, expected)
+            assert n_reads == expected_reads
+            assert n_placed == n_reads
+
+
+def test_amplicon_depth_filters_reads(tmp_path):
+    bam_file = str(tmp_path / 'f.bam')
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1_1_20', 'LN': 20}]}
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as bam:
+        for i, (flag, mapq, cigar) in enumerate([(0, 60, '4M2D4M'), (0, 10, '8M'),
+                                                 (0x400, 60, '8M'), (0x100, 60, '8M'),
+                                                 (0, 60, '3S5M')]):
+            read = pysam.AlignedSegment()
+            read.query_name = 'r{0}'.format(i)
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = 2
+            read.mapping_quality = mapq
+            read.cigarstring = cigar
+            read.query_sequence = 'A' * 8
+            read.query_qualities = pysam.qualitystring_to_array('I' * 8)
+            bam.write(read)
+    pysam.index(bam_file)
+    with pysam.AlignmentFile(bam_file) as bam:
+        depth, n_reads, n_placed = coverage_qc.amplicon_depth(bam, 'chr1_1_20', 20)
+    # the deletion is not covered, the duplicate and secondary are not placed,
+    # the low quality read is placed but not counted
+    assert n_reads == 2
+    assert n_placed == 3
+    assert list(depth[:10]) == [0, 0, 2, 2, 2, 2, 1, 0, 1, 1]
+    assert depth.sum() == 13
+
+
+def test_coverage_qc_pool_matches_serial(bam_file):
+    serial = coverage_qc.coverage_qc(bam_file, min_depth=10)
+    pooled = coverage_qc.coverage_qc(bam_file, min_depth=10, n_processes=2,
+                                     min_pool_reads=0)
+    assert pooled == serial
+    assert serial[0]['total_reads'] == 4000
@@ -0,0 +1,81 @@
+import io
+
+import pytest
+
+import fastq_utils_zhengu_20180103 as fastq_utils
+
+
+def fastq_records(names, suffix, length=10):
+    return b''.join(b'@%s/%s\n%s\n+\n%s\n' % (name, suffix, b'A' * length, b'I' * length)
+                    for name in names)
+
+
+def names(n):
+    return [b'r%d' % i for i in range(n)]
+
+
+def test_read_fastq_batches_follows_the_k_batch_size():
+    fastq1 = io.BytesIO(fastq_records(names(7), b'1'))
+    fastq2 = io.BytesIO(fastq_records(names(7), b'2'))
+    # 20 bases per pair, a batch is closed once it holds 50
+    batches = list(fastq_utils.read_fastq_batches(fastq1, fastq2, batch_bases=50))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    record1, record2 = batches[1][0]
+    assert record1[0] == b'@r3/1\n' and record2[0] == b'@r3/2\n'
+
+
+def test_read_fastq_batches_rejects_unpaired_files():
+    fastq1 = io.BytesIO(fastq_records(names(3), b'1'))
+    fastq2 = io.BytesIO(fastq_records(names(2), b'2'))
+    with pytest.raises(ValueError):
+        list(fastq_utils.read_fastq_batches(fastq1, fastq2))
+
+
+def test_read_fastq_batches_checks_mate_names():
+    fastq1 = io.BytesIO(fastq_records([b'r0', b'r1'], b'1'))
+    fastq2 = io.BytesIO(fastq_records([b'r1', b'r0'], b'2'))
+    with pytest.raises(ValueError):
+        list(fastq_utils.read_fastq_batches(fastq1, fastq2))
+    fastq1.seek(0)
+    fastq2.seek(0)
+    assert len(list(fastq_utils.read_fastq_batches(fastq1, fastq2,
+                                                   check_names=False))) == 1
+
+
+def test_read_fastq_batches_rejects_truncated_records():
+    fastq1 = io.BytesIO(fastq_records(names(2), b'1')[:-3])
+    fastq2 = io.BytesIO(fastq_records(names(2), b'2'))
+    with pytest.raises(ValueError):
+        list(fastq_utils.read_fastq_batches(fastq1, fastq2))
+
+
+def test_split_fastq_pair_deals_batches_round_robin(tmp_path):
+    read1 = tmp_path / 'x_R1.fastq'
+    read2 = tmp_path / 'x_R2.fastq'
+    read1.write_bytes(fastq_records(names(7), b'1'))
+    read2.write_bytes(fastq_records(names(7), b'2'))
+    out_prefix = str(tmp_path / 'x')
+    chunks = fastq_utils.split_fastq_pair(str(read1), str(read2), out_prefix, 2,
+                                          batch_bases=50)
+    assert chunks == fastq_utils.chunk_file_names(out_prefix, 2)
+    chunk_names = []
+    for chunk1, chunk2 in chunks:
+        lines1 = open(chunk1, 'rb').read().splitlines()
+        lines2 = open(chunk2, 'rb').read().splitlines()
+        assert [x[:-2] for x in lines1[::4]] == [x[:-2] for x in lines2[::4]]
+        chunk_names.append([x[1:-2] for x in lines1[::4]])
+    assert chunk_names == [[b'r0', b'r1', b'r2', b'r6'], [b'r3', b'r4', b'r5']]
+
+
+def test_split_fastq_pair_drops_empty_chunks(tmp_path):
+    read1 = tmp_path / 'x_R1.fastq'
+    read2 = tmp_path / 'x_R2.fastq'
+    read1.write_bytes(fastq_records(names(4), b'1'))
+    read2.write_bytes(fastq_records(names(4), b'2'))
+    out_prefix = str(tmp_path / 'x')
+    chunks = fastq_utils.split_fastq_pair(str(read1), str(read2), out_prefix, 4,
+                                          batch_bases=50)
+    assert chunks == fastq_utils.chunk_file_names(out_prefix, 4)[:2]
+    assert sorted(x.name for x in tmp_path.iterdir()) == sorted(
+        ['x_R1.fastq', 'x_R2.fastq'] + [name.rsplit('/', 1)[1] for pair in chunks
+                                        for name in pair])
@@ -0,0 +1,34 @@
+import genotype_joining_GATK_zhengu_20171211 as genotype_joining
+
+
+def gvcfs(n):
+    return ['/v/s{0}.g.vcf'.format(i) for i in range(n)]
+
+
+def test_build_combine_tree_levels():
+    levels, top = genotype_joining.build_combine_tree(gvcfs(10), 3, '/c/', 'joint')
+    assert [len(level) for level in levels] == [4, 2]
+    # the trailing single GVCF is carried up as it is
+    assert levels[0][-1] == ('/v/s9.g.vcf', None)
+    assert [children for _, children in levels[0][:3]] == \
+        [gvcfs(10)[0:3], gvcfs(10)[3:6], gvcfs(10)[6:9]]
+    assert top[0].startswith('/c/joint.L2.') and top[1] == '/v/s9.g.vcf'
+
+
+def test_build_combine_tree_small_cohort_has_no_levels():
+    assert genotype_joining.build_combine_tree(gvcfs(3), 3, '/c/', 'joint') == \
+        ([], gvcfs(3))
+
+
+def test_build_combine_tree_reuses_unchanged_branches():
+    levels, _ = genotype_joining.build_combine_tree(gvcfs(9), 3, '/c/', 'joint')
+    grown, _ = genotype_joining.build_combine_tree(gvcfs(11), 3, '/c/', 'joint')
+    # adding samples only touches the last branch of the first level
+    assert grown[0][:3] == levels[0][:3]
+    assert grown[0][3][1] == gvcfs(11)[9:]
+
+
+def test_build_combine_tree_fan_in_at_least_two():
+    levels, top = genotype_joining.build_combine_tree(gvcfs(4), 1, '/c/', 'joint')
+    assert [len(level) for level in levels] == [2]
+    assert len(top) == 2
@@ -0,0 +1,86 @@
+import struct
+
+import intervals_zhengu_20180103 as intervals
+
+
+def test_partition_intervals_balances_and_keeps_reference_order():
+    contigs = [('a', 10), ('b', 40), ('c', 30), ('d', 20)]
+    shards = intervals.partition_intervals(contigs, 2)
+    weights = dict(contigs)
+    assert sorted(sum(weights[x] for x in shard) for shard in shards) == [50, 50]
+    order = [name for name, _ in contigs]
+    for shard in shards:
+        assert shard == sorted(shard, key=order.index)
+    assert sorted(x for shard in shards for x in shard) == sorted(order)
+
+
+def test_partition_intervals_caps_shards_at_contigs():
+    assert intervals.partition_intervals([('a', 1), ('b', 1)], 5) == [['a'], ['b']]
+    assert intervals.partition_intervals([('a', 1), ('b', 1)], 0) == [['a', 'b']]
+
+
+def test_gather_vcfs_sorts_records_and_merges_headers(tmp_path):
+    columns = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+    shards = {
+        'shard_0.vcf': ['##fileformat=VCFv4.2\n',
+                        '##GATKCommandLine=<ID=GenotypeGVCFs,CommandLine="-L 0">\n',
+                        columns, 'a\t3\t.\tA\tG\t.\t.\t.\tGT\t0/1\n',
+                        'c\t5\t.\tA\tG\t.\t.\t.\tGT\t0/1\n'],
+        'shard_1.vcf': ['##fileformat=VCFv4.2\n',
+                        '##GATKCommandLine=<ID=GenotypeGVCFs,CommandLine="-L 1">\n',
+                        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n',
+                        columns, 'b\t1\t.\tC\tT\t.\t.\t.\tGT\t1/1\n',
+                        'b\t7\t.\tC\tT\t.\t.\t.\tGT\t0/1\n'],
+    }
+    vcf_files = []
+    for name, rows in shards.items():
+        (tmp_path / name).write_text(''.join(rows))
+        vcf_files.append(str(tmp_path / name))
+    out_vcf = str(tmp_path / 'out.vcf')
+    assert intervals.gather_vcfs(vcf_files, out_vcf, ['a', 'b', 'c']) == 4
+    rows = open(out_vcf).read().splitlines()
+    header = [row for row in rows if row.startswith('#')]
+    records = [tuple(row.split('\t')[:2]) for row in rows if not row.startswith('#')]
+    assert records == [('a', '3'), ('b', '1'), ('b', '7'), ('c', '5')]
+    assert sum(row.startswith('##GATKCommandLine') for row in header) == 1
+    assert sum(row.startswith('##INFO') for row in header) == 1
+    assert header[-1] == columns.rstrip('\n')
+
+
+def write_bai(bai_file, references):
+    """A BAI whose references hold only the pseudo-bin with the given
+    (mapped, unmapped) counts, or no bins for None."""
+    data = b'BAI\x01' + struct.pack('<i', len(references))
+    for counts in references:
+        if counts is None:
+            data += struct.pack('<i', 0)
+        else:
+            data += struct.pack('<i', 2)
+            # a regular bin with one chunk before the pseudo-bin
+            data += struct.pack('<Ii', 4681, 1) + struct.pack('<QQ', 0, 100)
+            data += struct.pack('<Ii', intervals.BAI_PSEUDO_BIN, 2)
+            data += struct.pack('<QQ', 0, 100) + struct.pack('<QQ', *counts)
+        # one linear index entry
+        data += struct.pack('<i', 1) + struct.pack('<Q', 0)
+    with open(bai_file, 'wb') as f:
+        f.write(data)
+
+
+def test_read_bai_counts(tmp_path):
+    bai_file = str(tmp_path / 'x.bai')
+    write_bai(bai_file, [(12, 3), None, (7, 0)])
+    assert intervals.read_bai_counts(bai_file) == [12, 0, 7]
+
+
+def test_contig_weights_from_bai_and_fallback(tmp_path):
+    fa_file = tmp_path / 'ref.fa'
+    fa_file.write_text('>a\nACGT\nAC\n>b\nACG\n')
+    assert intervals.contig_weights(str(fa_file)) == [('a', 6), ('b', 3)]
+    bai_file = str(tmp_path / 'x.bai')
+    write_bai(bai_file, [(12, 3), None])
+    assert intervals.contig_weights(str(fa_file), 'depth', bai_file) == \
+        [('a', 13), ('b', 1)]
+    # a BAI of another reference falls back on the lengths
+    write_bai(bai_file, [(12, 3)])
+    assert intervals.contig_weights(str(fa_file), 'depth', bai_file) == \
+        [('a', 6), ('b', 3)]
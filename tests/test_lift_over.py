@@ -0,0 +1,109 @@
+import io
+
+import pytest
+
+import lift_over_zhengu_20180103 as lift_over
+
+
+def test_parse_contig_name():
+    assert lift_over.parse_contig_name('chr7_55241614_55241736') == \
+        ('chr7', 55241613, 55241736)
+    # chromosome names may contain '_' themselves
+    assert lift_over.parse_contig_name('chrUn_gl000220_101_300') == \
+        ('chrUn_gl000220', 100, 300)
+    assert lift_over.parse_contig_name('chrM') == ('chrM', 0, None)
+
+
+def test_build_offset_table(tmp_path):
+    contigs = ['chr7_101_200', 'chr7_1001_1100', 'chr2_51_150']
+    offsets, chrom_lengths = lift_over.build_offset_table(contigs)
+    assert offsets == {'chr7_101_200': ('chr7', 100), 'chr7_1001_1100': ('chr7', 1000),
+                       'chr2_51_150': ('chr2', 50)}
+    assert list(chrom_lengths.items()) == [('chr7', 1100), ('chr2', 150)]
+    genome_fai = tmp_path / 'genome.fa.fai'
+    genome_fai.write_text('chr2\t242193529\t6\t60\t61\nchr7\t159345973\t7\t60\t61\n')
+    _, chrom_lengths = lift_over.build_offset_table(contigs, str(genome_fai))
+    # the chromosomes follow the genome
+    assert list(chrom_lengths.items()) == [('chr2', 242193529), ('chr7', 159345973)]
+
+
+def test_lift_over_sam_records():
+    offsets, _ = lift_over.build_offset_table(['chr7_101_200', 'chr2_51_150'])
+    rows = ['r1\t99\tchr7_101_200\t5\t60\t10M\t=\t20\t25\tACGT\tIIII\n',
+            'r2\t65\tchr7_101_200\t5\t60\t10M\tchr2_51_150\t3\t0\tACGT\tIIII\n',
+            'r3\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n']
+    assert lift_over.lift_over_sam_records(rows, offsets) == [
+        'r1\t99\tchr7\t105\t60\t10M\t=\t120\t25\tACGT\tIIII\n',
+        'r2\t65\tchr7\t105\t60\t10M\tchr2\t53\t0\tACGT\tIIII\n',
+        'r3\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n']
+
+
+def test_lift_over_vcf_orders_amplicons_by_genomic_position():
+    contigs = ['chr7_1001_1100', 'chr7_101_200', 'chr2_51_150']
+    offsets, chrom_lengths = lift_over.build_offset_table(contigs)
+    vcf_in = io.StringIO(
+        '##fileformat=VCFv4.2\n'
+        + ''.join('##contig=<ID={0},length=100>\n'.format(x) for x in contigs)
+        + '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+        'chr7_1001_1100\t1\t.\tA\t<NON_REF>\t.\t.\tEND=50\tGT\t0/0\n'
+        'chr7_1001_1100\t60\t.\tA\tG\t.\t.\tDP=9\tGT\t0/1\n'
+        'chr7_101_200\t2\t.\tC\tT\t.\t.\tDP=3\tGT\t0/1\n'
+        'chr2_51_150\t10\t.\tG\tA\t.\t.\tDP=5\tGT\t1/1\n')
+    vcf_out = io.StringIO()
+    assert lift_over.lift_over_vcf(vcf_in, vcf_out, offsets, chrom_lengths) == 4
+    rows = vcf_out.getvalue().splitlines()
+    assert [row for row in rows if row.startswith('##contig')] == [
+        '##contig=<ID=chr7,length=1100>', '##contig=<ID=chr2,length=150>']
+    assert [row.split('\t')[:2] + row.split('\t')[7:8] for row in rows
+            if row[0] != '#'] == [
+        ['chr7', '102', 'DP=3'], ['chr7', '1001', 'END=1050'],
+        ['chr7', '1060', 'DP=9'], ['chr2', '60', 'DP=5']]
+
+
+def lift_over_rows(contigs, rows, genome_fai=None, columns='INFO\tFORMAT\tS1'):
+    offsets, chrom_lengths = lift_over.build_offset_table(contigs, genome_fai)
+    vcf_in = io.StringIO('##fileformat=VCFv4.2\n'
+                         '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\t' + columns + '\n'
+                         + ''.join(rows))
+    vcf_out = io.StringIO()
+    n_records = lift_over.lift_over_vcf(vcf_in, vcf_out, offsets, chrom_lengths)
+    return n_records, vcf_out.getvalue().splitlines()
+
+
+def test_lift_over_vcf_merges_overlapping_amplicons(monkeypatch, tmp_path):
+    # batches of a few records, so runs are continued across batches
+    monkeypatch.setattr(lift_over, 'CHUNK_BYTES', 64)
+    contigs = ['chr7_101_200', 'chr7_151_250', 'chr2_51_150', 'chr1_11_60']
+    rows = ['chr7_101_200\t{0}\t.\tA\tG\t.\t.\t.\tGT\t0/1\n'.format(x)
+            for x in [1, 40, 70, 90]]
+    rows += ['chr7_151_250\t{0}\t.\tA\tG\t.\t.\t.\tGT\t0/1\n'.format(x)
+             for x in [5, 30, 60]]
+    rows += ['chr2_51_150\t7\t.\tA\tG\t.\t.\t.\tGT\t0/1\n',
+             'chr1_11_60\t2\t.\tA\tG\t.\t.\t.\tGT\t0/1\n']
+    genome_fai = tmp_path / 'genome.fa.fai'
+    genome_fai.write_text('chr1\t1000\t6\t60\t61\nchr2\t2000\t7\t60\t61\n'
+                          'chr7\t3000\t8\t60\t61\n')
+    n_records, out_rows = lift_over_rows(contigs, rows, str(genome_fai))
+    assert n_records == 9
+    assert [row.split('\t')[:2] for row in out_rows if row[0] != '#'] == [
+        ['chr1', '12'], ['chr2', '57'], ['chr7', '101'], ['chr7', '140'],
+        ['chr7', '155'], ['chr7', '170'], ['chr7', '180'], ['chr7', '190'],
+        ['chr7', '210']]
+    assert out_rows[-10] == '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1'
+
+
+def test_lift_over_vcf_sites_only_end():
+    _, out_rows = lift_over_rows(['chr7_101_200'],
+                                 ['chr7_101_200\t1\t.\tA\t<NON_REF>\t.\t.\tEND=50\n',
+                                  'chr7_101_200\t51\t.\tA\tG\t.\t.\tEND=60\n'],
+                                 columns='INFO')
+    assert out_rows[-2:] == ['chr7\t101\t.\tA\t<NON_REF>\t.\t.\tEND=150',
+                             'chr7\t151\t.\tA\tG\t.\t.\tEND=160']
+
+
+def test_lift_over_vcf_rejects_records_out_of_reference_order():
+    rows = ['chr2_51_150\t7\t.\tA\tG\t.\t.\t.\tGT\t0/1\n',
+            'chr7_101_200\t1\t.\tA\tG\t.\t.\t.\tGT\t0/1\n',
+            'chr2_51_150\t9\t.\tA\tG\t.\t.\t.\tGT\t0/1\n']
+    with pytest.raises(ValueError):
+        lift_over_rows(['chr2_51_150', 'chr7_101_200'], rows)
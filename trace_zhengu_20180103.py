@@ -0,0 +1,224 @@
+#!/user/bin/env python3
+
+"""Record a machine-readable trace of the pipeline stages and summarize it.
+
+Every stage run through stage_cache_zhengu_20180103.run_stage appends a
+'stage' record, and every external tool an additional 'command' record, to a
+JSONL trace file (by default trace.jsonl in the logging directory). The
+records hold start and end time, duration, CPU time and utilisation, peak
+resident memory, input/output bytes and the library ID. Several pipeline
+processes may append to the same trace.
+
+ Usage::
+     $ python3 trace_zhengu_20180103.py <trace.jsonl> [chrome_trace.json]
+
+ :param chrome_trace.json: also write the trace as a timeline which can be
+                           loaded in chrome://tracing or ui.perfetto.dev
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import contextlib
+import contextvars
+from collections import OrderedDict, defaultdict
+
+trace_file = None
+trace_lock = threading.Lock()
+current_span = contextvars.ContextVar('trace_span', default=None)
+
+def configure_trace(config):
+    """Direct the trace to 'trace.file' of the configuration, or to
+    trace.jsonl in the logging directory; 'trace.enabled: false' turns it off."""
+    global trace_file
+    trace_config = config.get('trace', {})
+    if not trace_config.get('enabled', True):
+        trace_file = None
+        return None
+    trace_file = trace_config.get('file', os.path.join(config['logging'], 'trace.jsonl'))
+    return trace_file
+
+def write_record(record):
+    if trace_file is None:
+        return
+    record.setdefault('host', socket.gethostname())
+    record.setdefault('pid', os.getpid())
+    line = json.dumps(record, sort_keys=True) + '\n'
+    # a single O_APPEND write keeps lines whole across processes
+    with trace_lock:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+def command_label(command):
+    """Name a command after its tool, e.g. 'GATK HaplotypeCaller',
+    'Picard SortSam' or 'bwa mem'."""
+    args = command.split()
+    if not args:
+        return ''
+    if '-T' in args and args.index('-T') + 1 < len(args):
+        return 'GATK ' + args[args.index('-T') + 1]
+    if '-jar' in args and args.index('-jar') + 2 < len(args):
+        return 'Picard ' + args[args.index('-jar') + 2]
+    if '-cp' in args and args.index('-cp') + 2 < len(args):
+        return args[args.index('-cp') + 2].split('.')[-1]
+    tool = os.path.basename(args[0])
+    if tool.startswith('python') and len(args) > 1:
+        return os.path.basename(args[1])
+    return tool + (' ' + args[1] if len(args) > 1 and not args[1].startswith('-') else '')
+
+def record_commands(results, stage=None, library=None):
+    span = current_span.get()
+    for result in results:
+        if span is not None:
+            span['commands'].append(result)
+        write_record({'type': 'command', 'stage': stage, 'library': library,
+                      'name': command_label(result.command),
+                      'command': result.command, 'returncode': result.returncode,
+                      'start': result.time_start,
+                      'end': result.time_start + result.wall_time,
+                      'duration': result.wall_time, 'cpu_time': result.cpu_time,
+                      'cpu_util': result.cpu_time / result.wall_time
+                      if result.wall_time > 0 else 0,
+                      'max_rss_kb': result.max_rss_kb,
+                      'read_bytes': result.read_bytes,
+                      'write_bytes': result.write_bytes})
+
+def total_size(file_names):
+    return sum(os.path.getsize(x) for x in file_names if os.path.isfile(x))
+
+@contextlib.contextmanager
+def stage_span(stage, library, inputs=(), outputs=()):
+    """Trace the stage run inside the block. The caller may set 'returncode'
+    and 'cached' on the yielded span."""
+    span = {'commands': [], 'returncode': None, 'cached': False}
+    token = current_span.set(span)
+    input_bytes = total_size(inputs)
+    time_start = time.time()
+    try:
+        yield span
+    finally:
+        time_end = time.time()
+        current_span.reset(token)
+        duration = time_end - time_start
+        cpu_time = sum(result.cpu_time for result in span['commands'])
+        write_record({'type': 'stage', 'stage': stage, 'library': library,
+                      'start': time_start, 'end': time_end, 'duration': duration,
+                      'cpu_time': cpu_time,
+                      'cpu_util': cpu_time / duration if duration > 0 else 0,
+                      'max_rss_kb': max([result.max_rss_kb
+                                         for result in span['commands']] or [0]),
+                      'input_bytes': input_bytes, 'output_bytes': total_size(outputs),
+                      'n_commands': len(span['commands']),
+                      'returncode': span['returncode'], 'cached': span['cached']})
+
+def read_trace(trace_file_name):
+    records = []
+    with open(trace_file_name) as f:
+        for row in f:
+            if row.strip():
+                records.append(json.loads(row))
+    return records
+
+def summarize_by(records, key):
+    summary = OrderedDict()
+    for record in sorted(records, key=lambda x: x['start']):
+        entry = summary.setdefault(record[key], defaultdict(float))
+        entry['count'] += 1
+        entry['duration'] += record['duration']
+        entry['cpu_time'] += record['cpu_time']
+        entry['max_rss_kb'] = max(entry['max_rss_kb'], record['max_rss_kb'])
+    return summary
+
+def library_gaps(stage_records):
+    """Per library: time from the first stage start to the last stage end, the
+    time covered by stages, and the rest, spent waiting on orchestration."""
+    intervals = defaultdict(list)
+    for record in stage_records:
+        intervals[record['library']].append((record['start'], record['end']))
+    gaps = OrderedDict()
+    for library, spans in sorted(intervals.items(), key=lambda x: str(x[0])):
+        spans.sort()
+        busy = 0.0
+        covered_until = spans[0][0]
+        for start, end in spans:
+            if end > covered_until:
+                busy += end - max(start, covered_until)
+                covered_until = end
+        elapsed = max(end for _, end in spans) - spans[0][0]
+        gaps[library] = (elapsed, busy, elapsed - busy)
+    return gaps
+
+def print_summary(records):
+    stage_records = [x for x in records if x['type'] == 'stage']
+    command_records = [x for x in records if x['type'] == 'command']
+    total = sum(x['duration'] for x in command_records) or 1.0
+    print('{0:<28}{1:>7}{2:>12}{3:>10}{4:>12}{5:>8}'.format(
+        'Tool', 'Runs', 'Total [s]', 'CPU util', 'Peak [MB]', 'Share'))
+    by_tool = summarize_by(command_records, 'name')
+    for name, entry in sorted(by_tool.items(), key=lambda x: -x[1]['duration']):
+        print('{0:<28}{1:>7.0f}{2:>12.1f}{3:>10.2f}{4:>12.1f}{5:>7.1f}%'.format(
+            name, entry['count'], entry['duration'],
+            entry['cpu_time'] / entry['duration'] if entry['duration'] else 0,
+            entry['max_rss_kb'] / 1024, 100 * entry['duration'] / total))
+    print()
+    print('{0:<28}{1:>7}{2:>12}{3:>10}{4:>12}'.format(
+        'Stage', 'Runs', 'Total [s]', 'Mean [s]', 'Peak [MB]'))
+    for stage, entry in summarize_by(stage_records, 'stage').items():
+        print('{0:<28}{1:>7.0f}{2:>12.1f}{3:>10.1f}{4:>12.1f}'.format(
+            stage, entry['count'], entry['duration'],
+            entry['duration'] / entry['count'], entry['max_rss_kb'] / 1024))
+    print()
+    print('{0:<28}{1:>12}{2:>12}{3:>12}'.format(
+        'Library', 'Elapsed [s]', 'Stages [s]', 'Gaps [s]'))
+    for library, (elapsed, busy, gap) in library_gaps(stage_records).items():
+        print('{0:<28}{1:>12.1f}{2:>12.1f}{3:>12.1f}'.format(str(library), elapsed,
+                                                           busy, gap))
+
+def write_chrome_trace(records, out_file):
+    """One row group per library; stages and the tools they launched are
+    nested on the same row."""
+    time_zero = min(x['start'] for x in records)
+    library_ids = OrderedDict()
+    events = []
+    for record in records:
+        library = str(record['library'])
+        if library not in library_ids:
+            library_ids[library] = len(library_ids) + 1
+            events.append({'name': 'process_name', 'ph': 'M',
+                           'pid': library_ids[library], 'args': {'name': library}})
+        name = record['stage'] if record['type'] == 'stage' else record['name']
+        events.append({'name': str(name), 'cat': record['type'], 'ph': 'X',
+                       'ts': (record['start'] - time_zero) * 1e6,
+                       'dur': record['duration'] * 1e6,
+                       'pid': library_ids[library], 'tid': record['pid'],
+                       'args': {key: record.get(key) for key in
+                                ['cpu_util', 'max_rss_kb', 'returncode', 'command',
+                                 'input_bytes', 'output_bytes', 'cached']
+                                if key in record}})
+    with open(out_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+    records = read_trace(sys.argv[1])
+    if not records:
+        print('The trace {0} is empty.'.format(sys.argv[1]))
+        return 1
+    print_summary(records)
+    if len(sys.argv) > 2:
+        write_chrome_trace(records, sys.argv[2])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
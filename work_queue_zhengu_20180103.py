@@ -0,0 +1,562 @@
+#!/user/bin/env python3
+
+"""Run the pipeline stages from a shared work queue on one or several nodes.
+
+The tasks are the per-library stages (alignment, sorting, BQSR, the QC
+stages, HaplotypeCaller) and the cohort joining. In the chunked mode the
+splitting of the reads, every chunk alignment and the merge are tasks of
+their own. The tasks carry the same dependencies and core and memory sizes
+the single-node scheduler uses. They are submitted to a queue backend, and
+any number of workers claim the tasks whose dependencies are met:
+
+ * a claimed task is leased to its worker, which renews the lease with a
+   heartbeat while the stage runs. A task whose lease runs out, because its
+   worker died or lost the node, is handed to the next worker;
+ * a failed task is retried until 'queue.max_attempts' attempts are used,
+   then its downstream stages are skipped;
+ * a task is completed only by the worker holding its lease, so a late
+   result of a worker which lost the lease is ignored, and completing a task
+   twice changes nothing. The stage cache makes a re-run of a completed
+   stage cheap;
+ * with scratch staging, all stages of a library run on the node which
+   aligned it. Once that node holds no live lease, its scratch files are
+   taken as lost and the library starts over from the alignment on the
+   next node.
+
+The first backend is a SQLite database. It serves the workers of one node
+or, on a filesystem with working POSIX locks, of several nodes. Another
+backend, e.g. a cluster scheduler, implements the methods of SqliteQueue
+and is selected by 'queue.backend'.
+
+ Usage::
+     $ python3 work_queue_zhengu_20180103.py submit [library ...]
+     $ python3 work_queue_zhengu_20180103.py worker [cores] [memory_gb]
+     $ python3 work_queue_zhengu_20180103.py local <n_workers> [library ...]
+     $ python3 work_queue_zhengu_20180103.py status|retry
+"""
+__author__ = 'Maggie Ruimin Sun'
+__version__ = '0.1'
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import align_reads_zhengu_20180103
+import germline_variant_calling_GATK_zhengu_20180103
+import genotype_joining_GATK_zhengu_20171211
+import plan_zhengu_20180103
+import reference_zhengu_20180103
+import resources_zhengu_20180103
+import sample_sheet_zhengu_20180103
+import scratch_zhengu_20180103
+import trace_zhengu_20180103
+
+# downstream stages first, so that started libraries finish first
+STAGE_RANK = ['coverage_qc', 'bqsr_qc', 'split', 'align_chunk', 'align', 'sort', 'bqsr',
+              'call', 'join']
+# the names of the loggers run_stage_task expects, in order
+STAGE_LOGGERS = ['BWA Running Messages', 'Errors & Warnings of BWA',
+                 'Picard Running Messages', 'Errors & Warnings of Picard',
+                 'GATK Running Messages', 'Errors & Warnings of GATK']
+
+def task_id(stage, library):
+    return '{0}:{1}'.format(stage, library)
+
+def stage_rank(stage):
+    """The position of a stage in STAGE_RANK, the chunk stages
+    'align_chunk_<i>' sharing one."""
+    if stage.startswith('align_chunk_'):
+        stage = 'align_chunk'
+    return STAGE_RANK.index(stage)
+
+def task_definitions(config, libraries):
+    """The tasks of the libraries and of their joining, in dependency order,
+    as dicts of task_id, stage, library, cores, memory_gb, scratch_gb, deps
+    (task ids) and require_all."""
+    scheduler = config.get('scheduler', {})
+    definitions = []
+
+    def define(stage, library, cores, memory_gb, deps, require_all=True):
+        definitions.append({'task_id': task_id(stage, library), 'stage': stage,
+                            'library': library, 'cores': cores, 'memory_gb': memory_gb,
+                            'scratch_gb': 0, 'deps': deps, 'require_all': require_all})
+        return definitions[-1]
+
+    def define_java(stage, library, n_jvms, deps, require_all=True):
+        # sized from the resource profile of the stage, per JVM
+        profile = resources_zhengu_20180103.stage_profile(
+            config, stage, None if library == 'cohort' else library)
+        return define(stage, library, n_jvms * profile['threads'],
+                      n_jvms * resources_zhengu_20180103.jvm_memory_gb(config, profile),
+                      deps, require_all)
+
+    # one HaplotypeCaller JVM per interval shard
+    n_shards = config['snv_calling'].get('shards', 1)
+    n_bqsr_shards = config['snv_calling'].get('bqsr_shards', 1)
+    n_chunks = config['alignment'].get('chunks', 1)
+    n_chunk_workers = max(1, config['alignment'].get('chunk_workers', n_chunks))
+    for library in libraries:
+        align_profile = resources_zhengu_20180103.stage_profile(config, 'align', library)
+        jvm_memory_gb = resources_zhengu_20180103.jvm_memory_gb(config, align_profile)
+        if n_chunks > 1:
+            # the chunks are aligned by tasks of their own, 'chunk_workers' of
+            # them share the cores and memory of the alignment
+            first = define('split', library,
+                           config['alignment'].get('decompress_threads', 1), 1, [])
+            chunk_ids = []
+            for chunk in range(n_chunks):
+                chunk_task = define(
+                    'align_chunk_{0}'.format(chunk), library,
+                    max(1, config['alignment']['num_threads'] // n_chunk_workers),
+                    scheduler.get('align_memory_gb', 8) / float(n_chunk_workers) +
+                    jvm_memory_gb, [task_id('split', library)])
+                chunk_ids.append(chunk_task['task_id'])
+            # the merge produces the sorted BAM of the 'align' stage
+            define_java('align', library, 1, chunk_ids)
+        else:
+            first = define('align', library, config['alignment']['num_threads'],
+                           scheduler.get('align_memory_gb', 8), [])
+            if config['alignment'].get('streaming', False):
+                # SortSam shares the pipe with bwa and needs its own JVM
+                first['memory_gb'] += jvm_memory_gb
+        if scratch_zhengu_20180103.is_enabled(config):
+            first['scratch_gb'] = scratch_zhengu_20180103.library_scratch_gb(config)
+        define_java('sort', library, 1, [task_id('align', library)])
+        define_java('bqsr', library, n_bqsr_shards, [task_id('sort', library)])
+        define_java('call', library, n_shards, [task_id('bqsr', library)])
+        if config['snv_calling'].get('bqsr_mode', 'full') == 'lean':
+            # off the critical path, nothing downstream waits for the QC
+            define_java('bqsr_qc', library, n_bqsr_shards, [task_id('bqsr', library)])
+        if config.get('coverage_qc', {}).get('enabled', False):
+            define('coverage_qc', library, config['coverage_qc'].get('processes', 1), 1,
+                   [task_id('sort', library)])
+    # one GenotypeGVCFs JVM per interval shard as well
+    define_java('join', 'cohort', genotype_joining_GATK_zhengu_20171211.joint_shards(config),
+                [task_id('call', library) for library in libraries], require_all=False)
+    return definitions
+
+def run_stage_task(config, stage, library, loggers, libraries=None):
+    """Run one stage for a library, or the joining of 'libraries' for the
+    'join' stage. 'loggers' are the BWA, Picard and GATK process and error
+    loggers."""
+    (logger_bwa_process, logger_bwa_errors, logger_picard_process,
+     logger_picard_errors, logger_gatk_process, logger_gatk_errors) = loggers
+    if stage == 'split':
+        return align_reads_zhengu_20180103.split_library(
+            config, library, logger_bwa_process, logger_bwa_errors)
+    if stage.startswith('align_chunk_'):
+        return align_reads_zhengu_20180103.align_chunk_library(
+            config, library, int(stage[len('align_chunk_'):]), logger_bwa_process,
+            logger_bwa_errors)
+    if stage == 'align' and config['alignment'].get('chunks', 1) > 1:
+        # the split and the chunks ran as tasks of their own
+        return align_reads_zhengu_20180103.merge_library(
+            config, library, logger_bwa_process, logger_bwa_errors)
+    if stage == 'align':
+        return align_reads_zhengu_20180103.align_library(
+            config, library, logger_bwa_process, logger_bwa_errors)
+    if stage == 'join':
+        return genotype_joining_GATK_zhengu_20171211.join_libraries(
+            config, libraries, logger_gatk_process, logger_gatk_errors)
+    stage_functions = {
+        'sort': germline_variant_calling_GATK_zhengu_20180103.sort_library,
+        'coverage_qc': germline_variant_calling_GATK_zhengu_20180103.coverage_qc_library,
+        'bqsr': germline_variant_calling_GATK_zhengu_20180103.recalibrate_library,
+        'bqsr_qc': germline_variant_calling_GATK_zhengu_20180103.recalibration_qc_library,
+        'call': germline_variant_calling_GATK_zhengu_20180103.call_library}
+    if stage in ('sort', 'coverage_qc'):
+        return stage_functions[stage](config, library, logger_picard_process,
+                                      logger_picard_errors)
+    return stage_functions[stage](config, library, logger_gatk_process, logger_gatk_errors)
+
+class SqliteQueue(object):
+    """The work queue in a SQLite database. Every state change is a single
+    IMMEDIATE transaction, so concurrent workers never claim the same task."""
+    def __init__(self, database, lease_seconds=300, max_attempts=3):
+        self.database = database
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if not os.path.exists(os.path.dirname(os.path.abspath(database))):
+            os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, '
+                       'stage TEXT, library TEXT, definition TEXT, state TEXT, '
+                       'priority INTEGER, require_all INTEGER, attempts INTEGER DEFAULT 0, worker TEXT, '
+                       'host TEXT, lease_expires REAL, returncode INTEGER, '
+                       'time_start REAL, time_end REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS deps (task_id TEXT, dep_id TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)')
+            db.execute('CREATE INDEX IF NOT EXISTS deps_task ON deps (task_id)')
+
+    def transaction(self):
+        db = sqlite3.connect(self.database, timeout=60, isolation_level=None)
+        return Transaction(db)
+
+    def submit(self, definitions):
+        """Add the tasks which are not queued yet. Returns the number added."""
+        n_added = 0
+        with self.transaction() as db:
+            for definition in definitions:
+                cursor = db.execute(
+                    'INSERT OR IGNORE INTO tasks (task_id, stage, library, definition, '
+                    'state, priority, require_all) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (definition['task_id'], definition['stage'], definition['library'],
+                     json.dumps(definition), 'pending',
+                     stage_rank(definition['stage']), definition['require_all']))
+                if cursor.rowcount:
+                    n_added += 1
+                    db.executemany('INSERT INTO deps VALUES (?, ?)',
+                                   [(definition['task_id'], dep)
+                                    for dep in definition['deps']])
+        return n_added
+
+    def expire_leases(self, db, now):
+        """Hand the tasks of lost workers to the next one, counting the lost
+        run as an attempt."""
+        lost = db.execute("SELECT DISTINCT library, host FROM tasks WHERE state = 'running' "
+                          "AND lease_expires < ? AND host IS NOT NULL", (now,)).fetchall()
+        db.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' "
+                   "ELSE 'failed' END, worker = NULL, returncode = -1 "
+                   "WHERE state = 'running' AND lease_expires < ?",
+                   (self.max_attempts, now))
+        for library, host in lost:
+            if db.execute("SELECT 1 FROM tasks WHERE state = 'running' AND worker LIKE ?",
+                          (host + ':%',)).fetchone():
+                # the node is alive, only a worker of it was lost
+                continue
+            # the scratch files of the library went with the node: unpin it and
+            # run its finished stages again, unless one of them ran out of attempts
+            db.execute("UPDATE tasks SET host = NULL WHERE library = ?", (library,))
+            if not db.execute("SELECT 1 FROM tasks WHERE library = ? AND state = 'failed'",
+                              (library,)).fetchone():
+                db.execute("UPDATE tasks SET state = 'pending', returncode = NULL "
+                           "WHERE library = ? AND state = 'done'", (library,))
+
+    def skip_blocked(self, db):
+        """Skip the pending tasks whose dependencies can no longer succeed."""
+        while True:
+            cursor = db.execute(
+                "UPDATE tasks SET state = 'skipped' WHERE state = 'pending' AND ("
+                "(require_all AND EXISTS ("
+                "  SELECT 1 FROM deps JOIN tasks AS dep ON dep.task_id = deps.dep_id "
+                "  WHERE deps.task_id = tasks.task_id AND dep.state IN ('failed', 'skipped')))"
+                " OR (NOT require_all AND EXISTS ("
+                "  SELECT 1 FROM deps WHERE deps.task_id = tasks.task_id) AND NOT EXISTS ("
+                "  SELECT 1 FROM deps JOIN tasks AS dep ON dep.task_id = deps.dep_id "
+                "  WHERE deps.task_id = tasks.task_id AND dep.state NOT IN "
+                "  ('failed', 'skipped'))))")
+            if not cursor.rowcount:
+                return
+
+    def claim(self, worker, host, free_cores, free_memory_gb, free_scratch_gb=None,
+              cores=None, memory_gb=None):
+        """Lease the first ready task which fits the free resources of the
+        worker and return its definition, or None. A task larger than the
+        worker ('cores', 'memory_gb') is sized down to it."""
+        now = time.time()
+        with self.transaction() as db:
+            self.expire_leases(db, now)
+            self.skip_blocked(db)
+            rows = db.execute(
+                "SELECT task_id, definition, host FROM tasks WHERE state = 'pending' "
+                "AND (host IS NULL OR host = ?) AND NOT EXISTS ("
+                "  SELECT 1 FROM deps JOIN tasks AS dep ON dep.task_id = deps.dep_id "
+                "  WHERE deps.task_id = tasks.task_id AND dep.state NOT IN "
+                "  ('done', 'failed', 'skipped')) "
+                "ORDER BY priority DESC, rowid", (host,)).fetchall()
+            for claimed_id, definition, task_host in rows:
+                definition = json.loads(definition)
+                if cores is not None:
+                    definition['cores'] = min(definition['cores'], cores)
+                if memory_gb is not None:
+                    definition['memory_gb'] = min(definition['memory_gb'], memory_gb)
+                if definition['cores'] > free_cores or \
+                        definition['memory_gb'] > free_memory_gb:
+                    continue
+                if free_scratch_gb is not None and \
+                        definition['scratch_gb'] > free_scratch_gb:
+                    continue
+                db.execute("UPDATE tasks SET state = 'running', worker = ?, "
+                           "attempts = attempts + 1, lease_expires = ?, time_start = ? "
+                           "WHERE task_id = ?",
+                           (worker, now + self.lease_seconds, now, claimed_id))
+                if definition['scratch_gb']:
+                    # the scratch files of the library stay on this node
+                    db.execute('UPDATE tasks SET host = ? WHERE library = ?',
+                               (host, definition['library']))
+                if definition['stage'] == 'join':
+                    definition['libraries'] = [row[0] for row in db.execute(
+                        "SELECT tasks.library FROM deps JOIN tasks ON "
+                        "tasks.task_id = deps.dep_id WHERE deps.task_id = ? AND "
+                        "tasks.state = 'done' ORDER BY tasks.rowid", (claimed_id,))]
+                return definition
+        return None
+
+    def heartbeat(self, worker, task_ids):
+        """Renew the leases of the worker's tasks. Returns the ids of the
+        tasks whose lease was lost."""
+        lost = []
+        with self.transaction() as db:
+            for running_id in task_ids:
+                cursor = db.execute("UPDATE tasks SET lease_expires = ? WHERE task_id = ? "
+                                    "AND worker = ? AND state = 'running'",
+                                    (time.time() + self.lease_seconds, running_id, worker))
+                if not cursor.rowcount:
+                    lost.append(running_id)
+        return lost
+
+    def complete(self, worker, completed_id, returncode):
+        """Record the result of a task leased to 'worker'. A failed task goes
+        back to the queue while attempts are left. Returns the new state of
+        the task, or None if the worker no longer held the lease."""
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET state = CASE WHEN ? = 0 THEN 'done' "
+                "WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "returncode = ?, worker = NULL, time_end = ? "
+                "WHERE task_id = ? AND worker = ? AND state = 'running'",
+                (returncode, self.max_attempts, returncode, time.time(), completed_id,
+                 worker))
+            if not cursor.rowcount == 1:
+                return None
+            return db.execute('SELECT state FROM tasks WHERE task_id = ?',
+                              (completed_id,)).fetchone()[0]
+
+    def is_drained(self):
+        with self.transaction() as db:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE state IN "
+                              "('pending', 'running')").fetchone()[0] == 0
+
+    def is_done(self, library):
+        """Whether all tasks of a library have ended."""
+        with self.transaction() as db:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE library = ? AND state "
+                              "NOT IN ('done', 'failed', 'skipped')",
+                              (library,)).fetchone()[0] == 0
+
+    def status(self):
+        with self.transaction() as db:
+            return db.execute('SELECT stage, state, COUNT(*) FROM tasks '
+                              'GROUP BY stage, state ORDER BY priority, state').fetchall()
+
+    def retry(self):
+        """Queue the failed and skipped tasks again, unpinned, as the node
+        they were pinned to may be gone."""
+        with self.transaction() as db:
+            return db.execute("UPDATE tasks SET state = 'pending', attempts = 0, "
+                              "returncode = NULL, host = NULL "
+                              "WHERE state IN ('failed', 'skipped')").rowcount
+
+class Transaction(object):
+    """An IMMEDIATE transaction which commits on success and closes the
+    connection."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.db.close()
+        return False
+
+BACKENDS = {'sqlite': SqliteQueue}
+
+def get_queue(config):
+    queue_config = config.get('queue', {})
+    backend = BACKENDS[queue_config.get('backend', 'sqlite')]
+    return backend(queue_config.get('database',
+                                    os.path.join(config['logging'], 'queue.sqlite')),
+                   queue_config.get('lease_seconds', 300),
+                   queue_config.get('max_attempts', 3))
+
+def run_worker(config, queue, loggers, logger_process, logger_errors, cores, memory_gb):
+    """Claim and run tasks until the queue is drained. Runs as many tasks at
+    once as fit 'cores' and 'memory_gb', and the scratch budget of the node.
+    Returns the number of tasks run and the number of them which failed for
+    good."""
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    host = socket.gethostname()
+    poll_seconds = config.get('queue', {}).get('poll_seconds', 5)
+    scratch_gb = config['scratch'].get('budget_gb') \
+        if scratch_zhengu_20180103.is_enabled(config) else None
+    free = {'cores': cores, 'memory_gb': memory_gb, 'scratch_gb': scratch_gb}
+    scratch_held = {}
+    running = {}
+    running_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(queue.lease_seconds / 3.0):
+            with running_lock:
+                task_ids = [x['task_id'] for x in running.values()]
+            for lost_id in queue.heartbeat(worker, task_ids):
+                logger_errors.error('Worker %s lost the lease of %s.', worker, lost_id)
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    n_tasks = 0
+    n_failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(cores, 1)) as executor:
+            while True:
+                while True:
+                    definition = queue.claim(worker, host, free['cores'],
+                                             free['memory_gb'], free['scratch_gb'],
+                                             cores, memory_gb)
+                    if definition is None:
+                        break
+                    free['cores'] -= definition['cores']
+                    free['memory_gb'] -= definition['memory_gb']
+                    if definition['scratch_gb'] and scratch_gb is not None:
+                        free['scratch_gb'] -= definition['scratch_gb']
+                        scratch_held[definition['library']] = definition['scratch_gb']
+                    logger_process.info('Worker %s starts %s with %d cores and %s GB.',
+                                        worker, definition['task_id'],
+                                        definition['cores'], definition['memory_gb'])
+                    future = executor.submit(run_claimed_task, config, definition,
+                                             loggers, logger_errors)
+                    with running_lock:
+                        running[future] = definition
+                if not running:
+                    if queue.is_drained():
+                        break
+                    # the remaining tasks wait on other workers
+                    time.sleep(poll_seconds)
+                    continue
+                finished, _ = wait(list(running), timeout=poll_seconds,
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    with running_lock:
+                        definition = running.pop(future)
+                    free['cores'] += definition['cores']
+                    free['memory_gb'] += definition['memory_gb']
+                    returncode = future.result()
+                    state = queue.complete(worker, definition['task_id'], returncode)
+                    if state is None:
+                        logger_errors.error('Result %d of %s is ignored, the lease was '
+                                            'lost.', returncode, definition['task_id'])
+                    elif returncode == 0:
+                        logger_process.info('Worker %s finished %s.', worker,
+                                            definition['task_id'])
+                    else:
+                        logger_errors.error('Task %s returns non-zero value %d.',
+                                            definition['task_id'], returncode)
+                    if state == 'failed':
+                        n_failed += 1
+                    n_tasks += 1
+                for library in list(scratch_held):
+                    if queue.is_done(library):
+                        free['scratch_gb'] += scratch_held.pop(library)
+    finally:
+        stopped.set()
+    return n_tasks, n_failed
+
+def run_claimed_task(config, definition, loggers, logger_errors):
+    # the sharded stages size their JVMs from what the task was granted
+    token = resources_zhengu_20180103.reservation.set((definition['cores'],
+                                                       definition['memory_gb']))
+    try:
+        returncode = run_stage_task(config, definition['stage'], definition['library'],
+                                    loggers, definition.get('libraries'))
+    except Exception:
+        logger_errors.exception('Task %s raised an exception.', definition['task_id'])
+        returncode = 1
+    finally:
+        resources_zhengu_20180103.reservation.reset(token)
+    # the stage functions return None or 0 on success
+    return returncode or 0
+
+def store_logs(log_dir):
+    formatter_process = logging.Formatter("%(asctime)s;%(message)s")
+    formatter_errors = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
+    logger_process = align_reads_zhengu_20180103.setup_logger(
+        'Work Queue', log_dir + '/queue_process.log', formatter_process)
+    logger_errors = align_reads_zhengu_20180103.setup_logger(
+        'Errors of Work Queue', log_dir + '/queue_errors.log', formatter_errors)
+    return logger_process, logger_errors
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('submit', 'worker', 'local', 'status',
+                                                'retry'):
+        print(__doc__)
+        return 1
+    config = sample_sheet_zhengu_20180103.load_config()
+    if config is None:
+        return 1
+    queue = get_queue(config)
+    command = sys.argv[1]
+    if command == 'status':
+        for stage, state, n_tasks in queue.status():
+            print('{0:<12}{1:<10}{2}'.format(stage, state, n_tasks))
+        return 0
+    if command == 'retry':
+        print('Queued {0} tasks again.'.format(queue.retry()))
+        return 0
+    if command == 'local' and (len(sys.argv) < 3 or not sys.argv[2].isdigit() or
+                               int(sys.argv[2]) < 1):
+        print(__doc__)
+        return 1
+    if command in ('submit', 'local'):
+        libraries = sys.argv[3 if command == 'local' else 2:] or \
+            list(config['input_data']['libraries'])
+        unknown = [x for x in libraries if x not in config['input_data']['libraries']]
+        if unknown:
+            print('Unknown libraries: {0}'.format(', '.join(unknown)))
+            return 1
+        n_added = queue.submit(task_definitions(config, libraries))
+        print('Submitted {0} tasks.'.format(n_added))
+        if command == 'submit':
+            return 0
+        # the local stand-in of a cluster: worker processes on this node
+        n_workers = int(sys.argv[2])
+        scheduler = config.get('scheduler', {})
+        cores = max(1, scheduler.get('cores', os.cpu_count()) // n_workers)
+        memory_gb = max(1, scheduler.get('memory_gb', 16) // n_workers)
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker',
+                                     str(cores), str(memory_gb)])
+                   for _ in range(n_workers)]
+        returncodes = [worker.wait() for worker in workers]
+        # a task skipped after a failure of an earlier run fails the run too
+        unfinished = sum(n_tasks for _, state, n_tasks in queue.status()
+                         if state in ('failed', 'skipped'))
+        if unfinished:
+            print('{0} tasks failed or were skipped.'.format(unfinished))
+        return 1 if any(returncodes) or unfinished else 0
+
+    log_dir = config['logging']
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    logger_process, logger_errors = store_logs(log_dir)
+    trace_zhengu_20180103.configure_trace(config)
+    loggers = (align_reads_zhengu_20180103.store_logs(log_dir) +
+               germline_variant_calling_GATK_zhengu_20180103.store_logs(log_dir))
+    reference = reference_zhengu_20180103.prepare_reference(config, logger_process,
+                                                            logger_errors)
+    if reference is None:
+        return 1
+    reference_zhengu_20180103.apply_reference(config, reference)
+    plan_zhengu_20180103.load_plan(config, logger_process)
+    scheduler = config.get('scheduler', {})
+    cores = int(sys.argv[2]) if len(sys.argv) > 2 else scheduler.get('cores',
+                                                                    os.cpu_count())
+    memory_gb = float(sys.argv[3]) if len(sys.argv) > 3 else scheduler.get('memory_gb', 16)
+    time_start = time.time()
+    n_tasks, n_failed = run_worker(config, queue, loggers, logger_process, logger_errors,
+                                   cores, memory_gb)
+    print('Worker ran {0} tasks in {1:.1f} min, {2} failed.'.format(
+        n_tasks, (time.time() - time_start) / 60, n_failed))
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())